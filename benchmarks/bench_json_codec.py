@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""Benchmark the JSON codecs on API payloads.
+
+Decodes and encodes the operatingData, calendar and alerts payloads with every
+installed codec. Run from the repository root: python benchmarks/bench_json_codec.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from payloads import PAYLOADS  # noqa: E402
+from pyIndego.codec import CODECS  # noqa: E402
+
+NUMBER = 20000
+
+
+def main():
+    """Run the benchmark."""
+    codecs = []
+    for codec_class in CODECS.values():
+        try:
+            codecs.append(codec_class())
+        except ImportError:
+            print(f"{codec_class.name} is not installed, skipped")
+
+    reference = CODECS["json"]()
+    print(f"{'payload':<15}{'bytes':>7}  {'codec':<8}{'decode':>12}{'encode':>12}")
+    for name, payload in PAYLOADS.items():
+        body = reference.dumps(payload)
+        for codec in codecs:
+            decode = timeit.timeit(lambda: codec.loads(body), number=NUMBER) / NUMBER
+            encode = timeit.timeit(lambda: codec.dumps(payload), number=NUMBER) / NUMBER
+            print(f"{name:<15}{len(body):>7}  {codec.name:<8}{decode * 1e6:>9.2f} us{encode * 1e6:>9.2f} us")
+
+
+if __name__ == "__main__":
+    main()
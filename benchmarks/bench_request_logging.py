@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Benchmark the per request overhead of the request debug logging.
+
+Compares the old eager logging (headers copied, masked and serialized for every
+request) with the lazy logging, with DEBUG off and with DEBUG on and sampling.
+The HTTP call is replaced by a stub, so only the client overhead is measured.
+
+Run from the repository root: python benchmarks/bench_request_logging.py
+"""
+import json
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pyIndego import IndegoClient  # noqa: E402
+from pyIndego import indego_client  # noqa: E402
+from pyIndego.const import CONTENT_TYPE, CONTENT_TYPE_JSON  # noqa: E402
+from pyIndego.indego_base_client import _LOGGER  # noqa: E402
+
+STATE = {
+    "state": 64513, "map_update_available": True, "mowed": 0, "mowmode": 0, "error": 0,
+    "xPos": 1, "yPos": 1, "runtime": {"total": {"operate": 81329, "charge": 11912}, "session": {"operate": 10, "charge": 0}},
+    "mapsvgcache_ts": 1593609416617, "svg_xPos": 720, "svg_yPos": 424, "config_change": False, "mow_trig": True,
+}
+BODY = json.dumps(STATE).encode()
+NUMBER = 20000
+
+
+class StubResponse:
+    """Response returned by the stubbed requests.request."""
+
+    status_code = 200
+    headers = {CONTENT_TYPE: CONTENT_TYPE_JSON}
+    content = BODY
+
+
+class EagerLoggingClient(IndegoClient):
+    """Client with the logging as it was before: always copy, mask and serialize."""
+
+    def _log_request(self, ctx):
+        log_headers = ctx.headers.copy()
+        if "Authorization" in log_headers:
+            log_headers["Authorization"] = "******"
+        _LOGGER.debug(
+            "[%s] %s call to API endpoint %s, headers: %s, data: %s",
+            ctx.request_id,
+            ctx.method.value,
+            ctx.url,
+            json.dumps(log_headers) if log_headers is not None else "",
+            json.dumps(ctx.data) if ctx.data is not None else "",
+        )
+
+    def _log_response(self, ctx, body=None):
+        _LOGGER.debug("[%s] HTTP status code: %i", ctx.request_id, ctx.status)
+        if ctx.status == 200 and ctx.is_json:
+            _LOGGER.debug("[%s] Response (JSON): %s", ctx.request_id, ctx.result)
+
+
+def run(client, label):
+    """Time PUT requests (which have a body to log) and print the time per request."""
+    seconds = timeit.timeit(
+        lambda: client.put("alms/123456789/state", {"state": "mow"}), number=NUMBER
+    )
+    print(f"{label:<45}{seconds / NUMBER * 1e6:>8.2f} us/request")
+    return seconds
+
+
+def main():
+    """Run the benchmark."""
+    indego_client.requests.request = lambda **kwargs: StubResponse()
+    logging.basicConfig(level=logging.WARNING)
+
+    eager = run(EagerLoggingClient(token="token", serial="123456789"), "eager logging, DEBUG off (old)")
+    lazy = run(IndegoClient(token="token", serial="123456789"), "lazy logging, DEBUG off")
+    print(f"{'overhead saved per request':<45}{(eager - lazy) / NUMBER * 1e6:>8.2f} us/request")
+
+    # With DEBUG on the log records are created, a NullHandler drops them.
+    _LOGGER.setLevel(logging.DEBUG)
+    _LOGGER.propagate = False
+    _LOGGER.addHandler(logging.NullHandler())
+    client = IndegoClient(token="token", serial="123456789")
+    run(client, "lazy logging, DEBUG on, every request")
+    client.set_request_logging(sample_rate=100)
+    run(client, "lazy logging, DEBUG on, 1 in 100 requests")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""API payloads as returned by the Bosch API, used by the benchmarks."""
+
+OPERATING_DATA = {
+    "runtime": {
+        "total": {"operate": 8832, "charge": 3283},
+        "session": {"operate": 0, "charge": 0},
+    },
+    "battery": {
+        "voltage": 35.9,
+        "cycles": 2,
+        "discharge": 0.0,
+        "ambient_temp": 24,
+        "battery_temp": 24,
+        "percent": 359,
+    },
+    "garden": {
+        "id": 8,
+        "name": 1,
+        "signal_id": 1,
+        "size": 769,
+        "inner_bounds": 3,
+        "cuts": 15,
+        "runtime": 166824,
+        "charge": 37702,
+        "bumps": 6646,
+        "stops": 29,
+        "last_mow": 1,
+        "map_cell_size": 0,
+    },
+    "hmiKeys": 1768,
+}
+
+CALENDAR = {
+    "sel_cal": 3,
+    "cals": [
+        {
+            "cal": 3,
+            "days": [
+                {
+                    "day": day,
+                    "slots": [
+                        {"En": True, "StHr": 0, "StMin": 0, "EnHr": 8, "EnMin": 0, "Attr": "C"},
+                        {"En": True, "StHr": 10, "StMin": 30, "EnHr": 13, "EnMin": 0, "Attr": "p"},
+                        {"En": True, "StHr": 20, "StMin": 0, "EnHr": 23, "EnMin": 59, "Attr": "C"},
+                    ],
+                }
+                for day in range(7)
+            ],
+        }
+    ],
+}
+
+ALERTS = [
+    {
+        "alm_sn": "505703041",
+        "alert_id": f"5efda84ffbf591182723be{index:02d}",
+        "error_code": code,
+        "headline": "Mower requires attention.",
+        "date": f"2020-07-{index % 28 + 1:02d}T09:26:39.589Z",
+        "message": "Stop button activated. The Stop button has been activated. "
+                   "Please follow the instructions on the mower display.",
+        "read_status": "read" if index % 3 else "unread",
+        "flag": "warning",
+        "push": True,
+    }
+    for index, code in enumerate(["104", "101", "115", "149", "151", "ntfy_blade_life", "1005", "1108"] * 3)
+]
+
+PAYLOADS = {
+    "operatingData": OPERATING_DATA,
+    "calendar": CALENDAR,
+    "alerts": ALERTS,
+}
@@ -0,0 +1,185 @@
+"""Request budget shared by the clients of an account.
+
+A token bucket refills at the allowed number of requests per minute. Every
+request gets a priority: commands first, then the state of mowing mowers, the
+other data of mowing mowers, routine data and last the rarely changing data
+like the user and setup. A request may only take a token when the bucket keeps
+the reserve of its priority, so when the budget runs low the lower priorities
+are held back first. A held back GET is answered from the cached data of the
+client when there is any, otherwise it waits until the bucket has refilled to
+its reserve. Longpolls always wait, a longpoll loop would not yield when it was
+answered from cache. The API usage stays under the limit instead of running into 429s.
+"""
+import logging
+import threading
+import time
+from typing import Dict, Sequence
+
+from .const import ENDPOINT_UPDATES, Methods
+from .middleware import Middleware, RequestContext
+from .polling import ACTIVITY_ACTIVE, mower_activity
+
+_LOGGER = logging.getLogger(__name__)
+
+PRIORITY_COMMAND = 0
+PRIORITY_ACTIVE_STATE = 1
+PRIORITY_ACTIVE = 2
+PRIORITY_ROUTINE = 3
+PRIORITY_BULK = 4
+PRIORITY_NAMES = ("command", "active_state", "active", "routine", "bulk")
+
+# Fraction of the bucket capacity that is kept for the higher priorities, per priority.
+DEFAULT_RESERVES = (0.0, 0.1, 0.2, 0.35, 0.5)
+DEFAULT_REQUESTS_PER_MINUTE = 60
+
+# Updates that rarely change, and the map and mower list, have the lowest priority.
+BULK_UPDATES = frozenset({"config", "security", "setup", "updates_available", "user"})
+BULK_ENDPOINTS = frozenset({"alms", "alms/{serial}/map"})
+
+
+class TokenBucket:
+    """Token bucket that refills continuously, not thread safe."""
+
+    def __init__(self, rate: float, capacity: float, now: float = None):
+        """Initialize a full bucket.
+
+        Args:
+            rate (float): tokens added per second.
+            capacity (float): maximum number of tokens.
+            now (float, optional): monotonic time, defaults to time.monotonic().
+
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic() if now is None else now
+
+    def refill(self, now: float = None) -> float:
+        """Add the tokens of the time since the last refill, returns the tokens."""
+        now = time.monotonic() if now is None else now
+        if now > self._updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+        return self.tokens
+
+    def take(self, floor: float = 0, now: float = None) -> bool:
+        """Take a token when at least floor tokens are left afterwards."""
+        if self.refill(now) - 1 < floor:
+            return False
+        self.tokens -= 1
+        return True
+
+    def reserve(self, floor: float = 0, now: float = None) -> float:
+        """Take a token in advance, returns the seconds until the bucket is back at floor."""
+        self.tokens = self.refill(now) - 1
+        return max(0.0, (floor - self.tokens) / self.rate)
+
+
+class RequestBudget:
+    """Requests per minute of an account, handed out by priority."""
+
+    def __init__(
+        self,
+        requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+        burst: float = None,
+        reserves: Sequence[float] = DEFAULT_RESERVES,
+        degrade_from: int = PRIORITY_ACTIVE,
+    ):
+        """Initialize the budget.
+
+        Args:
+            requests_per_minute (float, optional): sustained number of requests. Defaults to 60.
+            burst (float, optional): capacity of the bucket, defaults to requests_per_minute / 4.
+            reserves (sequence, optional): fraction of the capacity kept for higher priorities, per priority.
+            degrade_from (int, optional): held back GETs of this or a lower priority are answered from cached data. Defaults to PRIORITY_ACTIVE.
+
+        """
+        if len(reserves) != len(PRIORITY_NAMES):
+            raise ValueError(f"Reserves should have {len(PRIORITY_NAMES)} values, one per priority.")
+        capacity = burst if burst is not None else max(1.0, requests_per_minute / 4)
+        self.bucket = TokenBucket(requests_per_minute / 60, capacity)
+        self.reserves = tuple(reserves)
+        self.degrade_from = degrade_from
+        self._lock = threading.Lock()
+        self._counts: Dict[str, Dict[str, int]] = {
+            name: {"granted": 0, "delayed": 0, "degraded": 0} for name in PRIORITY_NAMES
+        }
+        self._delay = 0.0
+
+    def priority(self, client, ctx: RequestContext) -> int:
+        """Return the priority of a request of a client."""
+        if ctx.method != Methods.GET:
+            return PRIORITY_COMMAND
+        update = ENDPOINT_UPDATES.get(ctx.endpoint)
+        if update in BULK_UPDATES or ctx.endpoint in BULK_ENDPOINTS:
+            return PRIORITY_BULK
+        active = mower_activity(client.state, client.online) == ACTIVITY_ACTIVE
+        if update == "state":
+            return PRIORITY_ACTIVE_STATE if active else PRIORITY_ACTIVE
+        return PRIORITY_ACTIVE if active else PRIORITY_ROUTINE
+
+    def _floor(self, priority: int) -> float:
+        """Return the number of tokens a request of the priority has to leave in the bucket."""
+        return self.bucket.capacity * self.reserves[priority]
+
+    def try_acquire(self, priority: int, now: float = None) -> bool:
+        """Take a token for a request when the reserve of its priority allows it."""
+        with self._lock:
+            granted = self.bucket.take(self._floor(priority), now)
+            if granted:
+                self._counts[PRIORITY_NAMES[priority]]["granted"] += 1
+            return granted
+
+    def acquire(self, priority: int, now: float = None) -> float:
+        """Take a token for a request that waits, returns the seconds to wait."""
+        with self._lock:
+            delay = self.bucket.reserve(self._floor(priority), now)
+            counts = self._counts[PRIORITY_NAMES[priority]]
+            counts["granted" if delay == 0 else "delayed"] += 1
+            self._delay += delay
+            return delay
+
+    def degraded(self, priority: int):
+        """Count a request that was answered from cached data."""
+        with self._lock:
+            self._counts[PRIORITY_NAMES[priority]]["degraded"] += 1
+
+    def stats(self) -> dict:
+        """Return the tokens left, the total seconds requests waited and the counts per priority."""
+        with self._lock:
+            return {
+                "tokens": self.bucket.refill(),
+                "capacity": self.bucket.capacity,
+                "delay": self._delay,
+                "priorities": {name: dict(counts) for name, counts in self._counts.items()},
+            }
+
+
+class BudgetMiddleware(Middleware):
+    """Take a token of the request budget for every request, or hold it back."""
+
+    def __init__(self, budget: RequestBudget):
+        """Initialize the middleware with a budget that can be shared by clients."""
+        self.budget = budget
+
+    def on_request(self, client, ctx: RequestContext):
+        """Send, answer from cached data or delay the request."""
+        priority = self.budget.priority(client, ctx)
+        if self.budget.try_acquire(priority):
+            return
+        if (
+            priority >= self.budget.degrade_from
+            and ctx.method == Methods.GET
+            and not ctx.download_to
+            and not ctx.longpoll
+        ):
+            cached = client._cached_payload(ctx.endpoint)  # pylint: disable=protected-access
+            if cached is not None:
+                _LOGGER.debug("[%s] Request budget low, using cached data for %s", ctx.request_id, ctx.endpoint)
+                self.budget.degraded(priority)
+                ctx.short_circuit(cached)
+                return
+        delay = self.budget.acquire(priority)
+        if delay:
+            _LOGGER.debug("[%s] Request budget low, delaying %s by %.1f seconds", ctx.request_id, ctx.endpoint, delay)
+            ctx.delay = max(ctx.delay, delay)
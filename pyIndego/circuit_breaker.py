@@ -0,0 +1,199 @@
+"""Circuit breakers per endpoint template.
+
+A breaker keeps the outcomes of the last requests of an endpoint. When enough
+of them failed (timeouts, connection errors and 5xx statuses) the breaker
+opens: requests fail at once instead of waiting for their timeout, GETs are
+answered from the cached data of the client when there is any. After the open
+duration a single probe request is let through (half-open), its outcome
+closes the breaker or opens it again. Longpolls are never answered from cache,
+they wait until the breaker can be probed and then fail, so a longpoll loop
+does not spin while the API is down. The breakers can be shared by the clients
+of a fleet, the endpoint templates do not contain the serial.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict
+
+from .const import Methods
+from .middleware import Middleware, RequestContext
+
+_LOGGER = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+DEFAULT_FAILURE_RATE = 0.5
+DEFAULT_MIN_REQUESTS = 10
+DEFAULT_WINDOW = 20
+DEFAULT_OPEN_DURATION = 30.0
+MIN_LONGPOLL_DELAY = 1.0
+
+
+class CircuitOpenError(Exception):
+    """The circuit breaker of the endpoint is open, the request was not sent."""
+
+
+class CircuitBreaker:
+    """Breaker of a single endpoint, not thread safe."""
+
+    def __init__(self, failure_rate: float, min_requests: int, window: int, open_duration: float):
+        """Initialize a closed breaker, see CircuitBreakers for the arguments."""
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.open_duration = open_duration
+        self.state = STATE_CLOSED
+        self.opened_at = None
+        self.probing = False
+        self.trips = 0
+        self.rejected = 0
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+
+    def allow(self, now: float) -> bool:
+        """Return True when a request may be sent, moves an open breaker to half-open after the open duration."""
+        if self.state == STATE_OPEN and now - self.opened_at >= self.open_duration:
+            self.state = STATE_HALF_OPEN
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record(self, failed: bool, now: float, probe: bool = False):
+        """Record the outcome of a sent request, only the probe counts while half-open."""
+        if self.state == STATE_OPEN or (self.state == STATE_HALF_OPEN and not probe):
+            # Sent before the breaker opened.
+            return
+        if self.state == STATE_HALF_OPEN:
+            self.probing = False
+            if failed:
+                self._open(now)
+            else:
+                self.state = STATE_CLOSED
+                self._outcomes.clear()
+            return
+        self._outcomes.append(failed)
+        failures = sum(self._outcomes)
+        if len(self._outcomes) >= self.min_requests and failures >= self.failure_rate * len(self._outcomes):
+            self._open(now)
+
+    def retry_in(self, now: float) -> float:
+        """Return the seconds until the open breaker can be probed, 0 when it is half-open."""
+        if self.state != STATE_OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.open_duration - now)
+
+    def release(self):
+        """End a probe that did not reach the API without changing the state."""
+        self.probing = False
+
+    def _open(self, now: float):
+        """Open the breaker."""
+        self.state = STATE_OPEN
+        self.opened_at = now
+        self.trips += 1
+        self._outcomes.clear()
+
+    def as_dict(self) -> dict:
+        """Return the state and counters."""
+        return {
+            "state": self.state,
+            "failures": sum(self._outcomes),
+            "requests": len(self._outcomes),
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+
+class CircuitBreakers(Middleware):
+    """Circuit breakers keyed by endpoint template, as request middleware."""
+
+    def __init__(
+        self,
+        failure_rate: float = DEFAULT_FAILURE_RATE,
+        min_requests: int = DEFAULT_MIN_REQUESTS,
+        window: int = DEFAULT_WINDOW,
+        open_duration: float = DEFAULT_OPEN_DURATION,
+    ):
+        """Initialize the breakers.
+
+        Args:
+            failure_rate (float, optional): fraction of failed requests in the window that opens a breaker. Defaults to 0.5.
+            min_requests (int, optional): requests in the window before a breaker can open. Defaults to 10.
+            window (int, optional): number of outcomes kept per endpoint. Defaults to 20.
+            open_duration (float, optional): seconds a breaker stays open before it is probed. Defaults to 30.
+
+        """
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_duration = open_duration
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        """Return the breaker of an endpoint template."""
+        with self._lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                breaker = self._breakers[endpoint] = CircuitBreaker(
+                    self.failure_rate, self.min_requests, self.window, self.open_duration
+                )
+            return breaker
+
+    def state(self, endpoint: str) -> str:
+        """Return the state of the breaker of an endpoint template."""
+        return self.breaker(endpoint).state
+
+    def stats(self) -> dict:
+        """Return the state and counters per endpoint template."""
+        with self._lock:
+            return {endpoint: breaker.as_dict() for endpoint, breaker in self._breakers.items()}
+
+    def on_request(self, client, ctx: RequestContext):
+        """Let the request through, or answer it from cached data or with CircuitOpenError."""
+        breaker = self.breaker(ctx.endpoint)
+        now = time.monotonic()
+        with self._lock:
+            allowed = breaker.allow(now)
+            probe = allowed and breaker.state == STATE_HALF_OPEN
+            retry_in = breaker.retry_in(now)
+        if allowed:
+            ctx.extras["circuit"] = "probe" if probe else "closed"
+            return
+        ctx.extras["circuit"] = STATE_OPEN
+        if ctx.longpoll:
+            # Waits before failing, a longpoll loop would otherwise not yield.
+            ctx.delay = max(ctx.delay, MIN_LONGPOLL_DELAY, retry_in)
+        cached = None
+        if ctx.method == Methods.GET and not ctx.download_to and not ctx.longpoll:
+            cached = client._cached_payload(ctx.endpoint)  # pylint: disable=protected-access
+        if cached is not None:
+            _LOGGER.debug("[%s] Circuit of %s is open, using cached data", ctx.request_id, ctx.endpoint)
+            ctx.short_circuit(cached)
+            return
+        ctx.error = CircuitOpenError(f"Circuit of {ctx.endpoint} is open, the API failed too often.")
+        ctx.short_circuit(None)
+
+    def on_response(self, client, ctx: RequestContext):
+        """Record the outcome of a request that was sent."""
+        circuit = ctx.extras.get("circuit")
+        if circuit in (None, STATE_OPEN):
+            return
+        breaker = self.breaker(ctx.endpoint)
+        with self._lock:
+            if ctx.short_circuited or isinstance(ctx.error, client._cancelled_errors):  # pylint: disable=protected-access
+                if circuit == "probe":
+                    breaker.release()
+                return
+            failed = ctx.error is not None or (
+                ctx.status is not None and ctx.status >= 500 and not (ctx.status == 504 and ctx.longpoll)
+            )
+            before = breaker.state
+            breaker.record(failed, time.monotonic(), circuit == "probe")
+            if breaker.state == STATE_OPEN and before != STATE_OPEN:
+                _LOGGER.warning("Circuit of %s opened after too many failed requests", ctx.endpoint)
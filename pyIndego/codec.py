@@ -0,0 +1,86 @@
+"""JSON codecs for pyIndego.
+
+The standard library json module is always available, orjson and ujson are used
+when they are installed because they decode and encode the API payloads faster.
+"""
+import json
+import logging
+from typing import Any, Union
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class JsonCodec:
+    """JSON codec based on the standard library."""
+
+    name = "json"
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        """Decode JSON."""
+        return json.loads(data)
+
+    def dumps(self, value: Any) -> bytes:
+        """Encode a value as compact JSON."""
+        return json.dumps(value, separators=(",", ":")).encode()
+
+    def __repr__(self):
+        """Return the name of the codec."""
+        return f"{type(self).__name__}({self.name})"
+
+
+class OrjsonCodec(JsonCodec):
+    """JSON codec based on orjson."""
+
+    name = "orjson"
+
+    def __init__(self):
+        """Import orjson, raises ImportError when it is not installed."""
+        import orjson  # pylint: disable=import-outside-toplevel
+
+        self.loads = orjson.loads
+        self.dumps = orjson.dumps
+
+
+class UjsonCodec(JsonCodec):
+    """JSON codec based on ujson."""
+
+    name = "ujson"
+
+    def __init__(self):
+        """Import ujson, raises ImportError when it is not installed."""
+        import ujson  # pylint: disable=import-outside-toplevel
+
+        self._ujson = ujson
+        self.loads = ujson.loads
+
+    def dumps(self, value: Any) -> bytes:
+        """Encode a value as JSON."""
+        return self._ujson.dumps(value).encode()
+
+
+CODECS = {codec.name: codec for codec in (OrjsonCodec, UjsonCodec, JsonCodec)}
+
+
+def get_codec(codec: Union[str, JsonCodec, None] = None) -> JsonCodec:
+    """Return a JSON codec.
+
+    Args:
+        codec (str|JsonCodec, optional): codec instance or name ('json', 'orjson', 'ujson'). Defaults to None, which gives the fastest installed codec.
+
+    Raises:
+        ValueError: when the name is unknown.
+        ImportError: when the named codec is not installed.
+
+    """
+    if isinstance(codec, JsonCodec):
+        return codec
+    if codec is not None:
+        if codec not in CODECS:
+            raise ValueError(f"Unknown JSON codec '{codec}', use one of: {', '.join(CODECS)}")
+        return CODECS[codec]()
+    for codec_class in CODECS.values():
+        try:
+            return codec_class()
+        except ImportError:
+            continue
+    return JsonCodec()
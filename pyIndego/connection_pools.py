@@ -0,0 +1,49 @@
+"""Connection pool settings of the clients.
+
+Longpolls hold a connection for minutes. They get their own pool, so they can
+not use up the connections of the short requests (updates and commands) when
+many mowers are watched.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    """Size, keep-alive and DNS cache of a connection pool."""
+
+    limit: int = 20
+    limit_per_host: int = 10
+    keepalive_timeout: float = 30
+    ttl_dns_cache: Optional[int] = 300
+
+    def tcp_connector(self) -> aiohttp.TCPConnector:
+        """Return an aiohttp connector with these settings, needs a running event loop."""
+        return aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.ttl_dns_cache,
+            use_dns_cache=self.ttl_dns_cache is not None,
+        )
+
+    def client_session(self) -> aiohttp.ClientSession:
+        """Return an aiohttp session with its own connector."""
+        return aiohttp.ClientSession(connector=self.tcp_connector(), raise_for_status=False)
+
+    def requests_session(self) -> requests.Session:
+        """Return a requests session, requests has no DNS cache or keep-alive timeout so only the size is used."""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max(1, self.limit_per_host or self.limit or 10))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+
+DEFAULT_SHORT_POOL = PoolConfig()
+# 0 is no limit, every watched mower holds a longpoll connection.
+DEFAULT_LONGPOLL_POOL = PoolConfig(limit=0, limit_per_host=0, keepalive_timeout=15)
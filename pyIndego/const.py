@@ -20,6 +20,26 @@ CONTENT_TYPE_JSON = "application/json"
 CONTENT_TYPE = "Content-Type"
 COMMANDS = ("mow", "pause", "returnToDock")
 
+# Update target of the GET endpoints (see helpers.endpoint_template), used to answer requests from cached data.
+ENDPOINT_UPDATES = {
+    "alerts": "alerts",
+    "alms/{serial}": "generic_data",
+    "alms/{serial}/calendar": "calendar",
+    "alms/{serial}/config": "config",
+    "alms/{serial}/network": "network",
+    "alms/{serial}/operatingData": "operating_data",
+    "alms/{serial}/predictive/calendar": "predictive_calendar",
+    "alms/{serial}/predictive/lastcutting": "last_completed_mow",
+    "alms/{serial}/predictive/location": "location",
+    "alms/{serial}/predictive/nextcutting": "next_mow",
+    "alms/{serial}/predictive/schedule": "predictive_schedule",
+    "alms/{serial}/security": "security",
+    "alms/{serial}/setup": "setup",
+    "alms/{serial}/state": "state",
+    "alms/{serial}/updates": "updates_available",
+    "users/{user_id}": "user",
+}
+
 DEFAULT_HEADERS = {
     CONTENT_TYPE: CONTENT_TYPE_JSON,
     # We need to change the user-agent!
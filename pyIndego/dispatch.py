@@ -0,0 +1,145 @@
+"""Priority dispatch of the requests of async clients.
+
+Requests are split into classes: interactive commands, longpolls, routine
+refreshes and maintenance (map downloads and rarely changing data). Each class
+has its own concurrency limit and all classes share a total limit. When a slot
+frees up, the waiting request of the highest class goes first, so a command
+does not queue behind the polls of a fleet. The time requests wait for a slot
+is recorded per class.
+"""
+import asyncio
+import contextlib
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict
+
+from .budget import BULK_ENDPOINTS, BULK_UPDATES
+from .const import ENDPOINT_UPDATES, Methods
+from .metrics import Histogram
+from .middleware import RequestContext
+
+_LOGGER = logging.getLogger(__name__)
+
+CLASS_INTERACTIVE = "interactive"
+CLASS_LONGPOLL = "longpoll"
+CLASS_REFRESH = "refresh"
+CLASS_MAINTENANCE = "maintenance"
+# Request classes from the highest to the lowest priority.
+REQUEST_CLASSES = (CLASS_INTERACTIVE, CLASS_LONGPOLL, CLASS_REFRESH, CLASS_MAINTENANCE)
+
+DEFAULT_LIMITS = {CLASS_INTERACTIVE: 4, CLASS_LONGPOLL: 20, CLASS_REFRESH: 8, CLASS_MAINTENANCE: 2}
+DEFAULT_MAX_CONCURRENCY = 30
+QUEUE_DELAY_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def request_class(ctx: RequestContext) -> str:
+    """Return the class of a request."""
+    if ctx.method != Methods.GET:
+        return CLASS_INTERACTIVE
+    if ctx.longpoll:
+        return CLASS_LONGPOLL
+    if ctx.download_to or ctx.endpoint in BULK_ENDPOINTS or ENDPOINT_UPDATES.get(ctx.endpoint) in BULK_UPDATES:
+        return CLASS_MAINTENANCE
+    return CLASS_REFRESH
+
+
+class PriorityDispatcher:
+    """Concurrency limits per request class for async clients, can be shared by clients."""
+
+    def __init__(self, limits: Dict[str, int] = None, max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+        """Initialize the dispatcher.
+
+        Args:
+            limits (dict, optional): maximum running requests per class, missing classes use DEFAULT_LIMITS.
+            max_concurrency (int, optional): maximum running requests of all classes. Defaults to 30.
+
+        """
+        unknown = set(limits or {}) - set(REQUEST_CLASSES)
+        if unknown:
+            raise ValueError(f"Unknown request classes: {', '.join(sorted(unknown))}.")
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.max_concurrency = max_concurrency
+        self._running = {name: 0 for name in REQUEST_CLASSES}
+        self._waiting: Dict[str, Deque[asyncio.Future]] = {name: deque() for name in REQUEST_CLASSES}
+        self._queue_delay = {name: Histogram(QUEUE_DELAY_BUCKETS) for name in REQUEST_CLASSES}
+        self._queued = {name: 0 for name in REQUEST_CLASSES}
+
+    @property
+    def running(self) -> int:
+        """Return the number of running requests."""
+        return sum(self._running.values())
+
+    def _can_start(self, name: str) -> bool:
+        """Return True when a request of the class fits in the limits."""
+        return self._running[name] < self.limits[name] and self.running < self.max_concurrency
+
+    def _waiting_before(self, name: str) -> bool:
+        """Return True when requests of the class, or of a higher class that can start, are waiting.
+
+        A higher class at its own limit does not hold back the lower classes.
+        """
+        index = REQUEST_CLASSES.index(name)
+        if self._waiting[name]:
+            return True
+        return any(self._waiting[other] and self._can_start(other) for other in REQUEST_CLASSES[:index])
+
+    async def acquire(self, name: str):
+        """Wait for a slot of the request class."""
+        start = time.monotonic()
+        if self._can_start(name) and not self._waiting_before(name):
+            self._running[name] += 1
+        else:
+            self._queued[name] += 1
+            future = asyncio.get_running_loop().create_future()
+            self._waiting[name].append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The slot was handed over just before the cancellation.
+                    self.release(name)
+                else:
+                    self._waiting[name].remove(future)
+                raise
+        self._queue_delay[name].observe(time.monotonic() - start)
+
+    def release(self, name: str):
+        """Free a slot and hand it to the highest waiting class that fits in its limits."""
+        self._running[name] -= 1
+        for other in REQUEST_CLASSES:
+            waiting = self._waiting[other]
+            while waiting and self._can_start(other):
+                future = waiting.popleft()
+                if future.done():
+                    continue
+                self._running[other] += 1
+                future.set_result(None)
+            if self.running >= self.max_concurrency:
+                return
+
+    @contextlib.asynccontextmanager
+    async def slot(self, ctx: RequestContext):
+        """Hold a slot of the class of the request while it is sent."""
+        name = request_class(ctx)
+        await self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def stats(self) -> dict:
+        """Return the running, waiting and queued requests and the queueing delay per class."""
+        return {
+            name: {
+                "limit": self.limits[name],
+                "running": self._running[name],
+                "waiting": len(self._waiting[name]),
+                "queued": self._queued[name],
+                "requests": self._queue_delay[name].count,
+                "queue_delay_sum": self._queue_delay[name].sum,
+                "queue_delay_p95": self._queue_delay[name].quantile(0.95),
+                "queue_delay_buckets": self._queue_delay[name].cumulative(),
+            }
+            for name in REQUEST_CLASSES
+        }
@@ -0,0 +1,193 @@
+"""Polling of a fleet of mowers with async clients.
+
+Every update of every mower is a timer in a hierarchical timing wheel. The
+intervals come from the polling policy of the mower activity, with a jitter
+that is derived from the serial and update, so the polls of a fleet stay spread
+out over restarts. At startup the first polls are spread over a window instead
+of all being sent at once. Every tick at most max_dispatch_per_tick updates are
+started and never more than max_concurrency run at the same time, the other
+due updates wait in a queue for the next ticks.
+"""
+import asyncio
+import logging
+import time
+import zlib
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from .polling import ACTIVITY_ACTIVE, PollingPolicy, PollingScheduler
+from .timing_wheel import Timer, TimingWheel
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_TICK = 1.0
+DEFAULT_MAX_CONCURRENCY = 20
+DEFAULT_MAX_DISPATCH_PER_TICK = 20
+DEFAULT_JITTER = 0.1
+DEFAULT_STARTUP_WINDOW = 60.0
+
+
+class FleetScheduler:
+    """Poll the updates of many async clients from a single timing wheel."""
+
+    def __init__(
+        self,
+        policy: PollingPolicy = None,
+        updates: List[str] = None,
+        tick: float = DEFAULT_TICK,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        max_dispatch_per_tick: int = DEFAULT_MAX_DISPATCH_PER_TICK,
+        jitter: float = DEFAULT_JITTER,
+        startup_window: float = DEFAULT_STARTUP_WINDOW,
+    ):
+        """Initialize the scheduler.
+
+        Args:
+            policy (PollingPolicy, optional): intervals per activity, defaults to PollingPolicy().
+            updates (list, optional): names of the updates to poll, defaults to all updates of the policy.
+            tick (float, optional): seconds per tick of the timing wheel. Defaults to 1.
+            max_concurrency (int, optional): maximum number of updates that run at the same time. Defaults to 20.
+            max_dispatch_per_tick (int, optional): maximum number of updates started per tick. Defaults to 20.
+            jitter (float, optional): fraction of the interval an update is moved, up or down. Defaults to 0.1.
+            startup_window (float, optional): seconds over which the first polls of a client are spread. Defaults to 60.
+
+        """
+        self.policy = policy or PollingPolicy()
+        self.updates = list(updates or self.policy.intervals)
+        self.tick = tick
+        self.max_concurrency = max_concurrency
+        self.max_dispatch_per_tick = max_dispatch_per_tick
+        self.jitter = jitter
+        self.startup_window = startup_window
+        self._wheel = TimingWheel(tick=self._tick_of(time.monotonic()))
+        self._schedulers: Dict[str, PollingScheduler] = {}
+        self._timers: Dict[Tuple[str, str], Timer] = {}
+        self._ready: Deque[Tuple[str, str]] = deque()
+        self._tasks = set()
+
+    def _tick_of(self, monotonic: float) -> int:
+        """Return the tick of a monotonic time."""
+        return int(monotonic / self.tick)
+
+    @staticmethod
+    def _fraction(serial: str, update: str, salt: str = "") -> float:
+        """Return a fraction in [0, 1) that only depends on the serial, update and salt."""
+        return zlib.crc32(f"{serial}/{update}/{salt}".encode()) / 2**32
+
+    def _delay(self, serial: str, update: str, interval: float) -> float:
+        """Return the interval with the jitter of the update of this mower."""
+        return interval * (1 + self.jitter * (2 * self._fraction(serial, update) - 1))
+
+    def _now(self) -> float:
+        """Return the time of the current tick of the wheel, polls are rescheduled from there."""
+        return self._wheel.tick * self.tick
+
+    def _schedule(self, serial: str, update: str, delay: float, now: float):
+        """Schedule the next poll of an update delay seconds from now."""
+        key = (serial, update)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            self._wheel.cancel(timer)
+        self._timers[key] = self._wheel.schedule(self._tick_of(now + delay), key)
+
+    @property
+    def in_flight(self) -> int:
+        """Return the number of running updates."""
+        return len(self._tasks)
+
+    @property
+    def queued(self) -> int:
+        """Return the number of due updates that wait for a free slot."""
+        return len(self._ready)
+
+    def add_client(self, client, now: float = None):
+        """Start polling a client, its first polls are spread over the startup window.
+
+        Args:
+            client (IndegoAsyncClient): client with a serial.
+            now (float, optional): monotonic time, defaults to time.monotonic().
+
+        """
+        now = time.monotonic() if now is None else now
+        serial = client.serial
+        if serial in self._schedulers:
+            raise ValueError(f"Mower {serial} is already polled.")
+        self._schedulers[serial] = PollingScheduler(client, self.policy, self.updates)
+        for update in self.updates:
+            interval = self.policy.interval(update, ACTIVITY_ACTIVE)
+            self._schedule(serial, update, self._fraction(serial, update, "start") * min(interval, self.startup_window), now)
+
+    def remove_client(self, client):
+        """Stop polling a client, running updates finish."""
+        serial = client.serial
+        self._schedulers.pop(serial, None)
+        for update in self.updates:
+            timer = self._timers.pop((serial, update), None)
+            if timer is not None:
+                self._wheel.cancel(timer)
+
+    def due_in(self, serial: str, update: str, now: float = None) -> Optional[float]:
+        """Return the seconds from the current tick (or now) until the next poll of an update, None when it is not scheduled."""
+        timer = self._timers.get((serial, update))
+        if timer is None or not timer.active:
+            return None
+        now = self._now() if now is None else now
+        return timer.expiry * self.tick - now
+
+    def run_pending(self, now: float = None) -> int:
+        """Advance the wheel to now and start due updates within the limits, returns the number started."""
+        now = time.monotonic() if now is None else now
+        for timer in self._wheel.advance(self._tick_of(now)):
+            if self._timers.get(timer.payload) is timer:
+                del self._timers[timer.payload]
+                self._ready.append(timer.payload)
+        started = 0
+        while self._ready and started < self.max_dispatch_per_tick and len(self._tasks) < self.max_concurrency:
+            serial, update = self._ready.popleft()
+            if serial not in self._schedulers:
+                continue
+            task = asyncio.ensure_future(self._poll(serial, update))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            started += 1
+        if self._ready:
+            _LOGGER.debug("%i due updates wait for the next tick", len(self._ready))
+        return started
+
+    async def _poll(self, serial: str, update: str):
+        """Run an update and schedule the next one."""
+        scheduler = self._schedulers[serial]
+        request = scheduler.request(update)
+        activity = scheduler.activity()
+        with scheduler.client._span("refresh", update=update, activity=activity):  # pylint: disable=protected-access
+            try:
+                await getattr(scheduler.client, f"update_{update}")(**request.kwargs)
+            except Exception as exc:  # pylint: disable=broad-except
+                _LOGGER.warning("Polling %s of %s failed: %s", update, serial, exc)
+        if serial not in self._schedulers:
+            return
+        now = self._now()
+        self._schedule(serial, update, self._delay(serial, update, scheduler.request(update).interval), now)
+        if update == "state" and scheduler.activity() != activity:
+            self._reschedule(serial, now)
+
+    def _reschedule(self, serial: str, now: float):
+        """Move polls of a mower forward that are later than the interval of its new activity."""
+        scheduler = self._schedulers[serial]
+        for update in self.updates:
+            delay = self._delay(serial, update, scheduler.request(update).interval)
+            due_in = self.due_in(serial, update, now)
+            if due_in is not None and due_in > delay:
+                self._schedule(serial, update, delay, now)
+
+    async def run(self, stop: asyncio.Event = None):
+        """Poll until stop is set, running updates are awaited before returning."""
+        stop = stop or asyncio.Event()
+        while not stop.is_set():
+            self.run_pending()
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.tick)
+            except asyncio.TimeoutError:
+                pass
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,24 @@
+"""Fetch time and source of the attributes of a client."""
+import time
+from dataclasses import dataclass
+
+SOURCE_NETWORK = "network"
+SOURCE_CACHE = "cache"
+SOURCE_SNAPSHOT = "snapshot"
+
+
+@dataclass(frozen=True)
+class FetchInfo:
+    """When and from where an attribute was last updated."""
+
+    timestamp: float
+    source: str = SOURCE_NETWORK
+
+    @property
+    def age(self) -> float:
+        """Return the seconds since the attribute was fetched."""
+        return time.time() - self.timestamp
+
+    def is_fresh(self, max_age: float) -> bool:
+        """Return True when the attribute is at most max_age seconds old."""
+        return self.age <= max_age
@@ -0,0 +1,126 @@
+"""Hedged GET requests for the async client.
+
+When a GET has not been answered by the observed p95 latency of its endpoint,
+the same request is sent a second time. The first answer is used and the other
+request is cancelled. Every request adds max_rate to a small budget and every
+hedge takes 1 from it, so at most about max_rate of the requests are hedged and
+a slow API does not get twice the load. Longpolls and map downloads are never
+hedged, and neither are PUTs, which are not idempotent.
+"""
+import asyncio
+import dataclasses
+import logging
+from typing import Awaitable, Callable, Optional
+
+from .const import Methods
+from .middleware import RequestContext
+from .timeouts import LatencyTracker
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_HEDGE_QUANTILE = 0.95
+DEFAULT_MAX_HEDGE_RATE = 0.05
+DEFAULT_MIN_SAMPLES = 20
+MAX_HEDGE_BURST = 5
+
+
+class Hedger:
+    """Send a second GET when the first is slower than the quantile of its endpoint."""
+
+    def __init__(
+        self,
+        quantile: float = DEFAULT_HEDGE_QUANTILE,
+        max_rate: float = DEFAULT_MAX_HEDGE_RATE,
+        min_samples: int = DEFAULT_MIN_SAMPLES,
+        tracker: LatencyTracker = None,
+    ):
+        """Initialize the hedger.
+
+        Args:
+            quantile (float, optional): latency quantile after which the hedge is sent. Defaults to 0.95.
+            max_rate (float, optional): maximum fraction of the requests that is hedged. Defaults to 0.05.
+            min_samples (int, optional): requests of an endpoint before it is hedged. Defaults to 20.
+            tracker (LatencyTracker, optional): latencies of the first requests, share it between the clients of a fleet.
+
+        """
+        self.quantile = quantile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.tracker = tracker or LatencyTracker()
+        self._budget = 1.0
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    @staticmethod
+    def eligible(ctx: RequestContext) -> bool:
+        """Return True for a request that may be hedged."""
+        return ctx.method == Methods.GET and not ctx.longpoll and not ctx.download_to
+
+    def _hedge_delay(self, key) -> float:
+        """Return the seconds after which a request is hedged, None when the endpoint has too few samples."""
+        if self.tracker.count(key) < self.min_samples:
+            return None
+        return self.tracker.percentile(key, self.quantile)
+
+    def _take_budget(self) -> bool:
+        """Take a hedge from the budget."""
+        if self._budget < 1:
+            return False
+        self._budget -= 1
+        return True
+
+    async def send(self, ctx: RequestContext, send: Callable[[RequestContext], Awaitable[None]]):
+        """Send the request with send, and a hedge when it is slow, the outcome of the first answer ends up in ctx."""
+        key = self.tracker.key(ctx)
+        delay = self._hedge_delay(key)
+        self.requests += 1
+        self._budget = min(MAX_HEDGE_BURST, self._budget + self.max_rate)
+        primary = asyncio.ensure_future(send(ctx))
+        hedge_ctx = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+                if not done and self._take_budget():
+                    hedge_ctx = await self._race(ctx, primary, send)
+            await primary
+        finally:
+            if not primary.done():
+                primary.cancel()
+        # The latency of the first request is kept, also when it was cancelled for the hedge.
+        if ctx.elapsed is not None:
+            self.tracker.observe(key, ctx.elapsed)
+        if hedge_ctx is not None:
+            ctx.copy_outcome(hedge_ctx)
+            ctx.extras["hedged"] = True
+
+    async def _race(
+        self, ctx: RequestContext, primary: asyncio.Future, send: Callable[[RequestContext], Awaitable[None]]
+    ) -> Optional[RequestContext]:
+        """Send the hedge, return its context when it gave the first successful answer."""
+        self.hedged += 1
+        _LOGGER.debug("[%s] No answer after the p%i latency, hedging %s", ctx.request_id, self.quantile * 100, ctx.path)
+        hedge_ctx = dataclasses.replace(ctx, request_id=f"{ctx.request_id}-H", extras={})
+        hedge = asyncio.ensure_future(send(hedge_ctx))
+        try:
+            await asyncio.wait({primary, hedge}, return_when=asyncio.FIRST_COMPLETED)
+            # A request that failed fast does not win, the other one may still answer.
+            if not primary.done() and hedge_ctx.error is not None:
+                await primary
+            elif not hedge.done() and ctx.error is not None:
+                await hedge
+            if primary.done() and ctx.error is None:
+                return None
+            if hedge.done() and hedge_ctx.error is None:
+                self.hedge_wins += 1
+                return hedge_ctx
+            return None
+        finally:
+            for task in (primary, hedge):
+                if not task.done():
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+
+    def stats(self) -> dict:
+        """Return the number of requests, hedges and hedges that answered first."""
+        return {"requests": self.requests, "hedged": self.hedged, "hedge_wins": self.hedge_wins}
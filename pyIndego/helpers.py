@@ -69,3 +69,16 @@ def generate_update(field: Any, new: dict, new_class: Any):
 def random_request_id() -> str:
     """A random ID for API request to for easier tracking of corresponding log messages."""
     return ''.join(random.choices('ABCDEF' + string.digits, k=6))
+
+
+def endpoint_template(path: str) -> str:
+    """Return the endpoint of an API path without query and with the serial or id replaced, e.g. 'alms/{serial}/state'."""
+    parts = path.split("?", 1)[0].strip("/").split("/")
+    if len(parts) > 1:
+        if parts[0] == "alms":
+            parts[1] = "{serial}"
+        elif parts[0] == "alerts":
+            parts[1] = "{alert_id}"
+        elif parts[0] == "users":
+            parts[1] = "{user_id}"
+    return "/".join(parts)
@@ -0,0 +1,192 @@
+"""Time series history of the state and operating data of a mower.
+
+Every column is a fixed size array from the array module used as ring buffer,
+so the memory of a history does not grow after it is full. Missing values are
+stored as NaN (floats) or -1 (state and error codes). Timestamps only go up, so
+range queries are binary searches.
+"""
+import logging
+import math
+import threading
+import time
+from array import array
+from typing import Dict, Iterator, Optional, Tuple
+
+from .states import OperatingData, State
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 10000
+MISSING_CODE = -1
+
+# Column name and array type code, 'q' columns hold codes, 'd' columns measurements.
+COLUMNS: Tuple[Tuple[str, str], ...] = (
+    ("timestamp", "d"),
+    ("state", "q"),
+    ("error", "q"),
+    ("x", "d"),
+    ("y", "d"),
+    ("battery_percent", "d"),
+    ("battery_voltage", "d"),
+    ("battery_temperature", "d"),
+    ("mowed", "d"),
+    ("runtime_operate", "d"),
+    ("runtime_charge", "d"),
+)
+
+
+def _value(value, code: str):
+    """Return the value to store, with the missing marker of the column type for None."""
+    if value is None:
+        return MISSING_CODE if code == "q" else math.nan
+    return int(value) if code == "q" else float(value)
+
+
+def build_row(timestamp: float, state: Optional[State], operating_data: Optional[OperatingData]) -> tuple:
+    """Return the values of a history row from the current state and operating data."""
+    battery = operating_data.battery if operating_data is not None else None
+    values = (
+        timestamp,
+        state.state if state else None,
+        state.error if state else None,
+        state.xPos if state else None,
+        state.yPos if state else None,
+        battery.percent_adjusted if battery else None,
+        battery.voltage if battery else None,
+        battery.battery_temp if battery else None,
+        state.mowed if state else None,
+        state.runtime.total.operate if state else None,
+        state.runtime.total.charge if state else None,
+    )
+    return tuple(_value(value, code) for value, (_, code) in zip(values, COLUMNS))
+
+
+class History:
+    """Columnar ring buffer of the state and operating data of a mower."""
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        """Allocate the columns.
+
+        Args:
+            capacity (int, optional): number of rows to keep, the oldest rows are overwritten. Defaults to DEFAULT_CAPACITY.
+
+        """
+        if capacity < 1:
+            raise ValueError("Capacity should be 1 or higher.")
+        self.capacity = capacity
+        self._columns: Dict[str, array] = {
+            name: array(code, [_value(None, code)]) * capacity for name, code in COLUMNS
+        }
+        self._start = 0
+        self._length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Return the number of rows."""
+        return self._length
+
+    @property
+    def nbytes(self) -> int:
+        """Return the memory used by the columns."""
+        return sum(column.itemsize * len(column) for column in self._columns.values())
+
+    def append(self, row: tuple):
+        """Append a row with a value for every column, in the order of COLUMNS."""
+        with self._lock:
+            if self._length and row[0] < self._columns["timestamp"][(self._start + self._length - 1) % self.capacity]:
+                _LOGGER.debug("History row with timestamp %s is older than the last row, it is not recorded", row[0])
+                return
+            position = (self._start + self._length) % self.capacity
+            for (name, _), value in zip(COLUMNS, row):
+                self._columns[name][position] = value
+            if self._length < self.capacity:
+                self._length += 1
+            else:
+                self._start = (self._start + 1) % self.capacity
+
+    def record(self, state: Optional[State], operating_data: Optional[OperatingData], timestamp: float = None):
+        """Append a row with the current state and operating data of a client."""
+        self.append(build_row(time.time() if timestamp is None else timestamp, state, operating_data))
+
+    def _bisect(self, timestamp: float, right: bool) -> int:
+        """Return the logical index where the timestamp would be inserted."""
+        timestamps = self._columns["timestamp"]
+        low, high = 0, self._length
+        while low < high:
+            middle = (low + high) // 2
+            value = timestamps[(self._start + middle) % self.capacity]
+            if value < timestamp or (right and value == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _indexes(self, start: Optional[float], end: Optional[float]) -> range:
+        """Return the logical indexes of the rows with start <= timestamp <= end."""
+        first = 0 if start is None else self._bisect(start, False)
+        last = self._length if end is None else self._bisect(end, True)
+        return range(first, max(first, last))
+
+    def column(self, name: str, start: float = None, end: float = None) -> list:
+        """Return the values of a column between start and end (timestamps, inclusive)."""
+        with self._lock:
+            column = self._columns[name]
+            return [column[(self._start + index) % self.capacity] for index in self._indexes(start, end)]
+
+    def range(self, start: float = None, end: float = None) -> Iterator[dict]:
+        """Return the rows between start and end (timestamps, inclusive) as dicts, oldest first."""
+        with self._lock:
+            positions = [(self._start + index) % self.capacity for index in self._indexes(start, end)]
+            rows = [{name: self._columns[name][position] for name, _ in COLUMNS} for position in positions]
+        return iter(rows)
+
+    def to_numpy(self, start: float = None, end: float = None) -> Dict[str, "np.ndarray"]:
+        """Return the columns between start and end as numpy arrays (copies), oldest first.
+
+        Raises:
+            ImportError: when numpy is not installed.
+
+        """
+        if np is None:
+            raise ImportError("to_numpy requires numpy, install pyIndego[numpy].")
+        with self._lock:
+            indexes = self._indexes(start, end)
+            positions = (np.arange(indexes.start, indexes.stop) + self._start) % self.capacity
+            return {
+                name: np.frombuffer(self._columns[name], dtype=self._columns[name].typecode)[positions]
+                for name, _ in COLUMNS
+            }
+
+    def latest(self) -> Optional[dict]:
+        """Return the last row, None when the history is empty."""
+        with self._lock:
+            if not self._length:
+                return None
+            position = (self._start + self._length - 1) % self.capacity
+            return {name: self._columns[name][position] for name, _ in COLUMNS}
+
+    @property
+    def last_timestamp(self) -> Optional[float]:
+        """Return the timestamp of the last row."""
+        if not self._length:
+            return None
+        return self._columns["timestamp"][(self._start + self._length - 1) % self.capacity]
+
+    def drop_before(self, timestamp: float) -> int:
+        """Remove the rows that are older than timestamp, returns the number of removed rows."""
+        with self._lock:
+            count = self._bisect(timestamp, False)
+            self._start = (self._start + count) % self.capacity
+            self._length -= count
+        return count
+
+    def clear(self):
+        """Remove all rows, the memory stays allocated."""
+        with self._lock:
+            self._start = 0
+            self._length = 0
@@ -1,10 +1,9 @@
 """API for Bosch API server for Indego lawn mower."""
 import asyncio
 import logging
-import json
 import time
 from socket import error as SocketError
-from typing import Any, Optional, Callable, Awaitable
+from typing import Any, Optional, Callable, Awaitable, Union
 
 import aiohttp
 from aiohttp import (
@@ -15,6 +14,7 @@ from aiohttp import (
 )
 from aiohttp.web_exceptions import HTTPGatewayTimeout
 
+from .codec import JsonCodec
 from .const import (
     COMMANDS,
     CONTENT_TYPE_JSON,
@@ -22,9 +22,14 @@ from .const import (
     DEFAULT_URL,
     Methods,
 )
+from .connection_pools import DEFAULT_LONGPOLL_POOL, PoolConfig
+from .dispatch import PriorityDispatcher
+from .hedging import Hedger
 from .indego_base_client import IndegoBaseClient
+from .map_download import CHUNK_SIZE, AtomicFileWriter, MapDownload
+from .middleware import RequestContext
 from .states import Calendar
-from .helpers import random_request_id
+from .telemetry_log import TelemetryLog
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -32,6 +37,11 @@ _LOGGER = logging.getLogger(__name__)
 class IndegoAsyncClient(IndegoBaseClient):
     """Class for Indego Async Client."""
 
+    _timeout_errors = (asyncio.TimeoutError, ServerTimeoutError, HTTPGatewayTimeout, ClientOSError)
+    _request_errors = (TooManyRedirects, ClientResponseError, SocketError)
+    _cancelled_errors = (asyncio.CancelledError,)
+    _deadline_errors = (asyncio.TimeoutError, ServerTimeoutError)
+
     def __init__(
         self,
         token: str,
@@ -41,6 +51,8 @@ class IndegoAsyncClient(IndegoBaseClient):
         api_url: str = DEFAULT_URL,
         session: aiohttp.ClientSession = None,
         raise_request_exceptions: bool = False,
+        json_codec: Union[str, JsonCodec] = None,
+        token_invalidate_method: Optional[Callable[[], Awaitable[None]]] = None,
     ):
         """Initialize the Async Client.
 
@@ -51,16 +63,36 @@ class IndegoAsyncClient(IndegoBaseClient):
             map_filename (str, optional): Filename to store maps in. Defaults to None.
             api_url (str, optional): url for the api, defaults to DEFAULT_URL.
             raise_request_exceptions (bool): Should unexpected API request exception be raised or not. Default False to keep things backwards compatible.
+            json_codec (str|JsonCodec, optional): JSON codec ('json', 'orjson' or 'ujson'), defaults to the fastest installed one.
+            token_invalidate_method (callback, optional): Callback method that drops a cached token, called before the refresh after a 401.
         """
-        super().__init__(token, token_refresh_method, serial, map_filename, api_url, raise_request_exceptions)
+        super().__init__(
+            token,
+            token_refresh_method,
+            serial,
+            map_filename,
+            api_url,
+            raise_request_exceptions,
+            json_codec,
+            token_invalidate_method,
+        )
         if session:
             self._session = session
             # We should only close session we own.
             # In this case don't own it, probably a reference from HA.
             self._should_close_session = False
         else:
+            # aiohttp's default limits, set_connection_pools() changes them.
             self._session = aiohttp.ClientSession(raise_for_status=False)
             self._should_close_session = True
+        # Longpolls of a session passed by the caller go through that session until set_connection_pools().
+        self._longpoll_pool = None if session else DEFAULT_LONGPOLL_POOL
+        self._longpoll_session = None
+        self._telemetry_sync = None
+        self._refreshing = {}
+        self._dispatcher = None
+        self._token_refresh = None
+        self._hedger = None
 
     async def __aenter__(self):
         """Enter for async with."""
@@ -79,10 +111,87 @@ class IndegoAsyncClient(IndegoBaseClient):
         else:
             _LOGGER.debug("Token refresh is NOT available")
 
+    async def _refresh_token(self, stale: str) -> bool:
+        """Replace a token the API rejected, a single refresh is shared by the requests that got a 401 with it.
+
+        Returns:
+            bool: False when the refresh failed.
+
+        """
+        if self._token != stale:
+            # Another request already refreshed it.
+            return True
+        if self._token_refresh is None:
+            _LOGGER.debug("Token rejected by the API, refreshing it")
+            self._token_refresh = asyncio.ensure_future(self._refresh_rejected_token())
+        refresh = self._token_refresh
+        try:
+            token = await asyncio.shield(refresh)
+        except Exception as exc:  # pylint: disable=broad-except
+            _LOGGER.error("Refreshing the rejected token failed: %s", exc)
+            return False
+        finally:
+            if self._token_refresh is refresh and refresh.done():
+                self._token_refresh = None
+        self._new_token(token)
+        return True
+
+    async def _refresh_rejected_token(self) -> str:
+        """Drop the cached token when the callback allows it, and get a new one."""
+        if self._token_invalidate_method is not None:
+            await self._token_invalidate_method()
+        return await self._token_refresh_method()
+
+    def _sync_telemetry_log(self, log: TelemetryLog):
+        """Write the pending rows of the telemetry log in the executor, one write at a time."""
+        if self._telemetry_sync is not None and not self._telemetry_sync.done():
+            # The running write takes the new rows as well, or the next row starts another one.
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            super()._sync_telemetry_log(log)
+            return
+        self._telemetry_sync = loop.run_in_executor(None, super()._sync_telemetry_log, log)
+
     async def close(self):
-        """Close the aiohttp session."""
+        """Close the aiohttp sessions, after a running write of the telemetry log."""
+        if self._telemetry_sync is not None:
+            await self._telemetry_sync
+            self._telemetry_sync = None
         if self._should_close_session:
             await self._session.close()
+        if self._longpoll_session is not None:
+            await self._longpoll_session.close()
+            self._longpoll_session = None
+
+    async def set_connection_pools(self, short: PoolConfig = None, longpoll: PoolConfig = None):
+        """Change the connection pools of the short requests and the longpolls, longpolls then use their own pool.
+
+        Args:
+            short (PoolConfig, optional): pool of the updates and commands, replaces a session that was passed to the client.
+            longpoll (PoolConfig, optional): pool of the longpolls.
+
+        """
+        if short is not None:
+            if self._should_close_session:
+                await self._session.close()
+            self._session = short.client_session()
+            self._should_close_session = True
+            self._longpoll_pool = self._longpoll_pool or DEFAULT_LONGPOLL_POOL
+        if longpoll is not None:
+            if self._longpoll_session is not None:
+                await self._longpoll_session.close()
+                self._longpoll_session = None
+            self._longpoll_pool = longpoll
+
+    def _session_for(self, ctx: RequestContext) -> aiohttp.ClientSession:
+        """Return the session of the pool of the request, the longpoll session is created on first use."""
+        if not ctx.longpoll or self._longpoll_pool is None:
+            return self._session
+        if self._longpoll_session is None or self._longpoll_session.closed:
+            self._longpoll_session = self._longpoll_pool.client_session()
+        return self._longpoll_session
 
     async def get_mowers(self):
         """Get a list of the available mowers (serials) in the account."""
@@ -121,20 +230,93 @@ class IndegoAsyncClient(IndegoBaseClient):
     async def download_map(self, filename: str = None):
         """Download the map.
 
+        The map is streamed to a temporary file, which replaces the map file when the download is complete.
+        With a map cache (see set_map_cache) the map is only requested when the state reports a new map version.
+
         Args:
             filename (str, optional): Filename for the map. Defaults to None, can also be filled by the filename set in init.
 
+        Returns:
+            MapDownload: filename, size, duration and digest of the download, None when the map was not downloaded.
+
         """
         if not self.serial:
-            return
+            return None
         if filename:
             self.map_filename = filename
         if not self.map_filename:
             raise ValueError("No map filename defined.")
-        lawn_map = await self.get(f"alms/{self.serial}/map")
-        if lawn_map:
-            with open(self.map_filename, "wb") as file:
-                file.write(lawn_map)
+        version = self._map_version()
+        loop = asyncio.get_running_loop()
+        if version is not None:
+            cached = await loop.run_in_executor(None, self._load_cached_map, version)
+            if cached is not None:
+                return cached
+        lawn_map = await self.get(f"alms/{self.serial}/map", download_to=self.map_filename)
+        if not isinstance(lawn_map, MapDownload):
+            return None
+        self._map_model = None
+        if self._map_cache is not None:
+            await loop.run_in_executor(None, self._store_map, version, lawn_map)
+        return lawn_map
+
+    async def load_map_model(self):
+        """Parse the map file into a MapModel, parsing runs in the executor.
+
+        The model is kept and only parsed again when the map version (mapsvgcache_ts) of the state changes.
+
+        Returns:
+            MapModel: lawn polygons, dock position and bounding box of the map.
+
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self._parse_map_model)
+
+    async def snapshot(self, filename: str = None):
+        """Take a snapshot of the API responses of all populated attributes and their fetch times.
+
+        Args:
+            filename (str, optional): file to write the snapshot to (gzip compressed JSON), the write runs in the executor.
+
+        Returns:
+            dict: the snapshot, can be passed to restore as well.
+
+        """
+        data = self._snapshot_data()
+        if filename:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_snapshot, data, filename)
+        return data
+
+    async def restore(self, snapshot):
+        """Restore the attributes from a snapshot, without any requests.
+
+        Run update_all afterwards (for instance in a background task) to refresh the restored data.
+
+        Args:
+            snapshot (dict|bytes|str): snapshot, its (compressed) content or the snapshot file.
+
+        """
+        if not isinstance(snapshot, dict):
+            snapshot = await asyncio.get_running_loop().run_in_executor(None, self._decode_snapshot, snapshot)
+        self._restore_data(snapshot)
+
+    async def ensure_fresh(self, attribute: str, max_age: float):
+        """Update an attribute only when it is older than max_age seconds, and return it.
+
+        Concurrent calls for the same attribute share a single update.
+
+        Args:
+            attribute (str): name of the update, like 'state' or 'operating_data'.
+            max_age (float): maximum age in seconds, data served from a cache is always updated.
+
+        """
+        if not self._is_fresh(attribute, max_age):
+            task = self._refreshing.get(attribute)
+            if task is None:
+                task = asyncio.ensure_future(getattr(self, f"update_{attribute}")())
+                self._refreshing[attribute] = task
+                task.add_done_callback(lambda _: self._refreshing.pop(attribute, None))
+            await asyncio.shield(task)
+        return self._fresh_value(attribute)
 
     async def put_alert_read(self, alert_index: int):
         """Set the alert to read.
@@ -242,7 +424,8 @@ class IndegoAsyncClient(IndegoBaseClient):
             self.update_updates_available(),
             self.update_user(),
         ]
-        results = await asyncio.gather(*update_list, return_exceptions=True)
+        with self._span("update_all"):
+            results = await asyncio.gather(*update_list, return_exceptions=True)
         for res in results:
             if res:
                 _LOGGER.warning(res)
@@ -457,13 +640,14 @@ class IndegoAsyncClient(IndegoBaseClient):
         await self.update_user()
         return self.user
 
-    async def _request(  # noqa: C901
+    async def _request(
         self,
         method: Methods,
         path: str,
         data: dict = None,
         headers: dict = None,
-        timeout: int = 30
+        timeout: int = 30,
+        download_to: str = None,
     ):
         """Request implemented by the subclasses either synchronously or asynchronously.
 
@@ -473,114 +657,131 @@ class IndegoAsyncClient(IndegoBaseClient):
             data (dict, optional): if applicable, data to be sent, defaults to None.
             headers (dict, optional): headers to be included, defaults to None, which should be filled by the method.
             timeout (int, optional): Timeout for the api call. Defaults to 30.
+            download_to (str, optional): stream a successful response to this file instead of returning it, defaults to None.
 
         """
         await self.start()
 
-        url = f"{self._api_url}{path}"
+        ctx = self._create_request_context(method, path, data, headers, timeout, download_to)
+        while True:
+            self._middleware.on_request(self, ctx)
+            if ctx.delay:
+                await asyncio.sleep(ctx.delay)
+                ctx.delay = 0
+            if not ctx.short_circuited:
+                await self._dispatch(ctx)
+            self._middleware.on_response(self, ctx)
+            if not ctx.replay:
+                return self._request_result(ctx)
+            if ctx.extras.pop("refresh_token", False) and not (
+                await self._refresh_token(ctx.extras["stale_token"]) and self._can_replay(ctx)
+            ):
+                return self._request_result(ctx)
+            ctx.next_attempt()
+
+    def set_dispatcher(self, dispatcher: Optional[PriorityDispatcher]):
+        """Send the requests through a priority dispatcher, None removes it.
 
-        if not headers:
-            headers = self._default_headers.copy()
-            headers["Authorization"] = "Bearer %s" % self._token
+        Args:
+            dispatcher (PriorityDispatcher): concurrency limits per request class, can be shared by clients.
 
-        request_id = random_request_id()
-        request_start_time = None
-        try:
-            log_headers = headers.copy()
-            if 'Authorization' in log_headers:
-                log_headers['Authorization'] = '******'
-            _LOGGER.debug(
-                "[%s] %s call to API endpoint %s, headers: %s, data: %s",
-                request_id,
-                method.value,
-                url,
-                json.dumps(log_headers) if log_headers is not None else '',
-                json.dumps(data) if data is not None else '',
-            )
+        """
+        self._dispatcher = dispatcher
 
-            request_start_time = time.time()
-            async with self._session.request(
-                method=method.value,
-                url=url,
-                json=data,
-                headers=headers,
-                timeout=timeout,
-            ) as response:
-                status = response.status
-                _LOGGER.debug("[%s] HTTP status code: %i", request_id, status)
-
-                is_json = response.content_type == CONTENT_TYPE_JSON
-                if status == 200:
-                    if is_json:
-                        resp = await response.json()
-                        _LOGGER.debug("[%s] Response (JSON): %s", request_id, resp)
-                        return resp
-
-                resp = await response.content.read()
-                if len(resp) < 1000:
-                    _LOGGER.debug("[%s] Response (raw): %s", request_id, resp)
-                else:
-                    _LOGGER.debug("[%s] Response (raw): Not logged, exceeds 1000 characters", request_id)
-
-                if status == 200:
-                    return resp
-
-                if self._log_request_result(request_id, status, url):
-                    return {} if is_json else ""
-
-                response.raise_for_status()
-
-        except (asyncio.TimeoutError, ServerTimeoutError, HTTPGatewayTimeout, ClientOSError) as exc:
-            if self._raise_request_exceptions:
-                raise
-            _LOGGER.error(
-                "[%s] %s %s request timed out after %i seconds: %s",
-                request_id,
-                method.value,
-                path,
-                time.time() - request_start_time,
-                str(exc)
-            )
-            return None
+    def set_hedging(self, enabled: bool = True, hedger: Hedger = None) -> Optional[Hedger]:
+        """Send a second GET when the first is slower than the p95 latency of its endpoint.
 
-        except (TooManyRedirects, ClientResponseError, SocketError) as exc:
-            if self._raise_request_exceptions:
-                raise
-            _LOGGER.error(
-                "[%s] %s %s failed after %i seconds: %s",
-                request_id,
-                method.value,
-                path,
-                time.time() - request_start_time,
-                str(exc)
-            )
-            return None
+        Args:
+            enabled (bool, optional): False stops hedging. Defaults to True.
+            hedger (Hedger, optional): quantile, maximum hedge rate and latencies, defaults to Hedger().
 
-        except asyncio.CancelledError:
-            _LOGGER.debug("[%s] Task cancelled by task runner", request_id)
-            return None
+        Returns:
+            Hedger: the hedger with its statistics, None when disabled.
 
-        except Exception as exc:
-            if self._raise_request_exceptions:
-                raise
-            _LOGGER.error(
-                "[%s] Request %s %s gave a unhandled error: %s",
-                request_id,
-                method.value,
-                path,
-                str(exc)
-            )
-            return None
+        """
+        self._hedger = (hedger or Hedger()) if enabled else None
+        return self._hedger
+
+    async def _dispatch(self, ctx: RequestContext):
+        """Send the request, in a slot of the dispatcher when there is one."""
+        if self._dispatcher is None:
+            await self._send_or_hedge(ctx)
+            return
+        async with self._dispatcher.slot(ctx):
+            await self._send_or_hedge(ctx)
 
-    async def get(self, path: str, timeout: int = 30):
+    async def _send_or_hedge(self, ctx: RequestContext):
+        """Send the request, hedged when hedging is enabled and the request is eligible."""
+        if self._hedger is None or not self._hedger.eligible(ctx):
+            await self._send(ctx)
+            return
+        await self._hedger.send(ctx, self._send)
+
+    async def _send(self, ctx: RequestContext):
+        """Send the request with aiohttp and store the outcome in the context."""
+        try:
+            self._log_request(ctx)
+            ctx.mark_sent()
+            async with self._session_for(ctx).request(
+                method=ctx.method.value,
+                url=ctx.url,
+                data=self._encode_json(ctx),
+                headers=ctx.headers,
+                timeout=aiohttp.ClientTimeout(total=ctx.timeout, sock_connect=ctx.connect_timeout),
+            ) as response:
+                ctx.response = response
+                ctx.status = response.status
+                ctx.is_json = response.content_type == CONTENT_TYPE_JSON
+                if ctx.status == 200 and ctx.download_to:
+                    await self._stream_to_file(ctx, response)
+                    self._log_response(ctx)
+                    return
+
+                body = await response.read()
+                ctx.response_size = len(body)
+                if ctx.status == 200 and ctx.is_json:
+                    self._decode_json(ctx, body)
+                    self._log_response(ctx)
+                    return
+
+                self._log_response(ctx, body)
+                if ctx.status == 200:
+                    ctx.result = body
+
+        except (Exception, asyncio.CancelledError) as exc:  # pylint: disable=broad-except
+            ctx.error = exc
+
+        finally:
+            ctx.mark_done()
+
+    async def _stream_to_file(self, ctx: RequestContext, response: aiohttp.ClientResponse):
+        """Stream the response body to ctx.download_to, file operations run in the executor."""
+        loop = asyncio.get_running_loop()
+        writer = await loop.run_in_executor(None, AtomicFileWriter, ctx.download_to)
+        try:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                await loop.run_in_executor(None, writer.write, chunk)
+            await loop.run_in_executor(None, writer.commit)
+        except BaseException:
+            writer.abort()
+            raise
+        ctx.response_size = writer.size
+        ctx.result = MapDownload(
+            ctx.download_to, writer.size, time.monotonic() - ctx.start_time, writer.digest
+        )
+
+    async def get(self, path: str, timeout: int = 30, download_to: str = None):
         """Get implemented by the subclasses either synchronously or asynchronously.
 
         Args:
             path (str): url to call on top of base_url
             timeout (int, optional): Timeout for the api call. Defaults to 30.
+            download_to (str, optional): stream a successful response to this file instead of returning it, defaults to None.
 
         """
-        return await self._request(method=Methods.GET, path=path, timeout=timeout)
+        return await self._request(
+            method=Methods.GET, path=path, timeout=timeout, download_to=download_to
+        )
 
     async def put(self, path: str, data: dict, timeout: int = 30):
         """Put implemented by the subclasses either synchronously or asynchronously.
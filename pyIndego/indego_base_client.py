@@ -1,20 +1,48 @@
 """Base class for indego."""
+import contextlib
+import contextvars
+import functools
+import gzip
 import logging
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Optional, Callable, Awaitable
+from typing import Any, Optional, Callable, Awaitable, Union
 
 import pytz
 
+from .budget import BudgetMiddleware, RequestBudget
+from .circuit_breaker import CircuitBreakers, CircuitOpenError
+from .codec import JsonCodec, get_codec
+from .connection_pools import PoolConfig
 from .const import (
+    CONTENT_TYPE,
+    CONTENT_TYPE_JSON,
     DEFAULT_HEADERS,
     DEFAULT_CALENDAR,
     DEFAULT_LOOKUP_VALUE,
     DEFAULT_URL,
+    ENDPOINT_UPDATES,
     MOWER_STATE_DESCRIPTION,
     MOWER_STATE_DESCRIPTION_DETAIL,
     Methods,
 )
+from .freshness import SOURCE_CACHE, SOURCE_NETWORK, SOURCE_SNAPSHOT, FetchInfo
 from .helpers import convert_bosch_datetime, generate_update
+from .history import History, build_row
+from .map_cache import MapCache
+from .map_download import AtomicFileWriter, MapDownload, file_digest
+from .map_model import MapModel, parse_map
+from .occupancy import OccupancyGrid
+from .metrics import MetricsMiddleware, MetricsRegistry
+from .middleware import AuthMiddleware, Middleware, MiddlewareChain, RequestContext
+from .profiling import ProfileSample
+from .request_log import RequestLog
+from .retry import RetryPolicy
+from .telemetry_log import TelemetryLog
+from .timeouts import AdaptiveTimeoutMiddleware, LatencyTracker, TimeoutPolicy
+from .tracing import Tracer, TracingMiddleware
 from .states import (
     Alert,
     Calendar,
@@ -32,10 +60,53 @@ from .states import (
 
 _LOGGER = logging.getLogger(__name__)
 
+# Context of the last finished request in the current task/thread, used by the update methods.
+_LAST_REQUEST = contextvars.ContextVar("pyindego_last_request", default=None)
+# Source of the data the next update method in the current task/thread gets, None when the request failed.
+_UPDATE_SOURCE = contextvars.ContextVar("pyindego_update_source", default=SOURCE_NETWORK)
+
+# Targets of the _update_* methods in definition order, snapshots are restored in this order.
+UPDATE_TARGETS = []
+SNAPSHOT_VERSION = 1
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def update_target(target: str):
+    """Decorate an _update_* method with the name of the attribute it updates."""
+    UPDATE_TARGETS.append(target)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, new):
+            source = _UPDATE_SOURCE.get()
+            if source != SOURCE_NETWORK:
+                _UPDATE_SOURCE.set(SOURCE_NETWORK)
+            if new is not None and source is not None:
+                self._store_payload(target, new, source)
+            if self._profiler is None:
+                return func(self, new)
+            ctx = _LAST_REQUEST.get()
+            _LAST_REQUEST.set(None)
+            start = time.perf_counter()
+            result = func(self, new)
+            self._profiler(ProfileSample.from_request(target, ctx, time.perf_counter() - start))
+            return result
+
+        return wrapper
+
+    return decorator
+
 
 class IndegoBaseClient(ABC):
     """Indego base client class."""
 
+    # Exception types of the transport, used to map errors the same way in both clients.
+    _timeout_errors = ()
+    _request_errors = ()
+    _cancelled_errors = ()
+    # Only the requests that ran out of time, not the fast connection errors in _timeout_errors.
+    _deadline_errors = ()
+
     def __init__(
         self,
         token: str,
@@ -44,6 +115,8 @@ class IndegoBaseClient(ABC):
         map_filename: str = None,
         api_url: str = DEFAULT_URL,
         raise_request_exceptions: bool = False,
+        json_codec: Union[str, JsonCodec] = None,
+        token_invalidate_method: Optional[Callable[[], Any]] = None,
     ):
         """Abstract class for the Indego Clent, only use the Indego Client or Indego Async Client.
 
@@ -54,10 +127,15 @@ class IndegoBaseClient(ABC):
             map_filename (str, optional): Filename to store maps in. Defaults to None.
             api_url (str, optional): url for the api, defaults to DEFAULT_URL.
             raise_request_exceptions (bool): Should unexpected API request exception be raised or not. Default False to keep things backwards compatible.
+            json_codec (str|JsonCodec, optional): JSON codec ('json', 'orjson' or 'ujson'), defaults to the fastest installed one.
+            token_invalidate_method (callback, optional): Callback method that drops a cached token, called before the refresh after a 401.
         """
+        self._codec = get_codec(json_codec)
         self._default_headers = DEFAULT_HEADERS.copy()
         self._token = token
         self._token_refresh_method = token_refresh_method
+        self._token_invalidate_method = token_invalidate_method
+        self._token_lock = threading.Lock()
         self._serial = serial
         self._mowers_in_account = None
         self.map_filename = map_filename
@@ -67,6 +145,19 @@ class IndegoBaseClient(ABC):
         self._online = False
         self._contextid = ""
         self._userid = None
+        self._metrics = MetricsMiddleware(MetricsRegistry())
+        self._middleware = MiddlewareChain([AuthMiddleware(), self._metrics])
+        self._profiler = None
+        self._tracer = None
+        self._request_log = RequestLog(_LOGGER, codec=self._codec)
+        self._map_cache = None
+        self._map_model = None
+        self._occupancy_grid = None
+        self._history = None
+        self._telemetry_log = None
+        self._payloads = {}
+        self._fetched = {}
+        self._restoring = False
 
         self.alerts = []
         self._alerts_loaded = False
@@ -101,6 +192,31 @@ class IndegoBaseClient(ABC):
         _LOGGER.warning("Serial not yet set, please login first")
         return None
 
+    @property
+    def middlewares(self):
+        """Return the middlewares every request runs through, in request order."""
+        return list(self._middleware)
+
+    @property
+    def metrics_registry(self):
+        """Return the registry the request metrics are recorded in."""
+        return self._metrics.registry
+
+    @property
+    def map_model(self) -> Optional[MapModel]:
+        """Return the last loaded map model, None when no map was loaded yet."""
+        return self._map_model
+
+    @property
+    def occupancy_grid(self) -> Optional[OccupancyGrid]:
+        """Return the occupancy grid when coverage tracking is enabled."""
+        return self._occupancy_grid
+
+    @property
+    def history(self) -> Optional[History]:
+        """Return the recorded history when it is enabled."""
+        return self._history
+
     @property
     def mowers_in_account(self):
         """Return the list of mower detected during login."""
@@ -170,6 +286,26 @@ class IndegoBaseClient(ABC):
     def download_map(self, filename=None):
         """Download the map."""
 
+    @abstractmethod
+    def load_map_model(self):
+        """Load the geometry model of the map file."""
+
+    @abstractmethod
+    def snapshot(self, filename: str = None):
+        """Take a snapshot of the populated attributes."""
+
+    @abstractmethod
+    def restore(self, snapshot):
+        """Restore the attributes from a snapshot."""
+
+    @abstractmethod
+    def set_connection_pools(self, short: PoolConfig = None, longpoll: PoolConfig = None):
+        """Use separate connection pools for the short requests and the longpolls."""
+
+    @abstractmethod
+    def ensure_fresh(self, attribute: str, max_age: float):
+        """Update the attribute when it is older than max_age seconds."""
+
     @abstractmethod
     def put_alert_read(self, alert_index: int):
         """Set to read the read_status of the alert with the specified index."""
@@ -198,6 +334,7 @@ class IndegoBaseClient(ABC):
     def get_alerts(self):
         """Update alerts and return them."""
 
+    @update_target("alerts")
     def _update_alerts(self, new):
         """Update alerts."""
         self._alerts_loaded = True
@@ -218,6 +355,7 @@ class IndegoBaseClient(ABC):
     def get_calendar(self):
         """Update calendar and return it."""
 
+    @update_target("calendar")
     def _update_calendar(self, new):
         """Update calendar."""
         if new:
@@ -231,6 +369,7 @@ class IndegoBaseClient(ABC):
     def get_config(self):
         """Update config and return it."""
 
+    @update_target("config")
     def _update_config(self, new):
         """Update config."""
         if new:
@@ -244,6 +383,7 @@ class IndegoBaseClient(ABC):
     def get_generic_data(self):
         """Update generic_data and return it."""
 
+    @update_target("generic_data")
     def _update_generic_data(self, new):
         """Update generic data."""
         if new:
@@ -258,6 +398,7 @@ class IndegoBaseClient(ABC):
     def get_last_completed_mow(self):
         """Update last_completed_mow and return it."""
 
+    @update_target("last_completed_mow")
     def _update_last_completed_mow(self, new):
         """Update last completed mow."""
         if new:
@@ -271,6 +412,7 @@ class IndegoBaseClient(ABC):
     def get_location(self):
         """Update location and return it."""
 
+    @update_target("location")
     def _update_location(self, new):
         """Update location."""
         if new:
@@ -284,6 +426,7 @@ class IndegoBaseClient(ABC):
     def get_network(self):
         """Update network and return it."""
 
+    @update_target("network")
     def _update_network(self, new):
         """Update network."""
         if new:
@@ -297,6 +440,7 @@ class IndegoBaseClient(ABC):
     def get_next_mow(self):
         """Update next_mow and return it."""
 
+    @update_target("next_mow")
     def _update_next_mow(self, new):
         """Update next mow datetime."""
         if new:
@@ -310,6 +454,7 @@ class IndegoBaseClient(ABC):
     def get_operating_data(self):
         """Update operating_data and return it."""
 
+    @update_target("operating_data")
     def _update_operating_data(self, new):
         """Update operating data."""
         if new:
@@ -317,6 +462,7 @@ class IndegoBaseClient(ABC):
                 self.operating_data, new, OperatingData
             )
             self._update_battery_percentage_adjusted()
+            self._record_history()
 
     @abstractmethod
     def update_predictive_calendar(self):
@@ -326,6 +472,7 @@ class IndegoBaseClient(ABC):
     def get_predictive_calendar(self):
         """Update predictive_calendar and return it."""
 
+    @update_target("predictive_calendar")
     def _update_predictive_calendar(self, new):
         """Update predictive_calendar."""
         if new:
@@ -341,6 +488,7 @@ class IndegoBaseClient(ABC):
     def get_predictive_schedule(self):
         """Update predictive_schedule and return it."""
 
+    @update_target("predictive_schedule")
     def _update_predictive_schedule(self, new):
         """Update predictive schedule."""
         if new:
@@ -356,6 +504,7 @@ class IndegoBaseClient(ABC):
     def get_security(self):
         """Update security and return it."""
 
+    @update_target("security")
     def _update_security(self, new):
         """Update security."""
         if new:
@@ -369,6 +518,7 @@ class IndegoBaseClient(ABC):
     def get_setup(self):
         """Update setup and return it."""
 
+    @update_target("setup")
     def _update_setup(self, new):
         """Update setup."""
         if new:
@@ -382,12 +532,144 @@ class IndegoBaseClient(ABC):
     def get_state(self, force=False, longpoll=False, longpoll_timeout=120):
         """Update state and return it."""
 
+    @update_target("state")
     def _update_state(self, new):
         """Update state."""
         if new:
+            session = self.state.runtime.session.operate if self.state else None
             self.state = generate_update(self.state, new, State)
+            if self._occupancy_grid is not None and not self._restoring:
+                self._record_position(session)
+            self._record_history()
         self._online = new is not None
 
+    def fetch_info(self, attribute: str) -> Optional[FetchInfo]:
+        """Return when and from where an attribute was last updated, None when it was never updated.
+
+        Args:
+            attribute (str): name of the update, like 'state' or 'operating_data' (update_state, update_operating_data).
+
+        """
+        self._check_update_target(attribute)
+        return self._fetched.get(attribute)
+
+    @staticmethod
+    def _check_update_target(attribute: str):
+        """Raise a ValueError for names that do not have an update method."""
+        if attribute not in UPDATE_TARGETS:
+            raise ValueError(f"Unknown attribute '{attribute}', use one of: {', '.join(UPDATE_TARGETS)}")
+
+    def _is_fresh(self, attribute: str, max_age: float) -> bool:
+        """Return True when the attribute was fetched at most max_age seconds ago, data served from a cache is never fresh."""
+        info = self.fetch_info(attribute)
+        return info is not None and info.source != SOURCE_CACHE and info.is_fresh(max_age)
+
+    def _fresh_value(self, attribute: str) -> Any:
+        """Return the value of an updated attribute."""
+        return getattr(self, "update_available" if attribute == "updates_available" else attribute)
+
+    def _store_payload(self, target: str, new: Any, source: str):
+        """Keep the API response of an update with its time and source, state updates are merged like the state itself."""
+        current = self._payloads.get(target)
+        if isinstance(current, dict) and isinstance(new, dict):
+            new = {**current, **new}
+        self._payloads[target] = new
+        self._fetched[target] = FetchInfo(time.time(), source)
+
+    def _snapshot_data(self) -> dict:
+        """Return the API responses of all populated attributes and their fetch times."""
+        return {
+            "version": SNAPSHOT_VERSION,
+            "serial": self._serial,
+            "created": time.time(),
+            "mowers_in_account": self._mowers_in_account,
+            "payloads": dict(self._payloads),
+            "fetched": {target: info.timestamp for target, info in self._fetched.items()},
+        }
+
+    def _restore_data(self, data: dict):
+        """Rebuild the attributes from snapshot data by replaying the API responses through the update methods."""
+        if data.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {data.get('version')}.")
+        if self._serial and data["serial"] and data["serial"] != self._serial:
+            raise ValueError(f"Snapshot of mower {data['serial']} can not be restored for mower {self._serial}.")
+        self._serial = self._serial or data["serial"]
+        self._mowers_in_account = data.get("mowers_in_account")
+        # Error results of older snapshots are not data.
+        payloads = {target: payload for target, payload in data["payloads"].items() if payload not in ({}, "")}
+        # Nothing reached the API, the online state stays as it was.
+        online = self._online
+        self._restoring = True
+        try:
+            for target in UPDATE_TARGETS:
+                if target in payloads:
+                    _UPDATE_SOURCE.set(SOURCE_SNAPSHOT)
+                    getattr(self, f"_update_{target}")(payloads[target])
+        finally:
+            self._restoring = False
+            self._online = online
+        # The data is as old as its fetch in the snapshot, or the snapshot itself.
+        self._fetched.update(
+            {
+                target: FetchInfo(data["fetched"].get(target, data["created"]), SOURCE_SNAPSHOT)
+                for target in payloads
+                if target in UPDATE_TARGETS
+            }
+        )
+        _LOGGER.debug("Restored %s from a snapshot of %s", ", ".join(payloads), data["created"])
+
+    def _encode_snapshot(self, data: dict) -> bytes:
+        """Return the snapshot data as gzip compressed JSON."""
+        return gzip.compress(self._codec.dumps(data))
+
+    def _decode_snapshot(self, snapshot: Union[dict, bytes, str]) -> dict:
+        """Return snapshot data from a dict, (compressed) JSON bytes or a snapshot file."""
+        if isinstance(snapshot, dict):
+            return snapshot
+        if isinstance(snapshot, str):
+            with open(snapshot, "rb") as file:
+                snapshot = file.read()
+        if snapshot[:2] == GZIP_MAGIC:
+            snapshot = gzip.decompress(snapshot)
+        return self._codec.loads(snapshot)
+
+    def _write_snapshot(self, data: dict, filename: str):
+        """Write snapshot data atomically to a file."""
+        writer = AtomicFileWriter(filename)
+        try:
+            writer.write(self._encode_snapshot(data))
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+
+    def _record_history(self):
+        """Add a row with the current state and operating data to the history and telemetry log, not for restored data."""
+        if self._restoring or (self._history is None and self._telemetry_log is None):
+            return
+        row = build_row(time.time(), self.state, self.operating_data)
+        if self._history is not None:
+            self._history.append(row)
+        if self._telemetry_log is not None:
+            self._telemetry_log.append(row)
+            if self._telemetry_log.sync_due:
+                self._sync_telemetry_log(self._telemetry_log)
+
+    def _sync_telemetry_log(self, log: TelemetryLog):
+        """Write the pending rows of the telemetry log to disk."""
+        try:
+            log.sync()
+        except OSError as exc:
+            _LOGGER.warning("Could not write to the telemetry log of %s: %s", self._serial, exc)
+
+    def _record_position(self, previous_session: Optional[int]):
+        """Add the mower position to the occupancy grid, a session runtime that went down starts a new session."""
+        session = self.state.runtime.session.operate
+        if previous_session is not None and session is not None and session < previous_session:
+            self._occupancy_grid.start_session()
+        if self.state.svg_xPos is not None and self.state.svg_yPos is not None:
+            self._occupancy_grid.record(self.state.svg_xPos, self.state.svg_yPos)
+
     @abstractmethod
     def update_updates_available(self):
         """Update updates available."""
@@ -396,6 +678,7 @@ class IndegoBaseClient(ABC):
     def get_updates_available(self):
         """Update updates_available and return it."""
 
+    @update_target("updates_available")
     def _update_updates_available(self, new):
         """Update updates available."""
         if new:
@@ -409,6 +692,7 @@ class IndegoBaseClient(ABC):
     def get_user(self):
         """Update user and return it."""
 
+    @update_target("user")
     def _update_user(self, new):
         """Update users."""
         if new:
@@ -422,9 +706,400 @@ class IndegoBaseClient(ABC):
         data: dict = None,
         headers: dict = None,
         timeout: int = 30,
+        download_to: str = None,
     ):
         """Request implemented by the subclasses either synchronously or asynchronously."""
 
+    def add_middleware(self, middleware: Middleware, index: int = None):
+        """Add a middleware to the request chain.
+
+        Args:
+            middleware (Middleware): middleware to add.
+            index (int, optional): position in the chain, defaults to None which appends it.
+
+        """
+        self._middleware.add(middleware, index)
+
+    def remove_middleware(self, middleware: Middleware):
+        """Remove a middleware from the request chain."""
+        self._middleware.remove(middleware)
+
+    def metrics(self) -> dict:
+        """Return the request metrics per method and endpoint template."""
+        return self._metrics.registry.snapshot()
+
+    def metrics_prometheus(self) -> str:
+        """Return the request metrics in the Prometheus text exposition format."""
+        return self._metrics.registry.to_prometheus()
+
+    def set_metrics_registry(self, registry: MetricsRegistry):
+        """Record the request metrics in another registry, for instance one shared by all clients of a fleet."""
+        self._metrics.registry = registry
+
+    def set_profiler(self, profiler: Optional[Callable[[ProfileSample], None]]):
+        """Set a callback that gets the network, decode and build timings of every update, None disables it.
+
+        Args:
+            profiler (callable): called with a ProfileSample, pyIndego.profiling.ProfileReport can be used.
+
+        """
+        self._profiler = profiler
+
+    def set_tracer(self, tracer: Optional[Tracer]):
+        """Trace update cycles and requests with the tracer, None disables tracing.
+
+        Args:
+            tracer (Tracer): tracer that creates the spans and hands them to its exporter.
+
+        """
+        middleware = self._middleware.find(TracingMiddleware)
+        if middleware is not None:
+            self._middleware.remove(middleware)
+        self._tracer = tracer
+        if tracer is not None:
+            self._middleware.add(TracingMiddleware(tracer), 0)
+
+    def set_request_budget(self, budget: Optional[RequestBudget]):
+        """Take every request from a request budget, None removes it.
+
+        Args:
+            budget (RequestBudget): budget that is shared by the clients of an account.
+
+        """
+        middleware = self._middleware.find(BudgetMiddleware)
+        if middleware is not None:
+            self._middleware.remove(middleware)
+        if budget is not None:
+            self._middleware.add(BudgetMiddleware(budget), 0)
+
+    def set_adaptive_timeouts(
+        self, enabled: bool = True, policy: TimeoutPolicy = None, tracker: LatencyTracker = None
+    ) -> Optional[LatencyTracker]:
+        """Derive the timeouts of requests from the observed latency of their endpoint.
+
+        Args:
+            enabled (bool, optional): False uses the fixed timeouts again. Defaults to True.
+            policy (TimeoutPolicy, optional): percentile, factor, floor, ceiling and connect timeout, defaults to TimeoutPolicy().
+            tracker (LatencyTracker, optional): latencies, pass the same tracker to the clients of a fleet to share them.
+
+        Returns:
+            LatencyTracker: the tracker with the latencies, None when disabled.
+
+        """
+        middleware = self._middleware.find(AdaptiveTimeoutMiddleware)
+        if middleware is not None:
+            self._middleware.remove(middleware)
+        if not enabled:
+            return None
+        middleware = AdaptiveTimeoutMiddleware(policy, tracker)
+        self._middleware.add(middleware)
+        return middleware.tracker
+
+    def set_circuit_breakers(self, breakers: Optional[CircuitBreakers]):
+        """Fail requests fast while their endpoint keeps failing, None removes the breakers.
+
+        Args:
+            breakers (CircuitBreakers): breakers per endpoint template, can be shared by the clients of a fleet.
+
+        """
+        middleware = self._middleware.find(CircuitBreakers)
+        if middleware is not None:
+            self._middleware.remove(middleware)
+        if breakers is not None:
+            self._middleware.add(breakers, 0)
+
+    def set_retry_policy(self, policy: Optional[RetryPolicy]):
+        """Retry GETs that failed with a timeout, connection error or 429/5xx status, None removes the policy.
+
+        Args:
+            policy (RetryPolicy): attempts, delays and deadline, can be shared by the clients of a fleet.
+
+        """
+        middleware = self._middleware.find(RetryPolicy)
+        if middleware is not None:
+            self._middleware.remove(middleware)
+        if policy is not None:
+            self._middleware.add(policy)
+
+    def _new_token(self, token: str):
+        """Store a refreshed token, an empty token keeps the current one."""
+        if token:
+            self._token = token
+
+    def _can_replay(self, ctx: RequestContext) -> bool:
+        """Return True when the token is not the one the API rejected, a replay with that token fails again."""
+        if self._token == ctx.extras["stale_token"]:
+            _LOGGER.error(
+                "[%s] Token refresh gave the rejected token again, the request is not replayed."
+                " A token_invalidate_method can force a new token.",
+                ctx.request_id,
+            )
+            return False
+        return True
+
+    def _cached_payload(self, endpoint: str) -> Any:
+        """Return the last payload of the update of a GET endpoint template, None when there is none."""
+        return self._payloads.get(ENDPOINT_UPDATES.get(endpoint))
+
+    def _span(self, name: str, **attributes):
+        """Return a context manager with a span when tracing is enabled."""
+        if self._tracer is None:
+            return contextlib.nullcontext()
+        return self._tracer.span(name, serial=self._serial, **attributes)
+
+    def set_map_cache(self, cache: Union[MapCache, str, None]):
+        """Keep downloaded maps in a content addressed cache, None disables it.
+
+        With a cache download_map only requests the map when the state reports a map version that is not cached yet.
+
+        Args:
+            cache (MapCache|str): cache or the directory for a new cache, a cache can be shared by several clients.
+
+        """
+        self._map_cache = MapCache(cache) if isinstance(cache, str) else cache
+
+    def _map_version(self) -> Optional[int]:
+        """Return the version of the current map from the state, None when it is unknown or a new map is available."""
+        if self._map_cache is None or self.state is None or self.state.map_update_available:
+            return None
+        return self.state.mapsvgcache_ts
+
+    def _load_cached_map(self, version: int) -> Optional[MapDownload]:
+        """Return the cached map of the version, the map file is only rewritten when its content differs."""
+        digest = self._map_cache.lookup(self._serial, version)
+        if digest is None:
+            return None
+        try:
+            with open(self.map_filename, "rb") as file:
+                current = file_digest(file)
+            if current == digest:
+                _LOGGER.debug("Map version %s of %s is current, not downloading it", version, self._serial)
+                return MapDownload(self.map_filename, os.path.getsize(self.map_filename), 0, digest, cached=True)
+        except FileNotFoundError:
+            pass
+        _LOGGER.debug("Restoring map version %s of %s from the map cache", version, self._serial)
+        return self._map_cache.restore(digest, self.map_filename)
+
+    def _store_map(self, version: Optional[int], lawn_map: MapDownload):
+        """Add a downloaded map to the map cache, when the version is known."""
+        if version is None or lawn_map.digest is None:
+            return
+        try:
+            self._map_cache.store(self._serial, version, lawn_map.filename, lawn_map.digest)
+        except OSError as exc:
+            _LOGGER.warning("Could not store map version %s of %s in the map cache: %s", version, self._serial, exc)
+
+    def _parse_map_model(self) -> MapModel:
+        """Return the model of the map file, it is only parsed again when the map version changed."""
+        version = self.state.mapsvgcache_ts if self.state is not None else None
+        if self._map_model is not None and version is not None and self._map_model.version == version:
+            return self._map_model
+        if not self.map_filename:
+            raise ValueError("No map filename defined.")
+        with open(self.map_filename, "rb") as file:
+            self._map_model = parse_map(file.read(), version)
+        return self._map_model
+
+    def set_history(self, history: Union[History, int, None]):
+        """Record the state and operating data after every update in a history, None disables it.
+
+        Args:
+            history (History|int): history or the capacity (rows) of a new history.
+
+        """
+        self._history = History(history) if isinstance(history, int) else history
+
+    def set_telemetry_log(self, log: Union[TelemetryLog, str, None]):
+        """Append the history rows to a telemetry log on disk, None closes and disables it.
+
+        Args:
+            log (TelemetryLog|str): log or the base directory for a log with the default settings.
+
+        """
+        if isinstance(log, str):
+            if not self._serial:
+                raise ValueError("The telemetry log needs the serial of the mower, pass a serial to the client.")
+            log = TelemetryLog(log, self._serial)
+        if self._telemetry_log is not None and self._telemetry_log is not log:
+            self._telemetry_log.close()
+        self._telemetry_log = log
+
+    def set_coverage_tracking(self, enabled: bool = True, cell_size: float = None) -> Optional[OccupancyGrid]:
+        """Track the mowed cells of the lawn from the positions in the state updates, requires numpy.
+
+        Load the map model first (load_map_model), the grid covers the map and is not kept when tracking is disabled.
+
+        Args:
+            enabled (bool, optional): enable or disable tracking. Defaults to True.
+            cell_size (float, optional): cell size in map coordinates, defaults to map_cell_size of the garden in the operating data.
+
+        Returns:
+            OccupancyGrid: the new grid, None when tracking is disabled.
+
+        """
+        if not enabled:
+            self._occupancy_grid = None
+            return None
+        if self._map_model is None:
+            raise ValueError("No map model loaded, please run load_map_model first.")
+        if cell_size is None and self.operating_data is not None:
+            cell_size = self.operating_data.garden.map_cell_size
+        self._occupancy_grid = OccupancyGrid.from_map_model(self._map_model, cell_size)
+        return self._occupancy_grid
+
+    def render_map(self, radius: float = 8, color: str = None) -> Optional[str]:
+        """Return a lightweight SVG of the loaded map model with the current mower position.
+
+        Args:
+            radius (float, optional): radius of the mower marker. Defaults to 8.
+            color (str, optional): color of the mower marker, defaults to the color of the model.
+
+        Returns:
+            str: the SVG, None when no map model is loaded.
+
+        """
+        if self._map_model is None:
+            return None
+        position = None
+        if self.state is not None and self.state.svg_xPos is not None and self.state.svg_yPos is not None:
+            position = (self.state.svg_xPos, self.state.svg_yPos)
+        if color is None:
+            return self._map_model.render(position, radius)
+        return self._map_model.render(position, radius, color)
+
+    def _decode_json(self, ctx: RequestContext, body: bytes):
+        """Decode a JSON response body into the context, an empty body gives None."""
+        start = time.perf_counter()
+        ctx.result = self._codec.loads(body) if body.strip() else None
+        ctx.decode_time = time.perf_counter() - start
+
+    def _encode_json(self, ctx: RequestContext) -> Optional[bytes]:
+        """Encode the request data as JSON body, also makes sure the content type is set."""
+        if ctx.data is None:
+            return None
+        ctx.headers.setdefault(CONTENT_TYPE, CONTENT_TYPE_JSON)
+        return self._codec.dumps(ctx.data)
+
+    def _create_request_context(
+        self,
+        method: Methods,
+        path: str,
+        data: dict = None,
+        headers: dict = None,
+        timeout: int = 30,
+        download_to: str = None,
+    ) -> RequestContext:
+        """Create the context for a request, headers are only authenticated when not supplied."""
+        return RequestContext(
+            method=method,
+            path=path,
+            url=f"{self._api_url}{path}",
+            data=data,
+            headers=dict(headers) if headers else self._default_headers.copy(),
+            timeout=timeout,
+            authenticate=not headers,
+            download_to=download_to,
+            log=self._request_log.sampled(),
+        )
+
+    def set_request_logging(self, sample_rate: int = 1, max_body: int = 1000, structured: bool = False):
+        """Configure the debug logging of requests, which is only done when DEBUG is enabled for pyIndego.
+
+        Args:
+            sample_rate (int, optional): log 1 in sample_rate requests. Defaults to 1, every request.
+            max_body (int, optional): maximum number of characters of request and response bodies. Defaults to 1000.
+            structured (bool, optional): write one message per request with the details in the 'pyindego_request' record attribute. Defaults to False.
+
+        """
+        self._request_log = RequestLog(_LOGGER, sample_rate, max_body, structured, self._codec)
+
+    def _log_request(self, ctx: RequestContext):
+        """Log the outgoing request when it was sampled."""
+        if ctx.log:
+            self._request_log.request(ctx)
+
+    def _log_response(self, ctx: RequestContext, body: Any = None):
+        """Log the response when the request was sampled."""
+        if ctx.log:
+            self._request_log.response(ctx, body)
+
+    def _request_result(self, ctx: RequestContext):
+        """Return the result of a finished request, map errors and statuses the same way for both clients."""
+        if self._profiler is not None:
+            _LAST_REQUEST.set(ctx)
+        # Also resets the source after a request that was not followed by an update method, like a command.
+        _UPDATE_SOURCE.set(SOURCE_NETWORK)
+        if ctx.short_circuited:
+            if ctx.error is not None:
+                # A middleware failed the request without sending it, for instance an open circuit breaker.
+                return self._request_failed(ctx)
+            # A middleware answered the request, for instance from a cache.
+            _UPDATE_SOURCE.set(SOURCE_CACHE)
+            return ctx.result
+        if ctx.log:
+            self._request_log.finished(ctx)
+
+        if ctx.error is not None:
+            return self._request_failed(ctx)
+
+        if ctx.status == 200:
+            return ctx.result
+
+        if self._log_request_result(ctx.request_id, ctx.status, ctx.url):
+            # Not data of the API, the update method does not record a fetch.
+            _UPDATE_SOURCE.set(None)
+            return {} if ctx.is_json else ""
+
+        if ctx.response is not None:
+            try:
+                ctx.response.raise_for_status()
+            except Exception as exc:  # pylint: disable=broad-except
+                ctx.error = exc
+                return self._request_failed(ctx)
+        return None
+
+    def _request_failed(self, ctx: RequestContext):
+        """Log or raise the exception of a failed request."""
+        exc = ctx.error
+        if isinstance(exc, self._cancelled_errors):
+            _LOGGER.debug("[%s] Task cancelled by task runner", ctx.request_id)
+            return None
+
+        if self._raise_request_exceptions:
+            raise exc
+
+        if isinstance(exc, CircuitOpenError):
+            _LOGGER.debug("[%s] %s %s not sent: %s", ctx.request_id, ctx.method.value, ctx.path, str(exc))
+            return None
+
+        if isinstance(exc, self._timeout_errors):
+            _LOGGER.error(
+                "[%s] %s %s request timed out after %i seconds: %s",
+                ctx.request_id,
+                ctx.method.value,
+                ctx.path,
+                ctx.elapsed or 0,
+                str(exc)
+            )
+        elif isinstance(exc, self._request_errors):
+            _LOGGER.error(
+                "[%s] %s %s failed after %i seconds: %s",
+                ctx.request_id,
+                ctx.method.value,
+                ctx.path,
+                ctx.elapsed or 0,
+                str(exc)
+            )
+        else:
+            _LOGGER.error(
+                "[%s] Request %s %s gave a unhandled error: %s",
+                ctx.request_id,
+                ctx.method.value,
+                ctx.path,
+                str(exc)
+            )
+        return None
+
     def _log_request_result(self, request_id: str, status: int, url: str) -> bool:
         """Log the API request result for certain status codes."""
         """Return False if the status is fatal and should be raised."""
@@ -444,7 +1119,7 @@ class IndegoBaseClient(ABC):
         return False
 
     @abstractmethod
-    def get(self, path: str, timeout: int):
+    def get(self, path: str, timeout: int, download_to: str = None):
         """Get implemented by the subclasses either synchronously or asynchronously."""
 
     @abstractmethod
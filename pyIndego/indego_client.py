@@ -1,7 +1,7 @@
 """API for Bosch API server for Indego lawn mower."""
 import logging
+import time
 import typing
-import json
 
 import requests
 from requests.exceptions import RequestException, Timeout, TooManyRedirects
@@ -13,9 +13,11 @@ from .const import (
     DEFAULT_CALENDAR,
     Methods,
 )
+from .connection_pools import DEFAULT_LONGPOLL_POOL, DEFAULT_SHORT_POOL, PoolConfig
 from .indego_base_client import IndegoBaseClient
+from .map_download import CHUNK_SIZE, AtomicFileWriter, MapDownload
+from .middleware import RequestContext
 from .states import Calendar
-from .helpers import random_request_id
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -23,13 +25,39 @@ _LOGGER = logging.getLogger(__name__)
 class IndegoClient(IndegoBaseClient):
     """Class for Indego Non-Async Client."""
 
+    _timeout_errors = (Timeout,)
+    _request_errors = (TooManyRedirects, RequestException)
+    _deadline_errors = (Timeout,)
+    # Sessions of set_connection_pools, without them every request opens its own connection.
+    _session = None
+    _longpoll_session = None
+
     def __enter__(self):
         """Enter for with."""
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Exit for with."""
-        pass
+        self.close()
+
+    def close(self):
+        """Close the sessions of the connection pools."""
+        for session in (self._session, self._longpoll_session):
+            if session is not None:
+                session.close()
+        self._session = self._longpoll_session = None
+
+    def set_connection_pools(self, short: PoolConfig = None, longpoll: PoolConfig = None):
+        """Keep connections alive in a pool for the short requests and a separate pool for the longpolls.
+
+        Args:
+            short (PoolConfig, optional): pool of the updates and commands, defaults to DEFAULT_SHORT_POOL.
+            longpoll (PoolConfig, optional): pool of the longpolls, defaults to DEFAULT_LONGPOLL_POOL.
+
+        """
+        self.close()
+        self._session = (short or DEFAULT_SHORT_POOL).requests_session()
+        self._longpoll_session = (longpoll or DEFAULT_LONGPOLL_POOL).requests_session()
 
     def get_mowers(self):
         """Get a list of the available mowers (serials) in the account."""
@@ -67,20 +95,83 @@ class IndegoClient(IndegoBaseClient):
     def download_map(self, filename: str = None):
         """Download the map.
 
+        The map is streamed to a temporary file, which replaces the map file when the download is complete.
+        With a map cache (see set_map_cache) the map is only requested when the state reports a new map version.
+
         Args:
             filename (str, optional): Filename for the map. Defaults to None, can also be filled by the filename set in init.
 
+        Returns:
+            MapDownload: filename, size, duration and digest of the download, None when the map was not downloaded.
+
         """
         if not self.serial:
-            return
+            return None
         if filename:
             self.map_filename = filename
         if not self.map_filename:
             raise ValueError("No map filename defined.")
-        lawn_map = self.get(f"alms/{self.serial}/map")
-        if lawn_map:
-            with open(self.map_filename, "wb") as afp:
-                afp.write(lawn_map)
+        version = self._map_version()
+        if version is not None:
+            cached = self._load_cached_map(version)
+            if cached is not None:
+                return cached
+        lawn_map = self.get(f"alms/{self.serial}/map", download_to=self.map_filename)
+        if not isinstance(lawn_map, MapDownload):
+            return None
+        self._map_model = None
+        if self._map_cache is not None:
+            self._store_map(version, lawn_map)
+        return lawn_map
+
+    def load_map_model(self):
+        """Parse the map file into a MapModel.
+
+        The model is kept and only parsed again when the map version (mapsvgcache_ts) of the state changes.
+
+        Returns:
+            MapModel: lawn polygons, dock position and bounding box of the map.
+
+        """
+        return self._parse_map_model()
+
+    def snapshot(self, filename: str = None):
+        """Take a snapshot of the API responses of all populated attributes and their fetch times.
+
+        Args:
+            filename (str, optional): file to write the snapshot to (gzip compressed JSON).
+
+        Returns:
+            dict: the snapshot, can be passed to restore as well.
+
+        """
+        data = self._snapshot_data()
+        if filename:
+            self._write_snapshot(data, filename)
+        return data
+
+    def restore(self, snapshot):
+        """Restore the attributes from a snapshot, without any requests.
+
+        Run update_all afterwards to refresh the restored data.
+
+        Args:
+            snapshot (dict|bytes|str): snapshot, its (compressed) content or the snapshot file.
+
+        """
+        self._restore_data(self._decode_snapshot(snapshot))
+
+    def ensure_fresh(self, attribute: str, max_age: float):
+        """Update an attribute only when it is older than max_age seconds, and return it.
+
+        Args:
+            attribute (str): name of the update, like 'state' or 'operating_data'.
+            max_age (float): maximum age in seconds, data served from a cache is always updated.
+
+        """
+        if not self._is_fresh(attribute, max_age):
+            getattr(self, f"update_{attribute}")()
+        return self._fresh_value(attribute)
 
     def put_alert_read(self, alert_index: int):
         """Set the alert to read.
@@ -166,22 +257,23 @@ class IndegoClient(IndegoBaseClient):
 
     def update_all(self):
         """Update all states."""
-        self.update_alerts()
-        self.update_calendar()
-        self.update_config()
-        self.update_generic_data()
-        self.update_last_completed_mow()
-        self.update_location()
-        self.update_network()
-        self.update_next_mow()
-        self.update_operating_data()
-        self.update_predictive_calendar()
-        self.update_predictive_schedule()
-        self.update_security()
-        self.update_setup()
-        self.update_state()
-        self.update_updates_available()
-        self.update_user()
+        with self._span("update_all"):
+            self.update_alerts()
+            self.update_calendar()
+            self.update_config()
+            self.update_generic_data()
+            self.update_last_completed_mow()
+            self.update_location()
+            self.update_network()
+            self.update_next_mow()
+            self.update_operating_data()
+            self.update_predictive_calendar()
+            self.update_predictive_schedule()
+            self.update_security()
+            self.update_setup()
+            self.update_state()
+            self.update_updates_available()
+            self.update_user()
 
     def update_calendar(self):
         """Update calendar."""
@@ -380,77 +472,118 @@ class IndegoClient(IndegoBaseClient):
         self.update_user()
         return self.user
 
-    def _request(  # noqa: C901
+    def _request(
         self,
         method: Methods,
         path: str,
         data: dict = None,
         headers: dict = None,
         timeout: int = 30,
+        download_to: str = None,
     ):
-        """Send a request and return the response."""
+        """Send a request and return the response, or stream a successful response to the file download_to."""
         if self._token_refresh_method is not None:
-            self.token = self._token_refresh_method()
-
-        url = f"{self._api_url}{path}"
+            self._token = self._token_refresh_method()
+
+        ctx = self._create_request_context(method, path, data, headers, timeout, download_to)
+        while True:
+            self._middleware.on_request(self, ctx)
+            if ctx.delay:
+                time.sleep(ctx.delay)
+                ctx.delay = 0
+            if not ctx.short_circuited:
+                self._send(ctx)
+            self._middleware.on_response(self, ctx)
+            if not ctx.replay:
+                return self._request_result(ctx)
+            if ctx.extras.pop("refresh_token", False) and not (
+                self._refresh_token(ctx.extras["stale_token"]) and self._can_replay(ctx)
+            ):
+                return self._request_result(ctx)
+            ctx.next_attempt()
+
+    def _refresh_token(self, stale: str) -> bool:
+        """Replace a token the API rejected, threads that got a 401 with the same token share a single refresh.
 
-        if not headers:
-            headers = self._default_headers.copy()
-            headers["Authorization"] = "Bearer %s" % self._token
+        Returns:
+            bool: False when the refresh failed.
 
-        request_id = random_request_id()
+        """
+        with self._token_lock:
+            if self._token != stale:
+                # Another thread already refreshed it.
+                return True
+            _LOGGER.debug("Token rejected by the API, refreshing it")
+            try:
+                if self._token_invalidate_method is not None:
+                    self._token_invalidate_method()
+                token = self._token_refresh_method()
+            except Exception as exc:  # pylint: disable=broad-except
+                _LOGGER.error("Refreshing the rejected token failed: %s", exc)
+                return False
+            self._new_token(token)
+            return True
+
+    def _send(self, ctx: RequestContext):
+        """Send the request with requests and store the outcome in the context."""
         try:
-            log_headers = headers.copy()
-            if 'Authorization' in log_headers:
-                log_headers['Authorization'] = '******'
-            _LOGGER.debug(
-                "[%s] %s call to API endpoint %s, headers: %s, data: %s",
-                request_id,
-                method.value,
-                url,
-                json.dumps(log_headers) if log_headers is not None else '',
-                json.dumps(data) if data is not None else '',
+            self._log_request(ctx)
+            ctx.mark_sent()
+            session = self._longpoll_session if ctx.longpoll else self._session
+            response = (session or requests).request(
+                method=ctx.method.value,
+                url=ctx.url,
+                data=self._encode_json(ctx),
+                headers=ctx.headers,
+                timeout=ctx.timeout if ctx.connect_timeout is None else (ctx.connect_timeout, ctx.timeout),
+                stream=ctx.download_to is not None,
             )
+            ctx.response = response
+            ctx.status = response.status_code
+            ctx.is_json = CONTENT_TYPE_JSON in response.headers[CONTENT_TYPE].split(";")
+            if ctx.status == 200 and ctx.download_to:
+                self._stream_to_file(ctx, response)
+                self._log_response(ctx)
+                return
+
+            ctx.response_size = len(response.content)
+            if ctx.status == 200:
+                if ctx.method in (Methods.DELETE, Methods.PATCH, Methods.PUT):
+                    ctx.result = True
+                elif ctx.is_json:
+                    self._decode_json(ctx, response.content)
+                else:
+                    ctx.result = response.content
+            self._log_response(ctx)
+
+        except Exception as exc:  # pylint: disable=broad-except
+            ctx.error = exc
+
+        finally:
+            ctx.mark_done()
+
+    def _stream_to_file(self, ctx: RequestContext, response: requests.Response):
+        """Stream the response body to ctx.download_to."""
+        writer = AtomicFileWriter(ctx.download_to)
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                writer.write(chunk)
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            response.close()
+        ctx.response_size = writer.size
+        ctx.result = MapDownload(
+            ctx.download_to, writer.size, time.monotonic() - ctx.start_time, writer.digest
+        )
 
-            response = requests.request(
-                method=method.value,
-                url=url,
-                json=data,
-                headers=headers,
-                timeout=timeout,
-            )
-            status = response.status_code
-            _LOGGER.debug("[%s] HTTP status code: %i", request_id, status)
-
-            is_json = CONTENT_TYPE_JSON in response.headers[CONTENT_TYPE].split(";")
-            if status == 200:
-                if method in (Methods.DELETE, Methods.PATCH, Methods.PUT):
-                    return True
-                if is_json:
-                    return response.json()
-                return response.content
-
-            if self._log_request_result(request_id, status, url):
-                return {} if is_json else ""
-
-            response.raise_for_status()
-
-        except Timeout as exc:
-            _LOGGER.error("[%s] %s: Timeout on Bosch servers", request_id, str(exc))
-
-        except (TooManyRedirects, RequestException) as exc:
-            _LOGGER.error("[%s] %s: Failed to update Indego status", request_id, str(exc))
-
-        except Exception as exc:
-            if self._raise_request_exceptions:
-                raise
-            _LOGGER.error("[%s] Request to %s gave a unhandled error: %s", request_id, url, exc)
-
-        return None
-
-    def get(self, path: str, timeout: int = 30):
-        """Send a GET request and return the response as a dict."""
-        return self._request(method=Methods.GET, path=path, timeout=timeout)
+    def get(self, path: str, timeout: int = 30, download_to: str = None):
+        """Send a GET request and return the response as a dict, or stream it to the file download_to."""
+        return self._request(
+            method=Methods.GET, path=path, timeout=timeout, download_to=download_to
+        )
 
     def put(self, path: str, data: dict, timeout: int = 30):
         """Send a PUT request and return the response as a dict."""
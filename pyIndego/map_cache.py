@@ -0,0 +1,119 @@
+"""Content addressed cache for the maps of the mowers.
+
+Maps are stored once per SHA-256 digest in objects/<digest>.svg, the index maps
+the serial and map version (mapsvgcache_ts of the state) of a mower to a digest.
+Identical maps of different versions or different mowers are stored only once.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+from typing import Dict, Optional
+
+from .map_download import CHUNK_SIZE, AtomicFileWriter, MapDownload
+
+_LOGGER = logging.getLogger(__name__)
+
+INDEX_FILENAME = "index.json"
+OBJECTS_DIRECTORY = "objects"
+
+
+class MapCache:
+    """Local map store, can be shared by the clients of all mowers."""
+
+    def __init__(self, directory: str):
+        """Initialize the cache, the directory is created when it does not exist.
+
+        Args:
+            directory (str): directory for the index and the maps.
+
+        """
+        self.directory = directory
+        self._objects = os.path.join(directory, OBJECTS_DIRECTORY)
+        os.makedirs(self._objects, exist_ok=True)
+        self._index_filename = os.path.join(directory, INDEX_FILENAME)
+        self._lock = threading.Lock()
+        self._index: Dict[str, Dict[str, str]] = self._load_index()
+
+    def _load_index(self) -> Dict[str, Dict[str, str]]:
+        """Load the index, a missing or broken index gives an empty cache."""
+        try:
+            with open(self._index_filename, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            _LOGGER.warning("Map cache index %s could not be read, starting empty: %s", self._index_filename, exc)
+            return {}
+
+    def _save_index(self):
+        """Write the index atomically."""
+        writer = AtomicFileWriter(self._index_filename)
+        try:
+            writer.write(json.dumps(self._index, sort_keys=True).encode())
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+
+    def object_path(self, digest: str) -> str:
+        """Return the path of the map with the digest."""
+        return os.path.join(self._objects, f"{digest}.svg")
+
+    def lookup(self, serial: str, version: int) -> Optional[str]:
+        """Return the digest of the map of a mower version, None when it is not cached."""
+        with self._lock:
+            digest = self._index.get(serial, {}).get(str(version))
+        if digest and os.path.exists(self.object_path(digest)):
+            return digest
+        return None
+
+    def versions(self, serial: str) -> Dict[str, str]:
+        """Return the cached map versions of a mower with their digests."""
+        with self._lock:
+            return dict(self._index.get(serial, {}))
+
+    def store(self, serial: str, version: int, filename: str, digest: str) -> bool:
+        """Add a downloaded map to the cache.
+
+        Args:
+            serial (str): serial of the mower.
+            version (int): map version, the mapsvgcache_ts of the state.
+            filename (str): file with the downloaded map.
+            digest (str): SHA-256 hex digest of the file.
+
+        Returns:
+            bool: True when the same map was already in the cache (so it is not stored again).
+
+        """
+        path = self.object_path(digest)
+        deduplicated = os.path.exists(path)
+        if not deduplicated:
+            writer = AtomicFileWriter(path)
+            try:
+                with open(filename, "rb") as source:
+                    shutil.copyfileobj(source, writer, CHUNK_SIZE)
+                writer.commit()
+            except BaseException:
+                writer.abort()
+                raise
+        with self._lock:
+            self._index.setdefault(serial, {})[str(version)] = digest
+            self._save_index()
+        _LOGGER.debug(
+            "Map %s of %s version %s %s", digest[:12], serial, version, "deduplicated" if deduplicated else "stored"
+        )
+        return deduplicated
+
+    def restore(self, digest: str, filename: str) -> MapDownload:
+        """Write the cached map with the digest to filename, atomically."""
+        writer = AtomicFileWriter(filename)
+        try:
+            with open(self.object_path(digest), "rb") as source:
+                shutil.copyfileobj(source, writer, CHUNK_SIZE)
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        return MapDownload(filename, writer.size, 0, digest, cached=True)
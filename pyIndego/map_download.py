@@ -0,0 +1,84 @@
+"""Streaming download of the map to a file.
+
+The map is written in chunks to a temporary file next to the target file, which
+replaces the target in one atomic rename when the download is complete. A reader
+of the map file never sees a partially written map.
+"""
+import hashlib
+import logging
+import os
+import secrets
+import stat
+from dataclasses import dataclass
+
+_LOGGER = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Like open(), the kernel applies the current umask to this mode.
+_TEMP_FLAGS = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0)
+
+
+@dataclass
+class MapDownload:
+    """Result of a map download, cached is True when the map came from the map cache."""
+
+    filename: str
+    size: int
+    duration: float
+    digest: str = None
+    cached: bool = False
+
+
+def file_digest(file) -> str:
+    """Return the SHA-256 hex digest of an open binary file."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AtomicFileWriter:
+    """Write a file through a temporary file that replaces the target on commit."""
+
+    def __init__(self, filename: str):
+        """Create the temporary file in the directory of filename."""
+        self.filename = filename
+        self.size = 0
+        self._hash = hashlib.sha256()
+        directory = os.path.dirname(os.path.abspath(filename))
+        while True:
+            self.temp_filename = os.path.join(directory, f".{os.path.basename(filename)}.{secrets.token_hex(4)}.tmp")
+            try:
+                fd = os.open(self.temp_filename, _TEMP_FLAGS, 0o666)
+                break
+            except FileExistsError:
+                continue
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes):
+        """Write a chunk."""
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def digest(self) -> str:
+        """Return the SHA-256 hex digest of the chunks written so far."""
+        return self._hash.hexdigest()
+
+    def commit(self):
+        """Close the temporary file and move it over the target, an existing target keeps its mode."""
+        self._file.close()
+        try:
+            os.chmod(self.temp_filename, stat.S_IMODE(os.stat(self.filename).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(self.temp_filename, self.filename)
+
+    def abort(self):
+        """Close and remove the temporary file, the target is left untouched."""
+        self._file.close()
+        try:
+            os.unlink(self.temp_filename)
+        except OSError as exc:
+            _LOGGER.warning("Could not remove temporary map file %s: %s", self.temp_filename, exc)
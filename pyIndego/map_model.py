@@ -0,0 +1,221 @@
+"""Geometry model of the SVG map of a mower.
+
+The SVG map is parsed once into lawn polygons, the dock position and the bounding
+box. The lawns are rendered into a small SVG that only needs the mower marker
+appended, so drawing the current position does not parse the map again.
+"""
+import logging
+import re
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+_LOGGER = logging.getLogger(__name__)
+
+Point = Tuple[float, float]
+Polygon = Tuple[Point, ...]
+
+SVG_NAMESPACE = "http://www.w3.org/2000/svg"
+DEFAULT_LAWN_COLOR = "#5ca53c"
+DEFAULT_MOWER_COLOR = "#f5a623"
+DEFAULT_DOCK_COLOR = "#333333"
+
+_NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+_PATH_TOKEN = re.compile(r"[MmLlHhVvZzCcSsQqTtAa]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+# Number of parameters of the path commands, curves and arcs are reduced to their end point.
+_PATH_PARAMETERS = {"M": 2, "L": 2, "H": 1, "V": 1, "Z": 0, "C": 6, "S": 4, "Q": 4, "T": 2, "A": 7}
+
+
+def _numbers(value: Optional[str]) -> List[float]:
+    """Return all numbers in an attribute value."""
+    return [float(number) for number in _NUMBER.findall(value or "")]
+
+
+def _points(value: str) -> Polygon:
+    """Parse the points attribute of a polygon or polyline."""
+    numbers = _numbers(value)
+    return tuple(zip(numbers[0::2], numbers[1::2]))
+
+
+def _path_polygons(data: str) -> List[Polygon]:
+    """Parse the subpaths of a path into polygons, curves and arcs become straight lines to their end point."""
+    polygons = []
+    current: List[Point] = []
+    x = y = start_x = start_y = 0.0
+    command = None
+    tokens = _PATH_TOKEN.findall(data or "")
+    index = 0
+    while index < len(tokens):
+        if tokens[index].isalpha():
+            command = tokens[index]
+            index += 1
+            if command in "Zz":
+                if len(current) > 2:
+                    polygons.append(tuple(current))
+                current = []
+                x, y = start_x, start_y
+                continue
+        if command is None:
+            raise ValueError(f"Path data does not start with a command: {data[:20]}")
+        count = _PATH_PARAMETERS[command.upper()]
+        args = [float(arg) for arg in tokens[index:index + count]]
+        if len(args) < count:
+            break
+        index += count
+        relative = command.islower()
+        upper = command.upper()
+        if upper == "H":
+            x = x + args[0] if relative else args[0]
+        elif upper == "V":
+            y = y + args[0] if relative else args[0]
+        else:
+            x, y = (x + args[-2], y + args[-1]) if relative else (args[-2], args[-1])
+        if upper == "M":
+            if len(current) > 2:
+                polygons.append(tuple(current))
+            current = []
+            start_x, start_y = x, y
+            # Coordinates after a move are implicit line commands.
+            command = "l" if relative else "L"
+        current.append((x, y))
+    if len(current) > 2:
+        polygons.append(tuple(current))
+    return polygons
+
+
+def _local_name(tag: str) -> str:
+    """Return the tag without the XML namespace."""
+    return tag.rsplit("}", 1)[-1]
+
+
+def _format(value: float) -> str:
+    """Format a coordinate without trailing zeros."""
+    return f"{value:.2f}".rstrip("0").rstrip(".")
+
+
+@dataclass
+class MapModel:
+    """Lawn polygons, dock position and bounding box of a map, in SVG coordinates."""
+
+    width: float
+    height: float
+    lawns: List[Polygon] = field(default_factory=list)
+    dock: Optional[Point] = None
+    view_box: Tuple[float, float, float, float] = None
+    version: Optional[int] = None
+
+    def __post_init__(self):
+        """Render the static part of the SVG once."""
+        if self.view_box is None:
+            self.view_box = (0.0, 0.0, self.width, self.height)
+        self._svg_head = None
+
+    @property
+    def bounding_box(self) -> Optional[Tuple[float, float, float, float]]:
+        """Return (min x, min y, max x, max y) of the lawns, None when the map has no lawns."""
+        if not self.lawns:
+            return None
+        xs = [x for lawn in self.lawns for x, _ in lawn]
+        ys = [y for lawn in self.lawns for _, y in lawn]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def contains(self, x: float, y: float) -> bool:
+        """Return True when the point is on one of the lawns (even-odd rule per polygon)."""
+        for lawn in self.lawns:
+            inside = False
+            x_prev, y_prev = lawn[-1]
+            for x_cur, y_cur in lawn:
+                if (y_cur > y) != (y_prev > y) and x < (x_prev - x_cur) * (y - y_cur) / (y_prev - y_cur) + x_cur:
+                    inside = not inside
+                x_prev, y_prev = x_cur, y_cur
+            if inside:
+                return True
+        return False
+
+    def _head(self) -> str:
+        """Return the SVG without the mower marker and closing tag, rendered on first use."""
+        if self._svg_head is None:
+            parts = [
+                f'<svg xmlns="{SVG_NAMESPACE}" width="{_format(self.width)}" height="{_format(self.height)}" '
+                f'viewBox="{" ".join(_format(value) for value in self.view_box)}">'
+            ]
+            for lawn in self.lawns:
+                points = " ".join(f"{_format(x)},{_format(y)}" for x, y in lawn)
+                parts.append(f'<polygon points="{points}" fill="{DEFAULT_LAWN_COLOR}"/>')
+            if self.dock is not None:
+                parts.append(
+                    f'<rect x="{_format(self.dock[0] - 6)}" y="{_format(self.dock[1] - 6)}" width="12" height="12" '
+                    f'fill="{DEFAULT_DOCK_COLOR}"/>'
+                )
+            self._svg_head = "".join(parts)
+        return self._svg_head
+
+    def render(self, position: Point = None, radius: float = 8, color: str = DEFAULT_MOWER_COLOR) -> str:
+        """Return a lightweight SVG of the lawns and dock with the mower marker at position.
+
+        Args:
+            position (tuple, optional): svg_xPos and svg_yPos of the mower, no marker when None.
+            radius (float, optional): radius of the marker. Defaults to 8.
+            color (str, optional): fill color of the marker.
+
+        """
+        if position is None:
+            return f"{self._head()}</svg>"
+        return (
+            f'{self._head()}<circle cx="{_format(position[0])}" cy="{_format(position[1])}" '
+            f'r="{_format(radius)}" fill="{color}"/></svg>'
+        )
+
+
+def parse_map(svg: bytes, version: int = None) -> MapModel:
+    """Parse an SVG map into a MapModel.
+
+    Filled polygons, polylines and paths are taken as lawns, an element with 'dock' in its
+    id or class gives the dock position (the centre of a circle or rectangle).
+
+    Args:
+        svg (bytes): content of the map file.
+        version (int, optional): map version (mapsvgcache_ts) the model is built from.
+
+    Raises:
+        ValueError: when the content is not a valid SVG document.
+
+    """
+    try:
+        root = ET.fromstring(svg)
+    except ET.ParseError as exc:
+        raise ValueError(f"Map is not a valid SVG document: {exc}") from exc
+    if _local_name(root.tag) != "svg":
+        raise ValueError(f"Map root element is {_local_name(root.tag)}, expected svg")
+
+    view_box = _numbers(root.get("viewBox"))
+    width = _numbers(root.get("width"))
+    height = _numbers(root.get("height"))
+    model = MapModel(
+        width=width[0] if width else (view_box[2] if len(view_box) == 4 else 0.0),
+        height=height[0] if height else (view_box[3] if len(view_box) == 4 else 0.0),
+        view_box=tuple(view_box) if len(view_box) == 4 else None,
+        version=version,
+    )
+    for element in root.iter():
+        tag = _local_name(element.tag)
+        marker = f"{element.get('id', '')} {element.get('class', '')}".lower()
+        if "dock" in marker:
+            if tag == "circle":
+                model.dock = (float(element.get("cx", 0)), float(element.get("cy", 0)))
+            elif tag == "rect":
+                model.dock = (
+                    float(element.get("x", 0)) + float(element.get("width", 0)) / 2,
+                    float(element.get("y", 0)) + float(element.get("height", 0)) / 2,
+                )
+            continue
+        if element.get("fill", "").lower() == "none":
+            continue
+        if tag in ("polygon", "polyline"):
+            points = _points(element.get("points"))
+            if len(points) > 2:
+                model.lawns.append(points)
+        elif tag == "path":
+            model.lawns.extend(_path_polygons(element.get("d")))
+    _LOGGER.debug("Parsed map version %s: %i lawn polygons, dock %s", version, len(model.lawns), model.dock)
+    return model
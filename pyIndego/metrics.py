@@ -0,0 +1,252 @@
+"""Request metrics for pyIndego.
+
+Every request is recorded per endpoint template (e.g. 'alms/{serial}/state'), so
+metrics of all mowers of a fleet can share a single registry.
+"""
+import bisect
+import logging
+import threading
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+from .middleware import Middleware, RequestContext
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 240)
+DEFAULT_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@dataclass
+class Histogram:
+    """Histogram with fixed upper bounds, the last count holds the values above the highest bound."""
+
+    bounds: Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS
+    counts: List[int] = None
+    sum: float = 0
+    count: int = 0
+
+    def __post_init__(self):
+        """Create the bucket counters."""
+        if self.counts is None:
+            self.counts = [0] * (len(self.bounds) + 1)
+
+    def observe(self, value: float):
+        """Add a value to the histogram."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """Return the (upper bound, cumulative count) pairs, ending with infinity."""
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def quantile(self, quantile: float) -> float:
+        """Return the upper bound of the bucket that contains the quantile, None when empty."""
+        if self.count == 0:
+            return None
+        rank = quantile * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return float("inf")
+
+
+@dataclass
+class EndpointMetrics:
+    """Metrics of a single endpoint template and method."""
+
+    latency: Histogram = field(default_factory=Histogram)
+    response_size: Histogram = field(default_factory=lambda: Histogram(DEFAULT_SIZE_BUCKETS))
+    statuses: Dict[int, int] = field(default_factory=dict)
+    timeouts: int = 0
+    errors: int = 0
+    longpoll_timeouts: int = 0
+    retries: int = 0
+    retries_recovered: int = 0
+    retries_exhausted: int = 0
+
+    def as_dict(self) -> dict:
+        """Return the metrics as a plain dict."""
+        return {
+            "requests": self.latency.count,
+            "latency_sum": self.latency.sum,
+            "latency_p50": self.latency.quantile(0.5),
+            "latency_p95": self.latency.quantile(0.95),
+            "latency_p99": self.latency.quantile(0.99),
+            "latency_buckets": self.latency.cumulative(),
+            "response_bytes": self.response_size.sum,
+            "statuses": dict(self.statuses),
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "longpoll_timeouts": self.longpoll_timeouts,
+            "retries": self.retries,
+            "retries_recovered": self.retries_recovered,
+            "retries_exhausted": self.retries_exhausted,
+        }
+
+
+class MetricsRegistry:
+    """Thread safe collection of request metrics, keyed by (method, endpoint, longpoll)."""
+
+    def __init__(self, latency_buckets: Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS):
+        """Initialize the registry.
+
+        Args:
+            latency_buckets (tuple, optional): upper bounds in seconds of the latency histograms.
+
+        """
+        self._latency_buckets = tuple(latency_buckets)
+        self._endpoints: Dict[Tuple[str, str, bool], EndpointMetrics] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key: Tuple[str, str, bool]) -> EndpointMetrics:
+        """Return the metrics for a key, create them when needed."""
+        metrics = self._endpoints.get(key)
+        if metrics is None:
+            metrics = self._endpoints[key] = EndpointMetrics(
+                latency=Histogram(self._latency_buckets)
+            )
+        return metrics
+
+    def record(self, ctx: RequestContext, timeout: bool = False):
+        """Record the outcome of a sent request."""
+        with self._lock:
+            metrics = self._get((ctx.method.value, ctx.endpoint, ctx.longpoll))
+            if ctx.elapsed is not None:
+                metrics.latency.observe(ctx.elapsed)
+            if ctx.status is not None:
+                metrics.statuses[ctx.status] = metrics.statuses.get(ctx.status, 0) + 1
+                metrics.response_size.observe(ctx.response_size)
+                if ctx.status == 504 and ctx.longpoll:
+                    metrics.longpoll_timeouts += 1
+            if timeout:
+                metrics.timeouts += 1
+            elif ctx.error is not None:
+                metrics.errors += 1
+
+    def record_retry(self, ctx: RequestContext, outcome: str):
+        """Count a retry ('retries'), a request that succeeded after retries ('recovered') or ran out of them ('exhausted')."""
+        attr = "retries" if outcome == "retries" else f"retries_{outcome}"
+        with self._lock:
+            metrics = self._get((ctx.method.value, ctx.endpoint, ctx.longpoll))
+            setattr(metrics, attr, getattr(metrics, attr) + 1)
+
+    def reset(self):
+        """Remove all recorded metrics."""
+        with self._lock:
+            self._endpoints.clear()
+
+    def snapshot(self) -> dict:
+        """Return the metrics as a dict: {method: {endpoint: {...}}}, longpolls get a ' (longpoll)' suffix."""
+        result = {}
+        with self._lock:
+            for (method, endpoint, longpoll), metrics in sorted(self._endpoints.items()):
+                name = f"{endpoint} (longpoll)" if longpoll else endpoint
+                result.setdefault(method, {})[name] = metrics.as_dict()
+        return result
+
+    def to_prometheus(self, prefix: str = "pyindego") -> str:
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def header(name, kind, text):
+            lines.append(f"# HELP {prefix}_{name} {text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        with self._lock:
+            items = sorted(self._endpoints.items())
+            header("request_duration_seconds", "histogram", "Duration of Bosch API requests.")
+            for key, metrics in items:
+                _histogram_lines(lines, f"{prefix}_request_duration_seconds", _labels(key), metrics.latency)
+            header("response_size_bytes", "histogram", "Size of Bosch API response bodies.")
+            for key, metrics in items:
+                _histogram_lines(lines, f"{prefix}_response_size_bytes", _labels(key), metrics.response_size)
+            header("responses_total", "counter", "Bosch API responses by HTTP status code.")
+            for key, metrics in items:
+                for status, count in sorted(metrics.statuses.items()):
+                    lines.append(f'{prefix}_responses_total{{{_labels(key)},status="{status}"}} {count}')
+            for name, attr, text in (
+                ("request_timeouts_total", "timeouts", "Bosch API requests that timed out."),
+                ("request_errors_total", "errors", "Bosch API requests that failed without a response."),
+                ("longpoll_timeouts_total", "longpoll_timeouts", "Longpolls that ended with 504 without updates."),
+                ("request_retries_total", "retries", "Bosch API requests that were retried."),
+                ("request_retries_recovered_total", "retries_recovered", "Retried requests that succeeded."),
+                ("request_retries_exhausted_total", "retries_exhausted", "Retried requests that ran out of attempts."),
+            ):
+                header(name, "counter", text)
+                for key, metrics in items:
+                    lines.append(f"{prefix}_{name}{{{_labels(key)}}} {getattr(metrics, attr)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    """Escape a Prometheus label value."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(key: Tuple[str, str, bool]) -> str:
+    """Return the Prometheus labels for a registry key."""
+    method, endpoint, longpoll = key
+    return f'method="{method}",endpoint="{_escape(endpoint)}",longpoll="{str(longpoll).lower()}"'
+
+
+def _histogram_lines(lines: List[str], name: str, labels: str, histogram: Histogram):
+    """Add the bucket, sum and count lines of a histogram."""
+    for bound, total in histogram.cumulative():
+        upper = "+Inf" if bound == float("inf") else repr(float(bound))
+        lines.append(f'{name}_bucket{{{labels},le="{upper}"}} {total}')
+    lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+
+class MetricsMiddleware(Middleware):
+    """Record every request that was sent to the API in a metrics registry."""
+
+    def __init__(self, registry: MetricsRegistry):
+        """Initialize the middleware."""
+        self.registry = registry
+
+    def on_response(self, client, ctx: RequestContext):
+        """Record the request, short circuited requests are not recorded."""
+        if ctx.short_circuited:
+            return
+        self.registry.record(ctx, timeout=isinstance(ctx.error, client._timeout_errors))
+
+
+def serve_metrics(registry: MetricsRegistry, port: int = 9464, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve the metrics in the Prometheus format from a background thread.
+
+    Args:
+        registry (MetricsRegistry): registry to serve, for instance client.metrics_registry.
+        port (int, optional): port to listen on, defaults to 9464, use 0 for a free port.
+        host (str, optional): address to listen on, defaults to localhost only.
+
+    Returns:
+        ThreadingHTTPServer: the running server, call shutdown() on it to stop serving.
+
+    """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):  # noqa: N802
+            body = registry.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            _LOGGER.debug("Metrics request: " + format, *args)
+
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="pyIndego-metrics", daemon=True).start()
+    _LOGGER.info("Serving metrics on http://%s:%i/metrics", host, server.server_address[1])
+    return server
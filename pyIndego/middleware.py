@@ -0,0 +1,178 @@
+"""Request middleware for pyIndego.
+
+Both the sync and the async client run every API request through the same chain
+of middlewares. A middleware can change the request before it is sent (headers,
+timeout, a delay), answer the request itself (short circuit) or look at the
+outcome and ask the client to send the request again (replay).
+"""
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from .const import Methods
+from .helpers import endpoint_template, random_request_id
+
+_LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class RequestContext:
+    """State of a single API request while it travels through the middleware chain."""
+
+    method: Methods
+    path: str
+    url: str
+    endpoint: str = None
+    data: Any = None
+    headers: Dict[str, str] = None
+    timeout: float = 30
+    connect_timeout: float = None
+    authenticate: bool = True
+    download_to: str = None
+    log: bool = False
+    request_id: str = field(default_factory=random_request_id)
+    attempt: int = 1
+    delay: float = 0
+    start_time: float = None
+    elapsed: float = None
+    status: int = None
+    is_json: bool = False
+    response_size: int = 0
+    decode_time: float = None
+    result: Any = None
+    response: Any = field(default=None, repr=False)
+    error: BaseException = None
+    short_circuited: bool = False
+    replay: bool = False
+    depth: int = 0
+    extras: Dict[str, Any] = field(default_factory=dict, repr=False)
+
+    def __post_init__(self):
+        """Derive the endpoint template from the path."""
+        if self.endpoint is None:
+            self.endpoint = endpoint_template(self.path)
+
+    @property
+    def longpoll(self) -> bool:
+        """Return True for a longpoll request."""
+        return "longpoll=true" in self.path
+
+    def short_circuit(self, result: Any):
+        """Answer the request without calling the API."""
+        self.short_circuited = True
+        self.result = result
+
+    def request_replay(self, delay: float = 0):
+        """Ask the client to send the request again after delay seconds."""
+        self.replay = True
+        self.delay = max(self.delay, delay)
+
+    def mark_sent(self):
+        """Mark the start of the transport call."""
+        self.start_time = time.monotonic()
+
+    def mark_done(self):
+        """Mark the end of the transport call."""
+        if self.start_time is not None:
+            self.elapsed = time.monotonic() - self.start_time
+
+    def copy_outcome(self, other: "RequestContext"):
+        """Take the outcome of another send of the same request, for instance a hedged one."""
+        for name in ("start_time", "elapsed", "status", "is_json", "response_size", "decode_time", "result", "response", "error"):
+            setattr(self, name, getattr(other, name))
+
+    def next_attempt(self):
+        """Reset the outcome of the previous attempt before a replay."""
+        self.attempt += 1
+        self.start_time = None
+        self.elapsed = None
+        self.status = None
+        self.is_json = False
+        self.response_size = 0
+        self.decode_time = None
+        self.result = None
+        self.response = None
+        self.error = None
+        self.short_circuited = False
+        self.replay = False
+        self.depth = 0
+
+
+class Middleware:
+    """Base class for request middlewares, override the hooks that are needed."""
+
+    def on_request(self, client, ctx: RequestContext):
+        """Call before the request is sent, ctx can be changed or short circuited."""
+
+    def on_response(self, client, ctx: RequestContext):
+        """Call after the request was sent (or short circuited), also when it failed."""
+
+
+class AuthMiddleware(Middleware):
+    """Add the OAuth bearer token of the client to authenticated requests, and recover from a rejected token."""
+
+    def on_request(self, client, ctx: RequestContext):
+        """Set the Authorization header."""
+        if ctx.authenticate:
+            ctx.extras["token"] = client._token
+            ctx.headers["Authorization"] = "Bearer %s" % client._token
+
+    def on_response(self, client, ctx: RequestContext):
+        """Ask the client to refresh the token and replay the request after a 401, once per request."""
+        if (
+            ctx.status == 401
+            and ctx.authenticate
+            and client._token_refresh_method is not None
+            and "stale_token" not in ctx.extras
+        ):
+            ctx.extras["stale_token"] = ctx.extras.get("token")
+            ctx.extras["refresh_token"] = True
+            ctx.request_replay()
+
+
+class MiddlewareChain:
+    """Ordered list of middlewares, responses are handled in reverse order."""
+
+    def __init__(self, middlewares: Optional[list] = None):
+        """Initialize the chain."""
+        self._middlewares = list(middlewares or [])
+
+    def __iter__(self):
+        """Iterate over the middlewares in request order."""
+        return iter(self._middlewares)
+
+    def __len__(self):
+        """Return the number of middlewares."""
+        return len(self._middlewares)
+
+    def add(self, middleware: Middleware, index: Optional[int] = None):
+        """Add a middleware at the end of the chain or at the given index."""
+        if index is None:
+            self._middlewares.append(middleware)
+        else:
+            self._middlewares.insert(index, middleware)
+
+    def remove(self, middleware: Middleware):
+        """Remove a middleware from the chain."""
+        self._middlewares.remove(middleware)
+
+    def find(self, middleware_class: type):
+        """Return the first middleware of the given class or None."""
+        for middleware in self._middlewares:
+            if isinstance(middleware, middleware_class):
+                return middleware
+        return None
+
+    def on_request(self, client, ctx: RequestContext):
+        """Run the request hooks until one of them short circuits the request."""
+        for middleware in self._middlewares:
+            ctx.depth += 1
+            middleware.on_request(client, ctx)
+            if ctx.short_circuited:
+                return
+
+    def on_response(self, client, ctx: RequestContext):
+        """Run the response hooks in reverse order, only for middlewares that saw the request."""
+        for middleware in reversed(self._middlewares[: ctx.depth]):
+            middleware.on_response(client, ctx)
@@ -0,0 +1,194 @@
+"""Occupancy grid of the lawn for coverage tracking, requires numpy.
+
+The lawn of the map model is rasterised into cells, the positions of the mower
+(svg_xPos and svg_yPos of the state, in map coordinates) are buffered and added
+to the grid in one vectorised update when the grid is queried.
+"""
+import logging
+import time
+from typing import List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from .map_model import MapModel
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CELL_SIZE = 10
+FLUSH_SIZE = 1024
+
+
+class OccupancyGrid:
+    """Raster of the lawn with the visits and last visit time of every cell."""
+
+    def __init__(
+        self,
+        width: float,
+        height: float,
+        cell_size: float = DEFAULT_CELL_SIZE,
+        origin: Tuple[float, float] = (0.0, 0.0),
+        lawn: "np.ndarray" = None,
+    ):
+        """Initialize an empty grid.
+
+        Args:
+            width (float): width of the area in map coordinates.
+            height (float): height of the area in map coordinates.
+            cell_size (float, optional): size of a (square) cell in map coordinates. Defaults to DEFAULT_CELL_SIZE.
+            origin (tuple, optional): map coordinates of the top left corner. Defaults to (0, 0).
+            lawn (ndarray, optional): boolean mask of the cells that are lawn, defaults to all cells.
+
+        Raises:
+            ImportError: when numpy is not installed.
+            ValueError: when the cell size is not positive.
+
+        """
+        if np is None:
+            raise ImportError("The occupancy grid requires numpy, install pyIndego[numpy].")
+        if cell_size <= 0:
+            raise ValueError("Cell size should be larger than 0.")
+        self.cell_size = float(cell_size)
+        self.origin = (float(origin[0]), float(origin[1]))
+        shape = (max(1, int(np.ceil(height / cell_size))), max(1, int(np.ceil(width / cell_size))))
+        self.lawn = np.ones(shape, dtype=bool) if lawn is None else lawn.astype(bool)
+        if self.lawn.shape != shape:
+            raise ValueError(f"Lawn mask shape {self.lawn.shape} does not match the grid shape {shape}.")
+        self.visits = np.zeros(shape, dtype=np.uint32)
+        self.last_visit = np.zeros(shape, dtype=np.float64)
+        self.session = np.zeros(shape, dtype=bool)
+        self._pending: List[Tuple[float, float, float]] = []
+
+    @classmethod
+    def from_map_model(cls, model: MapModel, cell_size: float = None) -> "OccupancyGrid":
+        """Create a grid over the view box of the map, cells with their centre on a lawn are lawn cells.
+
+        Args:
+            model (MapModel): parsed map.
+            cell_size (float, optional): cell size in map coordinates, Garden.map_cell_size of the operating data. Defaults to DEFAULT_CELL_SIZE.
+
+        """
+        cell_size = float(cell_size or DEFAULT_CELL_SIZE)
+        min_x, min_y, width, height = model.view_box
+        grid = cls(width, height, cell_size, (min_x, min_y))
+        rows, cols = grid.lawn.shape
+        xs = min_x + (np.arange(cols) + 0.5) * cell_size
+        ys = min_y + (np.arange(rows) + 0.5) * cell_size
+        grid_x, grid_y = np.meshgrid(xs, ys)
+        lawn = np.zeros(grid.lawn.shape, dtype=bool)
+        for polygon in model.lawns:
+            lawn |= _inside(grid_x, grid_y, np.asarray(polygon, dtype=np.float64))
+        grid.lawn = lawn
+        _LOGGER.debug("Occupancy grid %s with %i lawn cells of size %s", lawn.shape, int(lawn.sum()), cell_size)
+        return grid
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        """Return the number of rows and columns."""
+        return self.lawn.shape
+
+    def record(self, x: float, y: float, timestamp: float = None):
+        """Buffer a mower position, the buffer is added to the grid when it is full or the grid is queried."""
+        self._pending.append((x, y, time.time() if timestamp is None else timestamp))
+        if len(self._pending) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Add the buffered positions to the grid."""
+        if not self._pending:
+            return
+        positions = np.asarray(self._pending, dtype=np.float64)
+        self._pending = []
+        self.add_positions(positions[:, 0], positions[:, 1], positions[:, 2])
+
+    def add_positions(self, xs, ys, timestamps):
+        """Add arrays of positions (map coordinates) and their timestamps to the grid, positions outside it are ignored."""
+        cols = np.floor((np.asarray(xs, dtype=np.float64) - self.origin[0]) / self.cell_size).astype(np.int64)
+        rows = np.floor((np.asarray(ys, dtype=np.float64) - self.origin[1]) / self.cell_size).astype(np.int64)
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype=np.float64), rows.shape)
+        valid = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        rows, cols, timestamps = rows[valid], cols[valid], timestamps[valid]
+        np.add.at(self.visits, (rows, cols), 1)
+        np.maximum.at(self.last_visit, (rows, cols), timestamps)
+        self.session[rows, cols] = True
+
+    def start_session(self):
+        """Start a new mowing session, the session coverage starts at 0 again."""
+        self.flush()
+        self.session[:] = False
+
+    def _coverage(self, visited: "np.ndarray") -> float:
+        """Return the percentage of lawn cells that are visited."""
+        total = int(self.lawn.sum())
+        if total == 0:
+            return 0.0
+        return 100.0 * int((visited & self.lawn).sum()) / total
+
+    def coverage(self) -> float:
+        """Return the percentage of the lawn cells that were ever visited."""
+        self.flush()
+        return self._coverage(self.visits > 0)
+
+    def session_coverage(self) -> float:
+        """Return the percentage of the lawn cells visited in the current session."""
+        self.flush()
+        return self._coverage(self.session)
+
+    def least_recently_mowed(self, count: int = 5, region_size: int = 4) -> List[dict]:
+        """Return the regions whose lawn was mowed longest ago.
+
+        Args:
+            count (int, optional): number of regions. Defaults to 5.
+            region_size (int, optional): width and height of a region in cells. Defaults to 4.
+
+        Returns:
+            list: dicts with the bounds of the region in map coordinates (x, y, width, height) and last_mowed, the mean
+            last visit time of its lawn cells (0 for cells that were never visited), oldest first.
+
+        """
+        self.flush()
+        rows, cols = self.shape
+        pad_rows, pad_cols = -rows % region_size, -cols % region_size
+        lawn = np.pad(self.lawn, ((0, pad_rows), (0, pad_cols)))
+        last_visit = np.pad(self.last_visit, ((0, pad_rows), (0, pad_cols)))
+        shape = (lawn.shape[0] // region_size, region_size, lawn.shape[1] // region_size, region_size)
+        lawn_cells = lawn.reshape(shape).sum(axis=(1, 3))
+        visit_sum = np.where(lawn, last_visit, 0).reshape(shape).sum(axis=(1, 3))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(lawn_cells > 0, visit_sum / lawn_cells, np.inf)
+        order = np.argsort(mean, axis=None, kind="stable")[: min(count, int((lawn_cells > 0).sum()))]
+        size = region_size * self.cell_size
+        regions = []
+        for region_row, region_col in zip(*np.unravel_index(order, mean.shape)):
+            regions.append(
+                {
+                    "x": self.origin[0] + int(region_col) * size,
+                    "y": self.origin[1] + int(region_row) * size,
+                    "width": size,
+                    "height": size,
+                    "last_mowed": float(mean[region_row, region_col]),
+                }
+            )
+        return regions
+
+    def cell_of(self, x: float, y: float) -> Optional[Tuple[int, int]]:
+        """Return the (row, column) of a position, None when it is outside the grid."""
+        row = int((y - self.origin[1]) // self.cell_size)
+        col = int((x - self.origin[0]) // self.cell_size)
+        if 0 <= row < self.shape[0] and 0 <= col < self.shape[1]:
+            return row, col
+        return None
+
+
+def _inside(xs: "np.ndarray", ys: "np.ndarray", polygon: "np.ndarray") -> "np.ndarray":
+    """Return a mask of the points that are inside the polygon (even-odd rule), vectorised over the points."""
+    inside = np.zeros(xs.shape, dtype=bool)
+    x_prev, y_prev = polygon[-1]
+    for x_cur, y_cur in polygon:
+        if y_cur != y_prev:
+            crosses = (y_cur > ys) != (y_prev > ys)
+            inside ^= crosses & (xs < (x_prev - x_cur) * (ys - y_cur) / (y_prev - y_cur) + x_cur)
+        x_prev, y_prev = x_cur, y_cur
+    return inside
@@ -0,0 +1,248 @@
+"""State-adaptive polling of a mower.
+
+The scheduler picks the interval of every update from the activity of the
+mower: a mowing mower is polled often, a docked, sleeping or offline mower
+rarely. Just before the next scheduled mow the state is polled more often so
+the start is noticed quickly. forceRefresh is never sent to a sleeping or
+offline mower, because it wakes the mower up.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, FrozenSet, List, Optional
+
+from .const import MOWER_STATE_DESCRIPTION
+from .states import State
+
+_LOGGER = logging.getLogger(__name__)
+
+ACTIVITY_ACTIVE = "active"
+ACTIVITY_ATTENTION = "attention"
+ACTIVITY_DOCKED = "docked"
+ACTIVITY_SLEEPING = "sleeping"
+ACTIVITY_OFFLINE = "offline"
+
+STATE_SLEEPING = 64513
+STATE_OFFLINE = 99999
+
+MINUTE = 60
+HOUR = 3600
+
+# Interval in seconds per update and activity, 'default' is used for the activities that are not listed.
+DEFAULT_INTERVALS: Dict[str, Dict[str, float]] = {
+    "state": {
+        ACTIVITY_ACTIVE: 15,
+        ACTIVITY_ATTENTION: 30,
+        ACTIVITY_DOCKED: 2 * MINUTE,
+        ACTIVITY_SLEEPING: 15 * MINUTE,
+        ACTIVITY_OFFLINE: 15 * MINUTE,
+    },
+    "operating_data": {
+        ACTIVITY_ACTIVE: MINUTE,
+        ACTIVITY_ATTENTION: 2 * MINUTE,
+        ACTIVITY_DOCKED: 15 * MINUTE,
+        "default": HOUR,
+    },
+    "alerts": {ACTIVITY_ACTIVE: 5 * MINUTE, ACTIVITY_ATTENTION: MINUTE, "default": 15 * MINUTE},
+    "next_mow": {ACTIVITY_ACTIVE: 15 * MINUTE, "default": 30 * MINUTE},
+    "last_completed_mow": {ACTIVITY_ACTIVE: 15 * MINUTE, "default": HOUR},
+    "predictive_schedule": {"default": HOUR},
+    "calendar": {"default": 6 * HOUR},
+    "predictive_calendar": {"default": 6 * HOUR},
+    "generic_data": {"default": 6 * HOUR},
+    "config": {"default": 12 * HOUR},
+    "location": {"default": 12 * HOUR},
+    "network": {"default": 6 * HOUR},
+    "security": {"default": 12 * HOUR},
+    "setup": {"default": 12 * HOUR},
+    "updates_available": {"default": 12 * HOUR},
+    "user": {"default": 24 * HOUR},
+}
+
+
+def mower_activity(state: Optional[State], online: bool = True) -> str:
+    """Return the activity of a mower from its state code.
+
+    Args:
+        state (State): current state, None when it is not known yet.
+        online (bool, optional): online flag of the client. Defaults to True.
+
+    """
+    if state is None or state.state is None:
+        return ACTIVITY_DOCKED
+    if not online or state.state == STATE_OFFLINE:
+        return ACTIVITY_OFFLINE
+    if state.state == STATE_SLEEPING:
+        return ACTIVITY_SLEEPING
+    category = MOWER_STATE_DESCRIPTION.get(state.state)
+    if category == "Mowing":
+        return ACTIVITY_ACTIVE
+    if category == "Docked":
+        return ACTIVITY_DOCKED
+    return ACTIVITY_ATTENTION
+
+
+@dataclass
+class PollingPolicy:
+    """Intervals of the updates per activity of the mower."""
+
+    intervals: Dict[str, Dict[str, float]] = field(
+        default_factory=lambda: {update: dict(intervals) for update, intervals in DEFAULT_INTERVALS.items()}
+    )
+    pre_mow_window: float = 10 * MINUTE
+    pre_mow_interval: float = 30
+    force_activities: FrozenSet[str] = frozenset()
+
+    def interval(self, update: str, activity: str, next_mow_in: float = None) -> float:
+        """Return the interval of an update.
+
+        Args:
+            update (str): name of the update, like 'state'.
+            activity (str): activity of the mower.
+            next_mow_in (float, optional): seconds until the next scheduled mow.
+
+        """
+        intervals = self.intervals[update]
+        interval = intervals.get(activity, intervals.get("default", HOUR))
+        if (
+            update == "state"
+            and next_mow_in is not None
+            and -self.pre_mow_window <= next_mow_in <= self.pre_mow_window
+            and activity != ACTIVITY_OFFLINE
+        ):
+            interval = min(interval, self.pre_mow_interval)
+        return interval
+
+    def force(self, activity: str) -> bool:
+        """Return True when a state update should use forceRefresh, never for a sleeping or offline mower."""
+        return activity in self.force_activities and activity not in (ACTIVITY_SLEEPING, ACTIVITY_OFFLINE)
+
+
+@dataclass
+class PollRequest:
+    """An update that is due."""
+
+    update: str
+    interval: float
+    kwargs: Dict[str, bool] = field(default_factory=dict)
+
+
+class PollingScheduler:
+    """Run the updates of a client when they are due according to a polling policy."""
+
+    def __init__(self, client, policy: PollingPolicy = None, updates: List[str] = None):
+        """Initialize the scheduler.
+
+        Args:
+            client (IndegoClient|IndegoAsyncClient): client to update.
+            policy (PollingPolicy, optional): intervals, defaults to PollingPolicy().
+            updates (list, optional): names of the updates to run, defaults to all updates of the policy.
+
+        """
+        self.client = client
+        self.policy = policy or PollingPolicy()
+        self.updates = list(updates or self.policy.intervals)
+        self._attempted: Dict[str, float] = {}
+
+    def activity(self) -> str:
+        """Return the current activity of the mower."""
+        return mower_activity(self.client.state, self.client.online)
+
+    def _next_mow_in(self, now: float) -> Optional[float]:
+        """Return the seconds until the next mow, None when it is unknown."""
+        next_mow = self.client.next_mow
+        if not isinstance(next_mow, datetime):
+            return None
+        if next_mow.tzinfo is None:
+            next_mow = next_mow.replace(tzinfo=timezone.utc)
+        return next_mow.timestamp() - now
+
+    def _last_run(self, update: str) -> Optional[float]:
+        """Return the time of the last update or attempt, failed updates are not retried before the interval passed."""
+        info = self.client.fetch_info(update)
+        times = [value for value in (info.timestamp if info else None, self._attempted.get(update)) if value is not None]
+        return max(times) if times else None
+
+    def request(self, update: str, now: float = None) -> PollRequest:
+        """Return the interval and arguments of an update for the current activity of the mower."""
+        now = time.time() if now is None else now
+        activity = self.activity()
+        interval = self.policy.interval(update, activity, self._next_mow_in(now))
+        kwargs = {"force": True} if update == "state" and self.policy.force(activity) else {}
+        return PollRequest(update, interval, kwargs)
+
+    def plan(self, now: float = None) -> List[PollRequest]:
+        """Return the updates that are due."""
+        now = time.time() if now is None else now
+        due = []
+        for update in self.updates:
+            request = self.request(update, now)
+            last = self._last_run(update)
+            if last is None or now - last >= request.interval:
+                due.append(request)
+        return due
+
+    def next_due(self, now: float = None) -> float:
+        """Return the seconds until the next update is due, 0 when one is due now."""
+        now = time.time() if now is None else now
+        activity = self.activity()
+        next_mow_in = self._next_mow_in(now)
+        waits = []
+        for update in self.updates:
+            last = self._last_run(update)
+            if last is None:
+                return 0
+            waits.append(last + self.policy.interval(update, activity, next_mow_in) - now)
+        return max(0, min(waits)) if waits else HOUR
+
+    def _start(self, now: float) -> List[PollRequest]:
+        """Plan the updates and mark them as attempted."""
+        requests = self.plan(now)
+        for request in requests:
+            self._attempted[request.update] = now
+        if requests:
+            _LOGGER.debug(
+                "Polling %s of %s (%s)", ", ".join(request.update for request in requests), self.client.serial, self.activity()
+            )
+        return requests
+
+    def run_pending(self) -> int:
+        """Run the due updates with a sync client, returns the number of updates."""
+        requests = self._start(time.time())
+        if requests:
+            with self.client._span("refresh", activity=self.activity(), updates=len(requests)):  # pylint: disable=protected-access
+                for request in requests:
+                    getattr(self.client, f"update_{request.update}")(**request.kwargs)
+        return len(requests)
+
+    async def async_run_pending(self) -> int:
+        """Run the due updates concurrently with an async client, returns the number of updates."""
+        requests = self._start(time.time())
+        if requests:
+            with self.client._span("refresh", activity=self.activity(), updates=len(requests)):  # pylint: disable=protected-access
+                results = await asyncio.gather(
+                    *[getattr(self.client, f"update_{request.update}")(**request.kwargs) for request in requests],
+                    return_exceptions=True,
+                )
+            for request, result in zip(requests, results):
+                if isinstance(result, Exception):
+                    _LOGGER.warning("Polling %s of %s failed: %s", request.update, self.client.serial, result)
+        return len(requests)
+
+    async def run(self, stop: asyncio.Event = None, max_sleep: float = HOUR):
+        """Poll with an async client until stop is set.
+
+        Args:
+            stop (asyncio.Event, optional): event that ends the loop, runs until cancelled when None.
+            max_sleep (float, optional): maximum seconds between two checks. Defaults to an hour.
+
+        """
+        stop = stop or asyncio.Event()
+        while not stop.is_set():
+            await self.async_run_pending()
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=max(1, min(max_sleep, self.next_due())))
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,130 @@
+"""Profiling of the update methods of pyIndego.
+
+For every update target (state, calendar, operating_data, ...) the time is split in
+the network part (HTTP request and reading the body), decoding the JSON and building
+the state classes. Set a profiler with client.set_profiler(callback), the callback is
+called with a ProfileSample after each update, ProfileReport can be used as callback.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict
+
+from .middleware import RequestContext
+
+_LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class ProfileSample:
+    """Timings in seconds of a single update."""
+
+    target: str
+    network: float = 0
+    decode: float = 0
+    build: float = 0
+    request_id: str = None
+    endpoint: str = None
+    timestamp: float = field(default_factory=time.time)
+
+    @property
+    def total(self) -> float:
+        """Return the total time of the update."""
+        return self.network + self.decode + self.build
+
+    @classmethod
+    def from_request(cls, target: str, ctx: RequestContext, build: float):
+        """Create a sample from the context of the request the update used, ctx can be None."""
+        if ctx is None:
+            return cls(target=target, build=build)
+        decode = ctx.decode_time or 0
+        return cls(
+            target=target,
+            network=max((ctx.elapsed or 0) - decode, 0),
+            decode=decode,
+            build=build,
+            request_id=ctx.request_id,
+            endpoint=ctx.endpoint,
+        )
+
+
+@dataclass
+class PhaseStats:
+    """Aggregated timings of one update target."""
+
+    count: int = 0
+    network: float = 0
+    decode: float = 0
+    build: float = 0
+    max_total: float = 0
+
+    @property
+    def total(self) -> float:
+        """Return the summed time of all phases."""
+        return self.network + self.decode + self.build
+
+    def add(self, sample: ProfileSample):
+        """Add a sample to the stats."""
+        self.count += 1
+        self.network += sample.network
+        self.decode += sample.decode
+        self.build += sample.build
+        self.max_total = max(self.max_total, sample.total)
+
+
+class ProfileReport:
+    """Profiler callback that aggregates the samples per update target.
+
+    Example:
+        report = ProfileReport()
+        client.set_profiler(report)
+        client.update_all()
+        print(report.format())
+
+    """
+
+    def __init__(self):
+        """Initialize the report."""
+        self._stats: Dict[str, PhaseStats] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, sample: ProfileSample):
+        """Add a sample, makes the report usable as profiler."""
+        with self._lock:
+            self._stats.setdefault(sample.target, PhaseStats()).add(sample)
+
+    def reset(self):
+        """Remove all samples."""
+        with self._lock:
+            self._stats.clear()
+
+    def summary(self) -> Dict[str, dict]:
+        """Return the totals and means in seconds per update target, slowest target first."""
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda item: item[1].total, reverse=True)
+            return {
+                target: {
+                    "count": stats.count,
+                    "network": stats.network,
+                    "decode": stats.decode,
+                    "build": stats.build,
+                    "total": stats.total,
+                    "mean": stats.total / stats.count,
+                    "max": stats.max_total,
+                }
+                for target, stats in items
+            }
+
+    def format(self) -> str:
+        """Return the summary as a table with milliseconds."""
+        lines = [
+            f"{'target':<22}{'count':>7}{'network':>11}{'decode':>10}{'build':>10}{'mean':>10}{'max':>10}"
+        ]
+        for target, stats in self.summary().items():
+            lines.append(
+                f"{target:<22}{stats['count']:>7}"
+                f"{stats['network'] * 1000:>11.2f}{stats['decode'] * 1000:>10.2f}{stats['build'] * 1000:>10.2f}"
+                f"{stats['mean'] * 1000:>10.2f}{stats['max'] * 1000:>10.2f}"
+            )
+        return "\n".join(lines)
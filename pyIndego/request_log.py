@@ -0,0 +1,124 @@
+"""Debug logging of API requests.
+
+Nothing is copied or serialized unless the logger is enabled for DEBUG and the
+request is sampled, so logging costs next to nothing when it is off.
+"""
+import itertools
+import json
+import logging
+from typing import Any
+
+from .codec import JsonCodec
+from .middleware import RequestContext
+
+MASKED_HEADERS = ("Authorization",)
+
+
+def truncate(value: Any, max_length: int, codec: JsonCodec = None) -> str:
+    """Return the value as string (JSON for objects), cut off at max_length characters."""
+    if isinstance(value, (bytes, bytearray)):
+        text = bytes(value[: max_length + 1]).decode(errors="replace")
+    elif isinstance(value, str):
+        text = value
+    else:
+        try:
+            text = (codec or JsonCodec()).dumps(value).decode()
+        except TypeError:
+            text = json.dumps(value, default=str)
+    if len(text) > max_length:
+        return f"{text[:max_length]}... (truncated)"
+    return text
+
+
+class RequestLog:
+    """Decide which requests are logged and write their debug messages."""
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        sample_rate: int = 1,
+        max_body: int = 1000,
+        structured: bool = False,
+        codec: JsonCodec = None,
+    ):
+        """Initialize the request log.
+
+        Args:
+            logger (Logger): logger to write to, only used when it is enabled for DEBUG.
+            sample_rate (int, optional): log 1 in sample_rate requests. Defaults to 1, every request.
+            max_body (int, optional): maximum number of characters of request and response bodies. Defaults to 1000.
+            structured (bool, optional): write one message per request with the details as record attribute 'pyindego_request'. Defaults to False.
+            codec (JsonCodec, optional): codec to serialize bodies with. Defaults to the standard library codec.
+
+        """
+        if sample_rate < 1:
+            raise ValueError("Sample rate should be 1 or higher.")
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.max_body = max_body
+        self.structured = structured
+        self.codec = codec or JsonCodec()
+        self._counter = itertools.count()
+
+    def sampled(self) -> bool:
+        """Return True if the next request should be logged."""
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return False
+        return self.sample_rate == 1 or next(self._counter) % self.sample_rate == 0
+
+    @staticmethod
+    def _masked_headers(ctx: RequestContext) -> dict:
+        """Return the request headers without secrets."""
+        return {key: "******" if key in MASKED_HEADERS else value for key, value in ctx.headers.items()}
+
+    def request(self, ctx: RequestContext):
+        """Log the outgoing request."""
+        if self.structured:
+            return
+        self.logger.debug(
+            "[%s] %s call to API endpoint %s, headers: %s, data: %s",
+            ctx.request_id,
+            ctx.method.value,
+            ctx.url,
+            self.codec.dumps(self._masked_headers(ctx)).decode(),
+            truncate(ctx.data, self.max_body, self.codec) if ctx.data is not None else "",
+        )
+
+    def response(self, ctx: RequestContext, body: Any = None):
+        """Log the status and body of the response."""
+        if self.structured:
+            return
+        self.logger.debug("[%s] HTTP status code: %i", ctx.request_id, ctx.status)
+        if ctx.status == 200 and ctx.is_json:
+            self.logger.debug("[%s] Response (JSON): %s", ctx.request_id, truncate(ctx.result, self.max_body, self.codec))
+        elif body is not None:
+            self.logger.debug("[%s] Response (raw): %s", ctx.request_id, truncate(body, self.max_body))
+
+    def finished(self, ctx: RequestContext):
+        """Log a single message with all details of the request, in structured mode only."""
+        if not self.structured:
+            return
+        details = {
+            "request_id": ctx.request_id,
+            "method": ctx.method.value,
+            "endpoint": ctx.endpoint,
+            "url": ctx.url,
+            "attempt": ctx.attempt,
+            "headers": self._masked_headers(ctx),
+            "data": truncate(ctx.data, self.max_body, self.codec) if ctx.data is not None else None,
+            "status": ctx.status,
+            "elapsed": ctx.elapsed,
+            "response_size": ctx.response_size,
+            "error": repr(ctx.error) if ctx.error is not None else None,
+        }
+        if ctx.status == 200 and ctx.result is not None:
+            details["response"] = truncate(ctx.result, self.max_body, self.codec)
+        self.logger.debug(
+            "[%s] %s %s: %s in %.3f s",
+            ctx.request_id,
+            ctx.method.value,
+            ctx.endpoint,
+            ctx.status if ctx.error is None else type(ctx.error).__name__,
+            ctx.elapsed or 0,
+            extra={"pyindego_request": details},
+        )
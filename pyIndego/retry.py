@@ -0,0 +1,109 @@
+"""Retries of failed GET requests.
+
+Only GETs are retried, they read data and can be sent again without side
+effects. Commands (PUT, DELETE) are never retried, a replayed command could
+start the mower minutes after it was asked. Longpolls are not retried either,
+the next longpoll follows anyway. The delay between attempts uses decorrelated
+jitter: a random delay between the base delay and three times the previous
+delay, capped at max_delay. No retry is started that would end after the
+deadline, counted from the start of the first attempt.
+"""
+import logging
+import random
+import threading
+import time
+from typing import Dict, Tuple
+
+from .const import Methods
+from .middleware import Middleware, RequestContext
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 10.0
+DEFAULT_DEADLINE = 30.0
+DEFAULT_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RetryPolicy(Middleware):
+    """Replay GETs that failed with a transient error, as request middleware."""
+
+    def __init__(
+        self,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        base_delay: float = DEFAULT_BASE_DELAY,
+        max_delay: float = DEFAULT_MAX_DELAY,
+        deadline: float = DEFAULT_DEADLINE,
+        retry_statuses: Tuple[int, ...] = DEFAULT_RETRY_STATUSES,
+    ):
+        """Initialize the policy.
+
+        Args:
+            max_attempts (int, optional): attempts including the first one. Defaults to 3.
+            base_delay (float, optional): minimum seconds between attempts. Defaults to 0.5.
+            max_delay (float, optional): maximum seconds between attempts. Defaults to 10.
+            deadline (float, optional): seconds from the first attempt after which no retry ends. Defaults to 30.
+            retry_statuses (tuple, optional): HTTP statuses that are retried. Defaults to 429 and 5xx except 501.
+
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_statuses = frozenset(retry_statuses)
+        self._counts: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, client, ctx: RequestContext, name: str):
+        """Add one to a retry counter of the endpoint, also in the request metrics of the client."""
+        with self._lock:
+            counts = self._counts.setdefault(ctx.endpoint, {"retries": 0, "recovered": 0, "exhausted": 0})
+            counts[name] += 1
+        client.metrics_registry.record_retry(ctx, name)
+
+    def stats(self) -> dict:
+        """Return the retries, the requests that succeeded after a retry and the ones that ran out of attempts, per endpoint."""
+        with self._lock:
+            return {endpoint: dict(counts) for endpoint, counts in self._counts.items()}
+
+    def next_delay(self, previous: float) -> float:
+        """Return the delay before the next attempt, with decorrelated jitter."""
+        return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous * 3)))
+
+    def _transient(self, client, ctx: RequestContext) -> bool:
+        """Return True when the attempt failed in a way that can pass."""
+        if ctx.error is not None:
+            return isinstance(ctx.error, client._timeout_errors + client._request_errors)  # pylint: disable=protected-access
+        return ctx.status in self.retry_statuses
+
+    def on_request(self, client, ctx: RequestContext):
+        """Remember the start of the first attempt."""
+        ctx.extras.setdefault("retry_start", time.monotonic())
+
+    def on_response(self, client, ctx: RequestContext):
+        """Ask for a replay of a GET that failed with a transient error."""
+        if ctx.method != Methods.GET or ctx.longpoll or ctx.short_circuited:
+            return
+        if not self._transient(client, ctx):
+            if ctx.attempt > 1 and ctx.status == 200:
+                self._count(client, ctx, "recovered")
+            return
+        delay = self.next_delay(ctx.extras.get("retry_delay", self.base_delay))
+        elapsed = time.monotonic() - ctx.extras["retry_start"]
+        # elapsed already includes the attempt that just failed.
+        if ctx.attempt >= self.max_attempts or elapsed + delay > self.deadline:
+            if ctx.attempt > 1:
+                self._count(client, ctx, "exhausted")
+            return
+        ctx.extras["retry_delay"] = delay
+        self._count(client, ctx, "retries")
+        _LOGGER.debug(
+            "[%s] Attempt %i of %s failed (%s), retrying in %.1f seconds",
+            ctx.request_id,
+            ctx.attempt,
+            ctx.path,
+            ctx.error or ctx.status,
+            delay,
+        )
+        ctx.request_replay(delay)
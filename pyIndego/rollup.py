@@ -0,0 +1,280 @@
+"""Hourly and daily rollups of the history of a mower.
+
+The engine reads history rows in time order and adds them to hourly rollups:
+the time spent per state category (MOWER_STATE_DESCRIPTION), battery minimum,
+maximum and mean, the mowed progress and the runtime deltas. Daily rollups are
+merged from the hourly ones. compact() rolls up the rows of a history or
+telemetry log and then drops the raw rows that are older than the retention.
+Hours and days are in UTC.
+"""
+import logging
+import math
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, List, Optional
+
+from .codec import JsonCodec
+from .const import DEFAULT_LOOKUP_VALUE, MOWER_STATE_DESCRIPTION
+from .history import COLUMNS, History
+from .map_download import AtomicFileWriter
+from .telemetry_log import TelemetryReader, remove_segments_before
+
+_LOGGER = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 86400
+DEFAULT_MAX_GAP = HOUR
+DEFAULT_RETENTION = 7 * DAY
+DEFAULT_HOURLY_RETENTION = 90 * DAY
+
+
+def _number(value) -> Optional[float]:
+    """Return the value as float, None for missing values (NaN)."""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return float(value)
+
+
+@dataclass
+class Rollup:
+    """Aggregates of the history of one period."""
+
+    start: float
+    period: int
+    samples: int = 0
+    state_time: Dict[str, float] = field(default_factory=dict)
+    battery_min: Optional[float] = None
+    battery_max: Optional[float] = None
+    battery_sum: float = 0.0
+    battery_count: int = 0
+    mowed_first: Optional[float] = None
+    mowed_last: Optional[float] = None
+    runtime_operate: float = 0.0
+    runtime_charge: float = 0.0
+
+    @property
+    def battery_mean(self) -> Optional[float]:
+        """Return the mean battery percentage."""
+        if not self.battery_count:
+            return None
+        return self.battery_sum / self.battery_count
+
+    def add_battery(self, value: float):
+        """Add a battery percentage."""
+        self.battery_min = value if self.battery_min is None else min(self.battery_min, value)
+        self.battery_max = value if self.battery_max is None else max(self.battery_max, value)
+        self.battery_sum += value
+        self.battery_count += 1
+
+    def add_mowed(self, value: float):
+        """Add a mowed percentage."""
+        if self.mowed_first is None:
+            self.mowed_first = value
+        self.mowed_last = value
+
+    def add_state_time(self, category: str, seconds: float):
+        """Add time spent in a state category."""
+        self.state_time[category] = self.state_time.get(category, 0.0) + seconds
+
+    def merge(self, other: "Rollup"):
+        """Add a later rollup of a shorter period, used to build daily from hourly rollups."""
+        self.samples += other.samples
+        for category, seconds in other.state_time.items():
+            self.add_state_time(category, seconds)
+        if other.battery_count:
+            self.battery_min = other.battery_min if self.battery_min is None else min(self.battery_min, other.battery_min)
+            self.battery_max = other.battery_max if self.battery_max is None else max(self.battery_max, other.battery_max)
+            self.battery_sum += other.battery_sum
+            self.battery_count += other.battery_count
+        if other.mowed_first is not None:
+            if self.mowed_first is None:
+                self.mowed_first = other.mowed_first
+            self.mowed_last = other.mowed_last
+        self.runtime_operate += other.runtime_operate
+        self.runtime_charge += other.runtime_charge
+
+    def as_dict(self) -> dict:
+        """Return the rollup as dict, with the battery mean."""
+        result = asdict(self)
+        result["battery_mean"] = self.battery_mean
+        return result
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Rollup":
+        """Create a rollup from as_dict output."""
+        data = dict(data)
+        data.pop("battery_mean", None)
+        return cls(**data)
+
+
+class RollupEngine:
+    """Roll up history rows into hourly and daily rollups."""
+
+    def __init__(self, max_gap: float = DEFAULT_MAX_GAP, hourly_retention: float = DEFAULT_HOURLY_RETENTION):
+        """Initialize an empty engine.
+
+        Args:
+            max_gap (float, optional): longer gaps between rows (mower or client offline) do not count as state time. Defaults to an hour.
+            hourly_retention (float, optional): hourly rollups older than this are dropped on compaction, daily rollups are kept. Defaults to 90 days.
+
+        """
+        self.max_gap = max_gap
+        self.hourly_retention = hourly_retention
+        self.hourly: Dict[int, Rollup] = {}
+        self.daily: Dict[int, Rollup] = {}
+        self._last: Optional[dict] = None
+
+    @property
+    def last_timestamp(self) -> Optional[float]:
+        """Return the timestamp of the last row that was rolled up."""
+        return self._last["timestamp"] if self._last else None
+
+    def _hour(self, timestamp: float) -> Rollup:
+        """Return the hourly rollup of a timestamp."""
+        start = int(timestamp // HOUR * HOUR)
+        rollup = self.hourly.get(start)
+        if rollup is None:
+            rollup = self.hourly[start] = Rollup(start, HOUR)
+        return rollup
+
+    def _add_interval(self, start: float, end: float, state: Optional[float]):
+        """Add the time between two rows to the state category of the first row, split over the hours."""
+        if state is None or end - start > self.max_gap:
+            return
+        category = MOWER_STATE_DESCRIPTION.get(int(state), DEFAULT_LOOKUP_VALUE)
+        while start < end:
+            boundary = min(end, (start // HOUR + 1) * HOUR)
+            self._hour(start).add_state_time(category, boundary - start)
+            start = boundary
+
+    def add(self, row: dict):
+        """Add a history row, rows that are not newer than the last row are skipped."""
+        timestamp = float(row["timestamp"])
+        if self._last is not None and timestamp <= self._last["timestamp"]:
+            return
+        rollup = self._hour(timestamp)
+        rollup.samples += 1
+        battery = _number(row["battery_percent"])
+        if battery is not None:
+            rollup.add_battery(battery)
+        mowed = _number(row["mowed"])
+        if mowed is not None:
+            rollup.add_mowed(mowed)
+        previous = self._last
+        if previous is not None:
+            state = previous["state"]
+            self._add_interval(previous["timestamp"], timestamp, None if state == -1 else state)
+            for name in ("operate", "charge"):
+                before, after = _number(previous[f"runtime_{name}"]), _number(row[f"runtime_{name}"])
+                # A lower runtime means the counters were reset, that is not a negative runtime.
+                if before is not None and after is not None and after >= before:
+                    setattr(rollup, f"runtime_{name}", getattr(rollup, f"runtime_{name}") + after - before)
+        self._last = {name: float(row[name]) if code == "d" else int(row[name]) for name, code in COLUMNS}
+
+    def add_rows(self, rows: Iterable) -> int:
+        """Add history rows (dicts or numpy records) in time order, returns the number of rows added."""
+        count = 0
+        for row in rows:
+            if self._last is not None and row["timestamp"] <= self._last["timestamp"]:
+                continue
+            self.add(row)
+            count += 1
+        return count
+
+    def _rebuild_days(self, starts: Iterable[int]):
+        """Merge the hourly rollups of the days of the hours into daily rollups."""
+        for day in sorted({start // DAY * DAY for start in starts}):
+            daily = Rollup(day, DAY)
+            for hour in range(day, day + DAY, HOUR):
+                if hour in self.hourly:
+                    daily.merge(self.hourly[hour])
+            if daily.samples or daily.state_time:
+                self.daily[day] = daily
+
+    def compact(self, history: History, retention: float = DEFAULT_RETENTION, now: float = None) -> int:
+        """Roll up the new rows of a history and drop the raw rows that are older than the retention.
+
+        Args:
+            history (History): history of a client.
+            retention (float, optional): seconds to keep the raw rows. Defaults to 7 days.
+            now (float, optional): current time, defaults to time.time().
+
+        Returns:
+            int: number of raw rows that were dropped.
+
+        """
+        now = time.time() if now is None else now
+        self._roll_up(history.range(self.last_timestamp))
+        return history.drop_before(min(now - retention, self.last_timestamp or 0))
+
+    def compact_telemetry(
+        self, directory: str, serial: str, retention: float = DEFAULT_RETENTION, now: float = None
+    ) -> int:
+        """Roll up the new records of a telemetry log and remove the segments that are older than the retention.
+
+        Returns:
+            int: number of segment files that were removed.
+
+        """
+        now = time.time() if now is None else now
+        with TelemetryReader(directory, serial) as reader:
+            self._roll_up(row for segment in reader.segments(self.last_timestamp) for row in segment)
+        return remove_segments_before(directory, serial, min(now - retention, self.last_timestamp or 0))
+
+    def _roll_up(self, rows: Iterable):
+        """Add rows, rebuild the affected days and apply the hourly retention."""
+        changed_from = self.last_timestamp
+        if not self.add_rows(rows):
+            return
+        # Rows are added in time order, so only the hour of the previous last row and later hours changed.
+        first_hour = None if changed_from is None else changed_from // HOUR * HOUR
+        self._rebuild_days(start for start in self.hourly if first_hour is None or start >= first_hour)
+        cutoff = self.last_timestamp - self.hourly_retention
+        for start in [start for start in self.hourly if start + HOUR <= cutoff]:
+            del self.hourly[start]
+
+    def query(self, resolution: str = "daily", start: float = None, end: float = None) -> List[Rollup]:
+        """Return the rollups of the periods that overlap start to end, oldest first.
+
+        Args:
+            resolution (str, optional): 'hourly' or 'daily'. Defaults to 'daily'.
+            start (float, optional): start timestamp, defaults to the first rollup.
+            end (float, optional): end timestamp, defaults to the last rollup.
+
+        """
+        if resolution not in ("hourly", "daily"):
+            raise ValueError(f"Unknown resolution '{resolution}', use 'hourly' or 'daily'.")
+        rollups = self.hourly if resolution == "hourly" else self.daily
+        return [
+            rollups[key]
+            for key in sorted(rollups)
+            if (start is None or key + rollups[key].period > start) and (end is None or key <= end)
+        ]
+
+    def save(self, filename: str, codec: JsonCodec = None):
+        """Write the rollups and the last row to a JSON file, atomically."""
+        codec = codec or JsonCodec()
+        data = {
+            "last": self._last,
+            "hourly": [rollup.as_dict() for rollup in self.hourly.values()],
+            "daily": [rollup.as_dict() for rollup in self.daily.values()],
+        }
+        writer = AtomicFileWriter(filename)
+        try:
+            writer.write(codec.dumps(data))
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+
+    @classmethod
+    def load(cls, filename: str, codec: JsonCodec = None, **kwargs) -> "RollupEngine":
+        """Create an engine from a file written by save."""
+        codec = codec or JsonCodec()
+        with open(filename, "rb") as file:
+            data = codec.loads(file.read())
+        engine = cls(**kwargs)
+        engine._last = data["last"]
+        engine.hourly = {int(item["start"]): Rollup.from_dict(item) for item in data["hourly"]}
+        engine.daily = {int(item["start"]): Rollup.from_dict(item) for item in data["daily"]}
+        return engine
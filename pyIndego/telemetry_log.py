@@ -0,0 +1,279 @@
+"""Append-only telemetry log of a mower on disk.
+
+Rows with the columns of the history are stored as fixed-width little endian
+records in segment files, one directory per mower. A segment starts with a
+header and is closed when it holds segment_records records. Appended rows are
+kept in memory and written and fsynced in batches by sync(), which the async
+client runs in the executor so the event loop does not wait for the disk. The reader maps the segments in memory and returns numpy views on
+them, so reading months of telemetry does not parse or copy anything.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .history import COLUMNS
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+_LOGGER = logging.getLogger(__name__)
+
+MAGIC = b"PYITLOG1"
+HEADER = struct.Struct("<8sII")
+RECORD = struct.Struct("<" + "".join(code for _, code in COLUMNS))
+SEGMENT_SUFFIX = ".seg"
+DEFAULT_SEGMENT_RECORDS = 100000
+DEFAULT_FSYNC_RECORDS = 100
+DEFAULT_FSYNC_INTERVAL = 30.0
+
+
+def _header() -> bytes:
+    """Return the header of a segment."""
+    return HEADER.pack(MAGIC, RECORD.size, len(COLUMNS))
+
+
+def _segment_name(timestamp: float) -> str:
+    """Return the file name of a segment that starts at timestamp, names sort in time order."""
+    return f"{int(timestamp * 1000):016d}{SEGMENT_SUFFIX}"
+
+
+class TelemetryLog:
+    """Writer of the telemetry log of a mower."""
+
+    def __init__(
+        self,
+        directory: str,
+        serial: str,
+        segment_records: int = DEFAULT_SEGMENT_RECORDS,
+        fsync_records: int = DEFAULT_FSYNC_RECORDS,
+        fsync_interval: float = DEFAULT_FSYNC_INTERVAL,
+    ):
+        """Open the log, new records are appended to the last segment when it is not full.
+
+        Args:
+            directory (str): base directory of the logs, the segments are stored in a subdirectory per serial.
+            serial (str): serial of the mower.
+            segment_records (int, optional): records per segment before a new segment is started.
+            fsync_records (int, optional): fsync after this number of records.
+            fsync_interval (float, optional): fsync when the last fsync is this number of seconds ago.
+
+        """
+        self.directory = os.path.join(directory, serial)
+        self.segment_records = segment_records
+        self.fsync_records = fsync_records
+        self.fsync_interval = fsync_interval
+        os.makedirs(self.directory, exist_ok=True)
+        self._file = None
+        self._records = 0
+        self._pending: List[tuple] = []
+        self._last_sync = time.monotonic()
+        self._last_timestamp = None
+        # _lock guards the pending rows, _write_lock the segment file while sync() runs in another thread.
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._resume()
+
+    def _resume(self):
+        """Continue the last segment, a partly written record at its end is cut off."""
+        segments = segment_files(self.directory)
+        if not segments:
+            return
+        filename = segments[-1]
+        size = os.path.getsize(filename)
+        records, partial = divmod(size - HEADER.size, RECORD.size)
+        if size < HEADER.size:
+            return
+        file = open(filename, "r+b")  # pylint: disable=consider-using-with
+        if file.read(HEADER.size) != _header():
+            _LOGGER.warning("Telemetry segment %s has an unknown format, starting a new segment", filename)
+            file.close()
+            return
+        if records:
+            file.seek(HEADER.size + (records - 1) * RECORD.size)
+            self._last_timestamp = RECORD.unpack(file.read(RECORD.size))[0]
+        if records >= self.segment_records:
+            file.close()
+            return
+        if partial:
+            _LOGGER.warning("Telemetry segment %s ends with a partial record, it is removed", filename)
+            file.truncate(size - partial)
+        file.seek(0, os.SEEK_END)
+        self._file = file
+        self._records = records
+
+    def _rotate(self, timestamp: float):
+        """Close the current segment and start a new one, called by sync()."""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        filename = os.path.join(self.directory, _segment_name(timestamp))
+        self._file = open(filename, "ab")  # pylint: disable=consider-using-with
+        self._file.write(_header())
+        self._records = 0
+        _LOGGER.debug("Started telemetry segment %s", filename)
+
+    def append(self, row: tuple):
+        """Append a row with a value for every column of the history, in the order of COLUMNS, without disk I/O."""
+        with self._lock:
+            if self._last_timestamp is not None and row[0] < self._last_timestamp:
+                _LOGGER.debug("Telemetry row with timestamp %s is older than the last row, it is not logged", row[0])
+                return
+            self._last_timestamp = row[0]
+            self._pending.append(row)
+
+    @property
+    def sync_due(self) -> bool:
+        """Return True when fsync_records rows are pending or the last sync is fsync_interval seconds ago."""
+        pending = len(self._pending)
+        return pending >= self.fsync_records or (
+            pending > 0 and time.monotonic() - self._last_sync >= self.fsync_interval
+        )
+
+    def sync(self):
+        """Write the pending records to the segments and fsync them, blocks on the disk."""
+        with self._write_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return
+            for row in rows:
+                if self._file is None or self._records >= self.segment_records:
+                    self._rotate(row[0])
+                self._file.write(RECORD.pack(*row))
+                self._records += 1
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._last_sync = time.monotonic()
+
+    def close(self):
+        """Sync and close the current segment."""
+        self.sync()
+        with self._write_lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        """Return the log."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the log."""
+        self.close()
+
+
+def segment_files(directory: str) -> List[str]:
+    """Return the segment files in a mower directory, oldest first."""
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in names]
+
+
+def remove_segments_before(directory: str, serial: str, timestamp: float) -> int:
+    """Remove the segments of a mower with only records older than timestamp, the last segment is kept.
+
+    A segment ends where the next one starts, so it is removed when the next segment starts before timestamp.
+
+    Returns:
+        int: number of removed segments.
+
+    """
+    segments = segment_files(os.path.join(directory, serial))
+    removed = 0
+    for filename, next_filename in zip(segments, segments[1:]):
+        if int(os.path.basename(next_filename)[: -len(SEGMENT_SUFFIX)]) / 1000 > timestamp:
+            break
+        os.remove(filename)
+        removed += 1
+    if removed:
+        _LOGGER.debug("Removed %i telemetry segments of %s older than %s", removed, serial, timestamp)
+    return removed
+
+
+def record_dtype() -> "np.dtype":
+    """Return the numpy dtype of a record."""
+    return np.dtype([(name, "<f8" if code == "d" else "<i8") for name, code in COLUMNS])
+
+
+class TelemetryReader:
+    """Read the telemetry log of a mower through memory maps, requires numpy."""
+
+    def __init__(self, directory: str, serial: str):
+        """Initialize the reader, the segments are mapped on first read.
+
+        Raises:
+            ImportError: when numpy is not installed.
+
+        """
+        if np is None:
+            raise ImportError("The telemetry reader requires numpy, install pyIndego[numpy].")
+        self.directory = os.path.join(directory, serial)
+        self._dtype = record_dtype()
+        self._maps: Dict[str, mmap.mmap] = {}
+
+    def _segment(self, filename: str) -> Optional["np.ndarray"]:
+        """Return a view on the complete records of a segment."""
+        records = (os.path.getsize(filename) - HEADER.size) // RECORD.size
+        if records <= 0:
+            return None
+        current = self._maps.get(filename)
+        if current is None or len(current) < HEADER.size + records * RECORD.size:
+            # The segment grew (or is new), map it again to see the new records.
+            with open(filename, "rb") as file:
+                current = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            if current[: HEADER.size] != _header():
+                current.close()
+                _LOGGER.warning("Telemetry segment %s has an unknown format, it is skipped", filename)
+                return None
+            self._maps[filename] = current
+        return np.frombuffer(current, dtype=self._dtype, count=records, offset=HEADER.size)
+
+    def segments(self, start: float = None, end: float = None) -> List["np.ndarray"]:
+        """Return views on the records with start <= timestamp <= end, one per segment, oldest first."""
+        views = []
+        for filename in segment_files(self.directory):
+            view = self._segment(filename)
+            if view is None or not len(view):
+                continue
+            timestamps = view["timestamp"]
+            first = 0 if start is None else int(np.searchsorted(timestamps, start, "left"))
+            last = len(view) if end is None else int(np.searchsorted(timestamps, end, "right"))
+            if first < last:
+                views.append(view[first:last])
+        return views
+
+    def read(self, start: float = None, end: float = None) -> "np.ndarray":
+        """Return the records with start <= timestamp <= end as one array, this copies when there are more segments."""
+        views = self.segments(start, end)
+        if len(views) == 1:
+            return views[0]
+        if not views:
+            return np.empty(0, dtype=self._dtype)
+        return np.concatenate(views)
+
+    def close(self):
+        """Unmap the segments, views returned before can not be used anymore."""
+        for current in self._maps.values():
+            try:
+                current.close()
+            except BufferError:
+                _LOGGER.debug("Telemetry segment is still in use, it is unmapped when the views are released")
+        self._maps.clear()
+
+    def __enter__(self):
+        """Return the reader."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the reader."""
+        self.close()
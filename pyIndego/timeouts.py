@@ -0,0 +1,116 @@
+"""Request timeouts that follow the observed latency of each endpoint.
+
+The latency of the last requests is kept per method and endpoint template. Once
+there are enough samples, the read timeout of a request is a percentile of
+that latency times a factor, between a floor and a ceiling, and never longer
+than the timeout the caller asked for. Requests that time out are recorded with
+at least their timeout, so a slower endpoint gets longer timeouts again.
+Connection errors are not recorded, their short elapsed times would shrink the
+timeouts while the API is unhealthy. Connect
+times are not reported by requests or aiohttp, the connect timeout is a fixed
+part of the policy. Longpolls and map downloads keep their own timeouts.
+"""
+import logging
+import math
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Optional, Tuple
+
+from .middleware import Middleware, RequestContext
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 200
+
+
+class LatencyTracker:
+    """Rolling window of latencies per (method, endpoint), can be shared by the clients of a fleet."""
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        """Initialize the tracker.
+
+        Args:
+            window (int, optional): number of latencies kept per endpoint. Defaults to 200.
+
+        """
+        self.window = window
+        self._samples: Dict[Tuple[str, str], Deque[float]] = {}
+        self._sorted: Dict[Tuple[str, str], list] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(ctx: RequestContext) -> Tuple[str, str]:
+        """Return the key of a request."""
+        return ctx.method.value, ctx.endpoint
+
+    def observe(self, key: Tuple[str, str], latency: float):
+        """Add the latency of a request."""
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(latency)
+            self._sorted.pop(key, None)
+
+    def count(self, key: Tuple[str, str]) -> int:
+        """Return the number of latencies of an endpoint."""
+        return len(self._samples.get(key, ()))
+
+    def percentile(self, key: Tuple[str, str], quantile: float) -> Optional[float]:
+        """Return the latency at the quantile (0-1) of an endpoint, None without samples."""
+        with self._lock:
+            ordered = self._sorted.get(key)
+            if ordered is None:
+                samples = self._samples.get(key)
+                if not samples:
+                    return None
+                # Sorted once per new sample at most, a percentile is asked for every request.
+                ordered = self._sorted[key] = sorted(samples)
+            return ordered[min(len(ordered) - 1, max(0, math.ceil(quantile * len(ordered)) - 1))]
+
+
+@dataclass
+class TimeoutPolicy:
+    """How the read timeout follows the latency, and the connect timeout."""
+
+    quantile: float = 0.99
+    factor: float = 3.0
+    floor: float = 2.0
+    ceiling: float = 30.0
+    connect_timeout: float = 5.0
+    min_samples: int = 20
+
+    def read_timeout(self, latency: Optional[float], requested: float) -> float:
+        """Return the read timeout for the latency at the quantile, the requested timeout without a latency."""
+        if latency is None:
+            return requested
+        return min(requested, self.ceiling, max(self.floor, latency * self.factor))
+
+
+class AdaptiveTimeoutMiddleware(Middleware):
+    """Set the timeouts of requests from the latency of their endpoint."""
+
+    def __init__(self, policy: TimeoutPolicy = None, tracker: LatencyTracker = None):
+        """Initialize the middleware."""
+        self.policy = policy or TimeoutPolicy()
+        self.tracker = tracker or LatencyTracker()
+
+    def on_request(self, client, ctx: RequestContext):
+        """Set the connect and read timeout."""
+        ctx.connect_timeout = self.policy.connect_timeout
+        if ctx.longpoll or ctx.download_to:
+            return
+        key = self.tracker.key(ctx)
+        if self.tracker.count(key) < self.policy.min_samples:
+            return
+        ctx.timeout = self.policy.read_timeout(self.tracker.percentile(key, self.policy.quantile), ctx.timeout)
+
+    def on_response(self, client, ctx: RequestContext):
+        """Record the latency of answered and timed out requests."""
+        if ctx.short_circuited or ctx.longpoll or ctx.download_to or ctx.elapsed is None:
+            return
+        if isinstance(ctx.error, client._deadline_errors):  # pylint: disable=protected-access
+            self.tracker.observe(self.tracker.key(ctx), max(ctx.elapsed, ctx.timeout))
+        elif ctx.status is not None:
+            self.tracker.observe(self.tracker.key(ctx), ctx.elapsed)
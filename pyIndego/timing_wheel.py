@@ -0,0 +1,127 @@
+"""Hierarchical timing wheel.
+
+Timers are kept in slots of wheels with increasing tick sizes. Level 0 holds
+the timers that expire within slots ticks, level 1 those within slots**2 ticks
+and so on. When the lower wheel wraps, the current slot of the next level is
+moved down. Inserting and cancelling a timer are O(1), advancing costs O(1) per
+tick plus the expired timers.
+"""
+import itertools
+from typing import Any, Dict, List, Optional
+
+DEFAULT_SLOTS = 64
+DEFAULT_LEVELS = 4
+
+
+class Timer:
+    """Handle of a timer in a timing wheel."""
+
+    __slots__ = ("expiry", "payload", "_bucket", "_id")
+
+    def __init__(self, expiry: int, payload: Any, timer_id: int):
+        """Initialize the timer, use TimingWheel.schedule to create timers."""
+        self.expiry = expiry
+        self.payload = payload
+        self._bucket: Optional[Dict[int, "Timer"]] = None
+        self._id = timer_id
+
+    @property
+    def active(self) -> bool:
+        """Return True while the timer is scheduled."""
+        return self._bucket is not None
+
+    def __repr__(self):
+        """Return the expiry and payload."""
+        return f"Timer(expiry={self.expiry}, payload={self.payload!r})"
+
+
+class TimingWheel:
+    """Hierarchical timing wheel with integer ticks."""
+
+    def __init__(self, slots: int = DEFAULT_SLOTS, levels: int = DEFAULT_LEVELS, tick: int = 0):
+        """Initialize an empty wheel.
+
+        Args:
+            slots (int, optional): slots per level, a power of two. Defaults to 64.
+            levels (int, optional): number of levels, at least 2, timers further away than slots**levels ticks are moved down later. Defaults to 4.
+            tick (int, optional): current tick. Defaults to 0.
+
+        """
+        if slots < 2 or slots & (slots - 1):
+            raise ValueError("Slots should be a power of two.")
+        if levels < 2:
+            # Far timers are parked in the top level and moved down when it turns, a single level has nothing above it.
+            raise ValueError("A timing wheel needs at least 2 levels.")
+        self.slots = slots
+        self.levels = levels
+        self.tick = tick
+        self._bits = slots.bit_length() - 1
+        self._mask = slots - 1
+        self._wheels: List[List[Dict[int, Timer]]] = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._ready: Dict[int, Timer] = {}
+        self._ids = itertools.count()
+        self._count = 0
+
+    def __len__(self) -> int:
+        """Return the number of scheduled timers."""
+        return self._count
+
+    def schedule(self, expiry: int, payload: Any = None) -> Timer:
+        """Schedule a timer that expires at the tick expiry, a tick in the past expires on the next advance."""
+        timer = Timer(int(expiry), payload, next(self._ids))
+        self._insert(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer: Timer) -> bool:
+        """Cancel a timer, returns False when it already expired or was cancelled."""
+        if timer._bucket is None:  # pylint: disable=protected-access
+            return False
+        timer._bucket.pop(timer._id, None)  # pylint: disable=protected-access
+        timer._bucket = None  # pylint: disable=protected-access
+        self._count -= 1
+        return True
+
+    def _insert(self, timer: Timer):
+        """Put a timer in the slot of its expiry."""
+        delta = timer.expiry - self.tick
+        if delta <= 0:
+            bucket = self._ready
+        else:
+            level = 0
+            while level < self.levels - 1 and delta >= 1 << (self._bits * (level + 1)):
+                level += 1
+            expiry = min(timer.expiry, self.tick + (1 << (self._bits * (level + 1))) - 1)
+            bucket = self._wheels[level][(expiry >> (self._bits * level)) & self._mask]
+        bucket[timer._id] = timer  # pylint: disable=protected-access
+        timer._bucket = bucket  # pylint: disable=protected-access
+
+    def _take(self, bucket: Dict[int, Timer]) -> List[Timer]:
+        """Empty a bucket and return its timers."""
+        timers = list(bucket.values())
+        bucket.clear()
+        for timer in timers:
+            timer._bucket = None  # pylint: disable=protected-access
+        return timers
+
+    def advance(self, tick: int) -> List[Timer]:
+        """Move the wheel to tick and return the expired timers, in expiry order per tick."""
+        expired = self._take(self._ready)
+        while self.tick < tick:
+            self.tick += 1
+            for level in range(self.levels - 1, 0, -1):
+                if self.tick & ((1 << (self._bits * level)) - 1) == 0:
+                    slot = self._wheels[level][(self.tick >> (self._bits * level)) & self._mask]
+                    for timer in self._take(slot):
+                        self._insert(timer)
+            expired.extend(self._take(self._wheels[0][self.tick & self._mask]))
+            expired.extend(self._take(self._ready))
+        self._count -= len(expired)
+        return expired
+
+    def next_expiry(self) -> Optional[int]:
+        """Return the earliest expiry of the scheduled timers, None when the wheel is empty (O(timers), for diagnostics)."""
+        expiries = [
+            timer.expiry for level in self._wheels for bucket in level for timer in bucket.values()
+        ] + [timer.expiry for timer in self._ready.values()]
+        return min(expiries) if expiries else None
@@ -0,0 +1,196 @@
+"""Tracing of pyIndego requests and update cycles.
+
+Every span, also every attempt of a request, gets a random 64 bit span ID. The
+spans of requests carry the request ID of the log messages as attribute. The
+parent of a span is the span that was active in the same task or thread when it
+was started. Finished spans are handed to an exporter.
+"""
+import contextvars
+import logging
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from .middleware import Middleware, RequestContext
+
+_LOGGER = logging.getLogger(__name__)
+
+_CURRENT_SPAN = contextvars.ContextVar("pyindego_current_span", default=None)
+
+
+def new_span_id() -> str:
+    """Return a random span ID, unique within the spans of a fleet."""
+    return secrets.token_hex(8)
+
+
+@dataclass
+class Span:
+    """A timed operation, part of a trace."""
+
+    name: str
+    trace_id: str
+    span_id: str = field(default_factory=new_span_id)
+    parent_id: Optional[str] = None
+    start_time: float = field(default_factory=time.time)
+    end_time: Optional[float] = None
+    status: str = "ok"
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> Optional[float]:
+        """Return the duration in seconds, None while the span is running."""
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def set_attribute(self, key: str, value: Any):
+        """Set an attribute of the span."""
+        self.attributes[key] = value
+
+    def set_error(self, error: BaseException):
+        """Mark the span as failed."""
+        self.status = "error"
+        self.attributes["error"] = repr(error)
+
+
+class SpanExporter:
+    """Base class for span exporters."""
+
+    def export(self, span: Span):
+        """Export a finished span."""
+        raise NotImplementedError
+
+
+class InMemorySpanExporter(SpanExporter):
+    """Keep the last finished spans in a ring buffer."""
+
+    def __init__(self, max_spans: int = 10000):
+        """Initialize the exporter.
+
+        Args:
+            max_spans (int, optional): number of spans to keep, the oldest are dropped first. Defaults to 10000.
+
+        """
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        """Add the span to the buffer."""
+        with self._lock:
+            self._spans.append(span)
+
+    def clear(self):
+        """Remove all spans."""
+        with self._lock:
+            self._spans.clear()
+
+    def spans(self, trace_id: str = None) -> List[Span]:
+        """Return the buffered spans, optionally only those of a single trace."""
+        with self._lock:
+            return [span for span in self._spans if trace_id is None or span.trace_id == trace_id]
+
+    def children(self, span: Span) -> List[Span]:
+        """Return the direct children of a span, ordered by start time."""
+        return sorted(
+            (child for child in self.spans(span.trace_id) if child.parent_id == span.span_id),
+            key=lambda child: child.start_time,
+        )
+
+    def critical_path(self, span: Span) -> List[Span]:
+        """Return the chain of spans from span down to the child that finished last at each level."""
+        path = [span]
+        children = self.children(span)
+        while children:
+            last = max(children, key=lambda child: child.end_time)
+            path.append(last)
+            children = self.children(last)
+        return path
+
+
+class Tracer:
+    """Create spans and send them to the exporter when they end."""
+
+    def __init__(self, exporter: SpanExporter = None):
+        """Initialize the tracer.
+
+        Args:
+            exporter (SpanExporter, optional): exporter for finished spans, defaults to an InMemorySpanExporter.
+
+        """
+        self.exporter = exporter if exporter is not None else InMemorySpanExporter()
+
+    @staticmethod
+    def current_span() -> Optional[Span]:
+        """Return the active span of the current task or thread."""
+        return _CURRENT_SPAN.get()
+
+    def start_span(self, name: str, span_id: str = None, **attributes) -> Span:
+        """Start a span as child of the current span, it is not made the current span."""
+        parent = _CURRENT_SPAN.get()
+        span = Span(
+            name=name,
+            trace_id=parent.trace_id if parent else secrets.token_hex(8),
+            parent_id=parent.span_id if parent else None,
+            attributes=attributes,
+        )
+        if span_id:
+            span.span_id = span_id
+        return span
+
+    def end_span(self, span: Span):
+        """End a span and export it."""
+        span.end_time = time.time()
+        try:
+            self.exporter.export(span)
+        except Exception as exc:  # pylint: disable=broad-except
+            _LOGGER.warning("Exporting span %s failed: %s", span.name, exc)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Run the block in a new span that is the parent of the spans started in it."""
+        span = self.start_span(name, **attributes)
+        token = _CURRENT_SPAN.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.set_error(exc)
+            raise
+        finally:
+            _CURRENT_SPAN.reset(token)
+            self.end_span(span)
+
+
+class TracingMiddleware(Middleware):
+    """Create a span for every request attempt, with the request ID as attribute."""
+
+    def __init__(self, tracer: Tracer):
+        """Initialize the middleware."""
+        self.tracer = tracer
+
+    def on_request(self, client, ctx: RequestContext):
+        """Start the span of the request."""
+        ctx.extras["span"] = self.tracer.start_span(
+            f"{ctx.method.value} {ctx.endpoint}",
+            request_id=ctx.request_id,
+            endpoint=ctx.endpoint,
+            method=ctx.method.value,
+            attempt=ctx.attempt,
+            longpoll=ctx.longpoll,
+        )
+
+    def on_response(self, client, ctx: RequestContext):
+        """End the span with the status of the request."""
+        span = ctx.extras.pop("span", None)
+        if span is None:
+            return
+        span.set_attribute("status", ctx.status)
+        span.set_attribute("short_circuited", ctx.short_circuited)
+        if ctx.error is not None:
+            span.set_error(ctx.error)
+        elif ctx.status is not None and ctx.status >= 400 and not (ctx.status == 504 and ctx.longpoll):
+            span.status = "error"
+        self.tracer.end_span(span)
@@ -24,7 +24,11 @@ setup(
     url="https://github.com/sander1988/pyIndego",
     packages=find_packages("."),
     install_requires=["requests", "aiohttp", "pytz"],
-    extras_require={"testing": ["pytest", "pytest-asyncio", "pytest-cov", "mock"]},
+    extras_require={
+        "numpy": ["numpy"],
+        "speedups": ["orjson"],
+        "testing": ["pytest", "pytest-asyncio", "pytest-cov", "mock"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -1,13 +1,20 @@
 """Test the states of pyIndego."""
 import asyncio
+import json
 import logging
-from datetime import datetime
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone
 from socket import error as SocketError
 from typing import Final
+from urllib.request import urlopen
 
 import pytest
 from aiohttp import (
     ClientOSError,
+    ClientSession,
     ClientResponseError,
     ServerTimeoutError,
     TooManyRedirects,
@@ -18,8 +25,30 @@ from requests.exceptions import RequestException, Timeout
 from requests.exceptions import TooManyRedirects as reqTooManyRedirects
 
 from pyIndego import IndegoAsyncClient, IndegoClient
+from pyIndego.budget import PRIORITY_BULK, PRIORITY_COMMAND, BudgetMiddleware, RequestBudget, TokenBucket
+from pyIndego.circuit_breaker import CircuitBreaker, CircuitBreakers, CircuitOpenError
+from pyIndego.codec import JsonCodec, get_codec
+from pyIndego.connection_pools import PoolConfig
+from pyIndego.dispatch import PriorityDispatcher, request_class
+from pyIndego.fleet import FleetScheduler
+from pyIndego.freshness import FetchInfo
 from pyIndego.const import CONTENT_TYPE, CONTENT_TYPE_JSON, Methods
-from pyIndego.helpers import convert_bosch_datetime
+from pyIndego.helpers import convert_bosch_datetime, endpoint_template
+from pyIndego.hedging import Hedger
+from pyIndego.history import History
+from pyIndego.map_cache import MapCache
+from pyIndego.map_model import parse_map
+from pyIndego.occupancy import OccupancyGrid
+from pyIndego.metrics import serve_metrics
+from pyIndego.middleware import Middleware
+from pyIndego.polling import PollingPolicy, PollingScheduler, mower_activity
+from pyIndego.profiling import ProfileReport
+from pyIndego.retry import RetryPolicy
+from pyIndego.rollup import RollupEngine
+from pyIndego.telemetry_log import TelemetryLog, TelemetryReader, segment_files
+from pyIndego.timing_wheel import TimingWheel
+from pyIndego.timeouts import AdaptiveTimeoutMiddleware, LatencyTracker, TimeoutPolicy
+from pyIndego.tracing import Tracer
 from pyIndego.states import (
     Alert,
     Calendar,
@@ -438,6 +467,10 @@ class MockResponseAsync:
         """Return json."""
         return self._json
 
+    async def read(self):
+        """Return the body."""
+        return json.dumps(self._json).encode() if self._json is not None else b""
+
     @property
     def content_type(self):
         """Return content type."""
@@ -466,6 +499,11 @@ class MockResponseSync:
         """Return json."""
         return self._json
 
+    @property
+    def content(self):
+        """Return the body."""
+        return json.dumps(self._json).encode() if self._json is not None else b""
+
     @property
     def headers(self):
         """Return header."""
@@ -474,6 +512,61 @@ class MockResponseSync:
         return None
 
 
+MAP_SVG: Final = (
+    b'<svg xmlns="http://www.w3.org/2000/svg" width="800" height="600" viewBox="0 0 800 600">'
+    b'<path d="M 100 100 L 700 100 L 700 500 L 100 500 Z" fill="#5ca53c"/>'
+    b'<circle id="dock" cx="110" cy="490" r="5"/></svg>'
+)
+
+
+class MockMapContent:
+    """Class for the streamed content of a mock map response in async."""
+
+    def __init__(self, body, fail):
+        """Init the content."""
+        self._body = body
+        self._fail = fail
+
+    async def iter_chunked(self, size):
+        """Return the body in chunks."""
+        yield self._body[:10]
+        if self._fail:
+            raise ClientOSError("Connection lost")
+        for start in range(10, len(self._body), size):
+            yield self._body[start:start + size]
+
+
+class MockMapResponseAsync(MockResponseAsync):
+    """Class for mock map responses in async."""
+
+    def __init__(self, body=MAP_SVG, status=200, fail=False):
+        """Init the async mock map response."""
+        super().__init__(None, status)
+        self.content = MockMapContent(body, fail)
+
+
+class MockMapResponseSync:
+    """Class for mock map responses in sync."""
+
+    def __init__(self, body=MAP_SVG, status=200, fail=False):
+        """Init the sync mock map response."""
+        self._body = body
+        self._fail = fail
+        self.status_code = status
+        self.headers = {CONTENT_TYPE: "image/svg+xml"}
+
+    def iter_content(self, size):
+        """Return the body in chunks."""
+        yield self._body[:10]
+        if self._fail:
+            raise RequestException("Connection lost")
+        for start in range(10, len(self._body), size):
+            yield self._body[start:start + size]
+
+    def close(self):
+        """Close the response."""
+
+
 class TestIndego(object):
     """States class."""
 
@@ -534,6 +627,58 @@ class TestIndego(object):
         test_dt = convert_bosch_datetime(date_str)
         assert test_dt == date_dt
 
+    @pytest.mark.parametrize(
+        "path, endpoint",
+        [
+            ("alms", "alms"),
+            ("alms/123456789", "alms/{serial}"),
+            ("alms/123456789/state?longpoll=true&timeout=120&last=0", "alms/{serial}/state"),
+            ("alms/123456789/predictive/calendar", "alms/{serial}/predictive/calendar"),
+            ("alerts/5efda84ffbf591182723be89/", "alerts/{alert_id}"),
+            ("users/abc", "users/{user_id}"),
+        ],
+    )
+    def test_endpoint_template(self, path, endpoint):
+        """Test the endpoint templates used for metrics."""
+        assert endpoint_template(path) == endpoint
+
+    def test_metrics(self):
+        """Test the request metrics per endpoint template."""
+        indego = IndegoClient(**test_config)
+        with patch("requests.request", return_value=MockResponseSync(STATE_RESPONSE, 200)):
+            indego.update_state()
+            indego.update_state(force=True)
+        with patch("requests.request", return_value=MockResponseSync(None, 504)):
+            indego.update_state(longpoll=True)
+        with patch("requests.request", side_effect=Timeout):
+            indego.update_operating_data()
+
+        metrics = indego.metrics()["GET"]
+        state = metrics["alms/{serial}/state"]
+        assert state["requests"] == 2
+        assert state["statuses"] == {200: 2}
+        assert state["response_bytes"] == 2 * len(json.dumps(STATE_RESPONSE))
+        assert metrics["alms/{serial}/state (longpoll)"]["longpoll_timeouts"] == 1
+        assert metrics["alms/{serial}/operatingData"]["timeouts"] == 1
+
+        text = indego.metrics_prometheus()
+        assert (
+            'pyindego_responses_total{method="GET",endpoint="alms/{serial}/state",longpoll="false",status="200"} 2'
+            in text
+        )
+        assert (
+            'pyindego_request_duration_seconds_count{method="GET",endpoint="alms/{serial}/state",longpoll="false"} 2'
+            in text
+        )
+
+        server = serve_metrics(indego.metrics_registry, port=0)
+        try:
+            with urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+                assert response.read().decode() == text
+        finally:
+            server.shutdown()
+            server.server_close()
+
     @pytest.mark.parametrize(
         "sync, func, attr, ret_value, assert_value",
         [
@@ -1053,6 +1198,191 @@ class TestIndego(object):
             resp = indego._request(method=Methods.GET, path="alerts", timeout=1)
             assert resp is None
 
+    @pytest.mark.parametrize(
+        "error", [(Timeout), (reqTooManyRedirects), (RequestException)]
+    )
+    def test_client_response_errors_raised(self, error):
+        """Test that the sync client raises request exceptions when configured to."""
+        with patch("requests.request", side_effect=error):
+            indego = IndegoClient(**test_config, raise_request_exceptions=True)
+            with pytest.raises(error):
+                indego._request(method=Methods.GET, path="alerts", timeout=1)
+
+    @pytest.mark.asyncio
+    async def test_middleware(self):
+        """Test that both clients run requests through the same middleware chain."""
+
+        class ShortCircuit(Middleware):
+            def __init__(self):
+                self.responses = []
+
+            def on_request(self, client, ctx):
+                if ctx.path.endswith("/state"):
+                    ctx.short_circuit(STATE_RESPONSE)
+
+            def on_response(self, client, ctx):
+                self.responses.append((ctx.path, ctx.headers.get("Authorization"), ctx.status))
+
+        middleware = ShortCircuit()
+        with patch("requests.request", return_value=MockResponseSync(USER_RESPONSE, 200)) as request:
+            indego = IndegoClient(**test_config)
+            indego.add_middleware(middleware)
+            indego.update_state()
+            indego.update_user()
+            assert indego.state == State(**STATE_RESPONSE)
+            assert request.call_count == 1
+            assert middleware.responses == [
+                ("alms/123456789/state", "Bearer testtoken", None),
+                ("users/None", "Bearer testtoken", 200),
+            ]
+
+        middleware = ShortCircuit()
+        with patch(
+                "aiohttp.ClientSession.request", return_value=MockResponseAsync(USER_RESPONSE, 200)
+        ) as request, patch("pyIndego.IndegoAsyncClient.start", return_value=True):
+            async with IndegoAsyncClient(**test_config) as indego:
+                indego.add_middleware(middleware)
+                await indego.update_state()
+                await indego.update_user()
+                assert indego.state == State(**STATE_RESPONSE)
+                assert request.call_count == 1
+                assert middleware.responses == [
+                    ("alms/123456789/state", "Bearer testtoken", None),
+                    ("users/None", "Bearer testtoken", 200),
+                ]
+
+    @pytest.mark.asyncio
+    async def test_profiler(self):
+        """Test the network, decode and build timings of the update methods."""
+        samples = []
+        report = ProfileReport()
+
+        def profiler(sample):
+            samples.append(sample)
+            report(sample)
+
+        with patch("requests.request", return_value=MockResponseSync(OPERATING_RESPONSE, 200)):
+            indego = IndegoClient(**test_config)
+            indego.set_profiler(profiler)
+            indego.update_operating_data()
+        with patch(
+                "aiohttp.ClientSession.request", return_value=MockResponseAsync(STATE_RESPONSE, 200)
+        ), patch("pyIndego.IndegoAsyncClient.start", return_value=True):
+            async with IndegoAsyncClient(**test_config) as indego:
+                indego.set_profiler(profiler)
+                await asyncio.gather(indego.update_state(), indego.update_state())
+                indego.set_profiler(None)
+                await indego.update_state()
+
+        assert [(sample.target, sample.endpoint) for sample in samples] == [
+            ("operating_data", "alms/{serial}/operatingData"),
+            ("state", "alms/{serial}/state"),
+            ("state", "alms/{serial}/state"),
+        ]
+        assert samples[1].request_id != samples[2].request_id
+        assert all(sample.build > 0 and sample.decode > 0 for sample in samples)
+        summary = report.summary()
+        assert summary["state"]["count"] == 2
+        assert summary["operating_data"]["total"] == samples[0].total
+        assert "operating_data" in report.format()
+
+    @pytest.mark.asyncio
+    async def test_tracing(self):
+        """Test the spans of an update cycle and its requests."""
+        tracer = Tracer()
+        with patch("aiohttp.ClientSession.request", return_value=MockResponseAsync(None, 504)), patch(
+                "pyIndego.IndegoAsyncClient.start", return_value=True
+        ):
+            async with IndegoAsyncClient(**test_config) as indego:
+                indego.set_tracer(tracer)
+                await indego.update_all()
+                indego.set_tracer(None)
+                await indego.update_state()
+
+        spans = tracer.exporter.spans()
+        root = spans[-1]
+        assert root.name == "update_all" and root.parent_id is None
+        children = tracer.exporter.children(root)
+        assert len(children) == len(spans) - 1 >= 15
+        assert all(child.trace_id == root.trace_id for child in children)
+        assert "GET alms/{serial}/state" in [child.name for child in children]
+        assert all(child.status == "error" and child.attributes["status"] == 504 for child in children)
+        assert tracer.exporter.critical_path(root)[-1].end_time == max(child.end_time for child in children)
+
+        tracer = Tracer()
+        with patch("requests.request", return_value=MockResponseSync(STATE_RESPONSE, 200)) as request:
+            indego = IndegoClient(**test_config)
+            indego.set_tracer(tracer)
+            with tracer.span("refresh") as refresh:
+                indego.update_state()
+            (span,) = tracer.exporter.children(refresh)
+            assert span.status == "ok" and span.attributes["status"] == 200
+            assert request.call_args.kwargs["headers"]["Authorization"] == "Bearer testtoken"
+
+            # Every attempt of a retried request has its own span.
+            indego.set_retry_policy(RetryPolicy(base_delay=0))
+            request.return_value = MockResponseSync({}, 502)
+            with tracer.span("retry") as retry, patch("time.sleep"):
+                indego.update_state()
+            attempts = tracer.exporter.children(retry)
+            assert [span.attributes["attempt"] for span in attempts] == [1, 2, 3]
+            assert len({span.span_id for span in attempts}) == 3
+            assert len({span.attributes["request_id"] for span in attempts}) == 1
+
+    def test_request_logging(self, caplog):
+        """Test the sampling, truncating and structured request logging."""
+        indego = IndegoClient(**test_config)
+        with patch("requests.request", return_value=MockResponseSync(OPERATING_RESPONSE, 200)):
+            with caplog.at_level(logging.INFO, logger="pyIndego"):
+                indego.update_operating_data()
+            assert not caplog.records
+
+            indego.set_request_logging(sample_rate=2, max_body=20)
+            with caplog.at_level(logging.DEBUG, logger="pyIndego"):
+                for _ in range(4):
+                    indego.update_operating_data()
+            messages = [record.getMessage() for record in caplog.records]
+            assert len([message for message in messages if "HTTP status code" in message]) == 2
+            assert "testtoken" not in " ".join(messages)
+            assert any(message.endswith("... (truncated)") for message in messages)
+
+            caplog.clear()
+            indego.set_request_logging(structured=True)
+            with caplog.at_level(logging.DEBUG, logger="pyIndego"):
+                indego.update_operating_data()
+            (record,) = caplog.records
+            assert record.pyindego_request["endpoint"] == "alms/{serial}/operatingData"
+            assert record.pyindego_request["status"] == 200
+            assert record.pyindego_request["headers"]["Authorization"] == "******"
+
+    @pytest.mark.parametrize("codec", ["json", "orjson", "ujson"])
+    @pytest.mark.asyncio
+    async def test_json_codec(self, codec):
+        """Test decoding responses and encoding request bodies with the JSON codecs."""
+        pytest.importorskip(codec)
+        assert get_codec(codec).name == codec
+        with patch("requests.request", return_value=MockResponseSync(OPERATING_RESPONSE, 200)) as request:
+            indego = IndegoClient(**test_config, json_codec=codec)
+            indego.update_operating_data()
+            assert indego.operating_data == OperatingData(**OPERATING_RESPONSE)
+            indego.put_command("mow")
+            assert json.loads(request.call_args.kwargs["data"]) == {"state": "mow"}
+
+        with patch(
+                "aiohttp.ClientSession.request", return_value=MockResponseAsync(CALENDAR_RESPONSE, 200)
+        ) as request, patch("pyIndego.IndegoAsyncClient.start", return_value=True):
+            async with IndegoAsyncClient(**test_config, json_codec=get_codec(codec)) as indego:
+                await indego.put_predictive_cal()
+                kwargs = request.call_args.kwargs
+                assert json.loads(kwargs["data"])["cals"][0]["cal"] == 1
+                assert kwargs["headers"][CONTENT_TYPE] == CONTENT_TYPE_JSON
+
+    def test_json_codec_default(self):
+        """Test the codec selection."""
+        assert isinstance(get_codec(), JsonCodec)
+        with pytest.raises(ValueError):
+            get_codec("yaml")
+
     @pytest.mark.parametrize(  # noqa: ignore:C901
         "alerts, loaded, index, error",
         [
@@ -1267,6 +1597,899 @@ class TestIndego(object):
                 except error:
                     assert True
 
+    @pytest.mark.asyncio
+    async def test_download_stream(self, tmp_path):
+        """Test streaming the map to a file, a failed download keeps the old map."""
+        filename = str(tmp_path / "map.svg")
+        with patch("requests.request", return_value=MockMapResponseSync()) as request:
+            indego = IndegoClient(**test_config)
+            result = indego.download_map(filename)
+            assert request.call_args.kwargs["stream"] is True
+        assert result.filename == filename and result.size == len(MAP_SVG) and result.duration >= 0
+        assert open(filename, "rb").read() == MAP_SVG
+        # The map gets the mode open() would give it, and keeps the mode of an existing map.
+        reference = tmp_path / "reference"
+        reference.write_bytes(b"")
+        assert os.stat(filename).st_mode == os.stat(reference).st_mode
+        os.remove(reference)
+        os.chmod(filename, 0o640)
+        with patch("requests.request", return_value=MockMapResponseSync()):
+            indego.download_map(filename)
+        assert os.stat(filename).st_mode & 0o777 == 0o640
+        # A new file gets the current umask.
+        umask = os.umask(0o077)
+        try:
+            with patch("requests.request", return_value=MockMapResponseSync()):
+                indego.download_map(str(tmp_path / "private.svg"))
+        finally:
+            os.umask(umask)
+        assert os.stat(tmp_path / "private.svg").st_mode & 0o777 == 0o600
+        os.remove(tmp_path / "private.svg")
+
+        with patch("requests.request", return_value=MockMapResponseSync(b"broken", fail=True)):
+            assert indego.download_map() is None
+        assert open(filename, "rb").read() == MAP_SVG
+        assert os.listdir(tmp_path) == ["map.svg"]
+
+        os.remove(filename)
+        with patch("aiohttp.ClientSession.request", return_value=MockMapResponseAsync()), patch(
+                "pyIndego.IndegoAsyncClient.start", return_value=True
+        ):
+            async with IndegoAsyncClient(**test_config, map_filename=filename) as indego:
+                result = await indego.download_map()
+                assert result.size == len(MAP_SVG)
+                assert indego.metrics()["GET"]["alms/{serial}/map"]["response_bytes"] == len(MAP_SVG)
+        assert open(filename, "rb").read() == MAP_SVG
+
+        with patch("aiohttp.ClientSession.request", return_value=MockMapResponseAsync(b"broken", fail=True)), patch(
+                "pyIndego.IndegoAsyncClient.start", return_value=True
+        ):
+            async with IndegoAsyncClient(**test_config, map_filename=filename) as indego:
+                assert await indego.download_map() is None
+        assert open(filename, "rb").read() == MAP_SVG
+        assert os.listdir(tmp_path) == ["map.svg"]
+
+    @pytest.mark.asyncio
+    async def test_map_cache(self, tmp_path):
+        """Test that cached map versions are not downloaded again and identical maps are stored once."""
+        filename = str(tmp_path / "map.svg")
+        cache = MapCache(str(tmp_path / "cache"))
+        state = {**STATE_RESPONSE, "map_update_available": False}
+        indego = IndegoClient(**test_config, map_filename=filename)
+        indego.set_map_cache(cache)
+        with patch("requests.request", return_value=MockMapResponseSync()) as request:
+            assert indego.download_map().cached is False
+            indego._update_state(state)
+            first = indego.download_map()
+            assert request.call_count == 2
+            assert first.cached is False
+            assert cache.lookup(indego.serial, state["mapsvgcache_ts"]) == first.digest
+
+            result = indego.download_map()
+            assert request.call_count == 2
+            assert result.cached is True and result.digest == first.digest and result.size == len(MAP_SVG)
+
+            os.remove(filename)
+            assert indego.download_map().cached is True
+            assert open(filename, "rb").read() == MAP_SVG
+            assert request.call_count == 2
+
+            indego._update_state({**state, "map_update_available": True})
+            assert indego.download_map().cached is False
+            assert request.call_count == 3
+
+            indego._update_state({**state, "mapsvgcache_ts": state["mapsvgcache_ts"] + 1})
+            assert indego.download_map().cached is False
+            assert cache.versions(indego.serial) == {
+                str(state["mapsvgcache_ts"]): first.digest,
+                str(state["mapsvgcache_ts"] + 1): first.digest,
+            }
+        assert os.listdir(tmp_path / "cache" / "objects") == [f"{first.digest}.svg"]
+        assert MapCache(str(tmp_path / "cache")).lookup(indego.serial, state["mapsvgcache_ts"]) == first.digest
+
+        with patch("aiohttp.ClientSession.request", return_value=MockMapResponseAsync()) as request, patch(
+                "pyIndego.IndegoAsyncClient.start", return_value=True
+        ):
+            async with IndegoAsyncClient(**test_config, map_filename=filename) as indego:
+                indego.set_map_cache(str(tmp_path / "cache"))
+                indego._update_state(state)
+                result = await indego.download_map()
+                assert result.cached is True and result.digest == first.digest
+                assert request.call_count == 0
+
+    def test_map_model(self, tmp_path):
+        """Test parsing the map into lawns and dock, and rendering the mower position."""
+        model = parse_map(MAP_SVG, 1)
+        assert (model.width, model.height) == (800, 600)
+        assert model.lawns == [((100, 100), (700, 100), (700, 500), (100, 500))]
+        assert model.dock == (110, 490)
+        assert model.bounding_box == (100, 100, 700, 500)
+        assert model.contains(400, 300) and not model.contains(50, 300)
+
+        svg = model.render((400, 300))
+        assert '<polygon points="100,100 700,100 700,500 100,500"' in svg
+        assert svg.endswith('<circle cx="400" cy="300" r="8" fill="#f5a623"/></svg>')
+        assert parse_map(svg.encode()).lawns == model.lawns
+        assert "<circle" not in model.render()
+
+        relative = parse_map(
+            b'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 50 40">'
+            b'<path d="m 10 10 h 20 v 10 h -20 z M 0 0 L 5 0 5 5 Z" fill="green"/>'
+            b'<path d="M 0 0 L 50 40" fill="none"/><rect class="dock" x="40" y="30" width="4" height="2"/></svg>'
+        )
+        assert (relative.width, relative.height) == (50, 40)
+        assert relative.lawns == [((10, 10), (30, 10), (30, 20), (10, 20)), ((0, 0), (5, 0), (5, 5))]
+        assert relative.dock == (42, 31)
+        with pytest.raises(ValueError):
+            parse_map(b"<html>")
+
+        filename = tmp_path / "map.svg"
+        filename.write_bytes(MAP_SVG)
+        indego = IndegoClient(**test_config, map_filename=str(filename))
+        assert indego.render_map() is None
+        indego._update_state(STATE_RESPONSE)
+        model = indego.load_map_model()
+        assert model.version == STATE_RESPONSE["mapsvgcache_ts"]
+        filename.write_bytes(b"<svg/>")
+        assert indego.load_map_model() is model
+        assert '<circle cx="720" cy="424" r="4" fill="red"/>' in indego.render_map(4, "red")
+        indego._update_state({**STATE_RESPONSE, "mapsvgcache_ts": 1})
+        assert indego.load_map_model().lawns == []
+
+    def test_occupancy_grid(self, tmp_path):
+        """Test the coverage of the lawn from the state positions."""
+        np = pytest.importorskip("numpy")
+        grid = OccupancyGrid.from_map_model(parse_map(MAP_SVG), 100)
+        assert grid.shape == (6, 8) and int(grid.lawn.sum()) == 24
+        grid.add_positions(np.array([150, 250, 10, 150]), np.array([150, 150, 10, 150]), 100.0)
+        assert grid.coverage() == 100 * 2 / 24
+        assert grid.visits[1, 1] == 2 and grid.visits[0, 0] == 1
+        grid.add_positions([-5, 900], [10, 10], [200, 200])
+        assert int(grid.visits.sum()) == 4
+
+        oldest = grid.least_recently_mowed(count=2, region_size=2)
+        assert [region["last_mowed"] for region in oldest] == [0, 0]
+        assert grid.least_recently_mowed(count=100, region_size=2)[-1] == {
+            "x": 0, "y": 0, "width": 200, "height": 200, "last_mowed": 100.0
+        }
+        grid.start_session()
+        assert grid.session_coverage() == 0 and grid.coverage() > 0
+
+        filename = tmp_path / "map.svg"
+        filename.write_bytes(MAP_SVG)
+        indego = IndegoClient(**test_config, map_filename=str(filename))
+        with pytest.raises(ValueError):
+            indego.set_coverage_tracking()
+        indego._update_operating_data(OPERATING_RESPONSE)
+        indego.load_map_model()
+        assert indego.set_coverage_tracking().cell_size == OPERATING_RESPONSE["garden"]["map_cell_size"]
+        grid = indego.set_coverage_tracking(cell_size=100)
+        indego._update_state({**STATE_RESPONSE, "svg_xPos": 650, "svg_yPos": 450})
+        indego._update_state({**STATE_RESPONSE, "svg_xPos": 150, "svg_yPos": 150})
+        assert grid.session_coverage() == 100 * 2 / 24
+        indego._update_state({"svg_xPos": 150, "svg_yPos": 150, "runtime": {"session": {"operate": 1, "charge": 0}}})
+        assert grid.session_coverage() == 100 / 24 and grid.coverage() == 100 * 2 / 24
+        assert indego.set_coverage_tracking(False) is None and indego.occupancy_grid is None
+
+    def test_history(self):
+        """Test the ring buffer history and its range queries."""
+        history = History(4)
+        nbytes = history.nbytes
+        for timestamp in range(1, 7):
+            history.record(State(state=timestamp, xPos=timestamp), None, timestamp)
+        history.record(State(state=99), None, 2)
+        assert len(history) == 4 and history.nbytes == nbytes
+        assert history.column("timestamp") == [3, 4, 5, 6]
+        assert history.column("state", 4, 5) == [4, 5]
+        assert history.column("state", 5.5) == [6] and history.column("state", 7) == []
+        row = history.latest()
+        assert row["state"] == 6 and row["x"] == 6 and row["error"] == -1 and math.isnan(row["battery_voltage"])
+        assert [row["timestamp"] for row in history.range(end=4)] == [3, 4]
+        history.clear()
+        assert history.latest() is None and history.last_timestamp is None
+
+        indego = IndegoClient(**test_config)
+        indego.set_history(100)
+        indego._update_generic_data(GENERIC_RESPONSE)
+        indego._update_state(STATE_RESPONSE)
+        indego._update_operating_data(OPERATING_RESPONSE)
+        assert len(indego.history) == 2
+        row = indego.history.latest()
+        assert row["state"] == STATE_RESPONSE["state"] and row["mowed"] == STATE_RESPONSE["mowed"]
+        assert row["battery_voltage"] == OPERATING_RESPONSE["battery"]["voltage"]
+        assert row["battery_percent"] == indego.operating_data.battery.percent_adjusted
+
+        np = pytest.importorskip("numpy")
+        columns = indego.history.to_numpy()
+        assert columns["state"].dtype == np.int64 and list(columns["state"]) == [STATE_RESPONSE["state"]] * 2
+        assert np.isnan(columns["battery_voltage"][0])
+
+    def test_telemetry_log(self, tmp_path):
+        """Test appending to segments, resuming after a restart and reading through memory maps."""
+        np = pytest.importorskip("numpy")
+        history = History(10)
+        log = TelemetryLog(str(tmp_path), "123", segment_records=4, fsync_records=2)
+        for timestamp in range(1, 7):
+            history.record(State(state=timestamp, xPos=timestamp * 10), None, timestamp)
+            log.append(tuple(history.latest().values()))
+        log.close()
+        assert len(segment_files(str(tmp_path / "123"))) == 2
+
+        last = segment_files(str(tmp_path / "123"))[-1]
+        with open(last, "ab") as file:
+            file.write(b"partial")
+        with TelemetryLog(str(tmp_path), "123", segment_records=4) as log:
+            log.append(tuple(history.latest().values()))
+            log.append((7.0,) + tuple(history.latest().values())[1:])
+
+        with TelemetryReader(str(tmp_path), "123") as reader:
+            segments = reader.segments()
+            assert [len(segment) for segment in segments] == [4, 4]
+            assert not segments[0].flags.owndata and not segments[0].flags.writeable
+            records = reader.read()
+            assert list(records["timestamp"]) == [1, 2, 3, 4, 5, 6, 6, 7]
+            assert list(records["x"][:3]) == [10, 20, 30] and records["error"][0] == -1
+            assert list(reader.read(3, 5)["state"]) == [3, 4, 5]
+            assert reader.read(4, 4).base is not None
+            assert len(reader.read(8)) == 0
+            del segments, records
+
+        indego = IndegoClient(**test_config)
+        indego.set_telemetry_log(str(tmp_path))
+        indego._update_state(STATE_RESPONSE)
+        indego.set_telemetry_log(None)
+        with TelemetryReader(str(tmp_path), test_config["serial"]) as reader:
+            assert list(reader.read()["state"]) == [STATE_RESPONSE["state"]]
+            assert np.isnan(reader.read()["battery_voltage"][0])
+
+        # The last timestamp of a full segment is kept after a restart.
+        with TelemetryLog(str(tmp_path), "456", segment_records=2) as log:
+            log.append((5.0,) + tuple(history.latest().values())[1:])
+            log.append((6.0,) + tuple(history.latest().values())[1:])
+        with TelemetryLog(str(tmp_path), "456", segment_records=2) as log:
+            log.append((4.0,) + tuple(history.latest().values())[1:])
+        assert len(segment_files(str(tmp_path / "456"))) == 1
+
+        with pytest.raises(ValueError):
+            IndegoClient(token="token").set_telemetry_log(str(tmp_path))
+
+    async def test_telemetry_log_async(self, tmp_path):
+        """Test that the async client writes the telemetry log in the executor."""
+        threads = []
+        log = TelemetryLog(str(tmp_path), test_config["serial"], fsync_records=1)
+        sync = log.sync
+        log.sync = lambda: threads.append(threading.get_ident()) or sync()
+        indego = IndegoAsyncClient(**test_config)
+        indego.set_telemetry_log(log)
+        indego._update_state(STATE_RESPONSE)
+        await indego.close()
+        assert threads and threads[0] != threading.get_ident()
+        assert len(segment_files(str(tmp_path / test_config["serial"]))) == 1
+        indego.set_telemetry_log(None)
+
+    def test_rollup(self, tmp_path):
+        """Test hourly and daily rollups and the retention of the raw history."""
+        day = 20 * 86400
+        history = History(100)
+        rows = [
+            (day + 0, 258, 80, 10, 1000),  # docked
+            (day + 1800, 513, 75, 20, 1000),  # mowing from 00:30
+            (day + 5400, 258, 60, 50, 1100),  # docked at 01:30
+            (day + 7200, 258, 70, 50, 1100),
+            (day + 86400 + 60, 513, 90, 0, 1100),  # next day after a gap
+        ]
+        for timestamp, state, battery, mowed, operate in rows:
+            history.append((timestamp, state, -1, 0, 0, battery, 25.0, 30, mowed, operate, 10))
+        engine = RollupEngine()
+        assert engine.compact(history, retention=3600, now=day + 3 * 3600) == 3
+        assert history.column("timestamp") == [day + 7200, day + 86460]
+
+        first, second, third = engine.query("hourly", day, day + 7200)
+        assert first.state_time == {"Docked": 1800, "Mowing": 1800} and first.samples == 2
+        assert second.state_time == {"Mowing": 1800, "Docked": 1800} and second.runtime_operate == 100
+        assert (second.battery_min, second.battery_max, second.mowed_first) == (60, 60, 50)
+        assert third.state_time == {}
+        daily = engine.query("daily")
+        assert [rollup.start for rollup in daily] == [day, day + 86400]
+        assert daily[0].state_time == {"Docked": 3600, "Mowing": 3600}
+        assert (daily[0].battery_min, daily[0].battery_max, daily[0].battery_mean) == (60, 80, 71.25)
+        assert (daily[0].mowed_first, daily[0].mowed_last, daily[0].runtime_operate) == (10, 50, 100)
+
+        history.append((day + 86460 + 600, 258, -1, 0, 0, math.nan, 25.0, 30, 10, 1200, 10))
+        engine.compact(history, retention=3600, now=day + 86400 + 3600)
+        assert engine.query("daily")[1].state_time == {"Mowing": 600}
+        filename = str(tmp_path / "rollups.json")
+        engine.save(filename)
+        loaded = RollupEngine.load(filename)
+        assert [rollup.as_dict() for rollup in loaded.query()] == [rollup.as_dict() for rollup in engine.query()]
+        assert loaded.last_timestamp == day + 86460 + 600
+        with pytest.raises(ValueError):
+            engine.query("weekly")
+
+        pytest.importorskip("numpy")
+        with TelemetryLog(str(tmp_path), "123", segment_records=2) as log:
+            for timestamp, state, battery, mowed, operate in rows:
+                log.append((timestamp, state, -1, 0, 0, battery, 25.0, 30, mowed, operate, 10))
+        engine = RollupEngine()
+        assert engine.compact_telemetry(str(tmp_path), "123", retention=3600, now=day + 86400 + 3600) == 1
+        assert engine.query("daily")[0].state_time == {"Docked": 3600, "Mowing": 3600}
+        assert len(segment_files(str(tmp_path / "123"))) == 2
+
+    @pytest.mark.asyncio
+    async def test_snapshot_restore(self, tmp_path):
+        """Test restoring the attributes of a client from a snapshot without requests."""
+        indego = IndegoClient(**test_config)
+        indego._update_alerts([ALERT_RESPONSE])
+        indego._update_calendar(PREDICTIVE_CALENDAR_RESPONSE)
+        indego._update_generic_data(GENERIC_RESPONSE)
+        indego._update_operating_data(OPERATING_RESPONSE)
+        indego._update_state(STATE_RESPONSE)
+        indego._update_state(STATE_UPDATE_RESPONSE)
+        indego._update_next_mow(NEXT_CUTTING_RESPONSE)
+        indego._update_user(USER_RESPONSE)
+        filename = str(tmp_path / "snapshot.json.gz")
+        data = indego.snapshot(filename)
+        assert set(data["payloads"]) == {
+            "alerts", "calendar", "generic_data", "operating_data", "state", "next_mow", "user"
+        }
+        assert data["payloads"]["state"]["state"] == STATE_UPDATE_RESPONSE["state"]
+
+        with patch("requests.request") as request:
+            restored = IndegoClient(**test_config)
+            restored.set_history(100)
+            restored.restore(filename)
+            assert request.call_count == 0
+        # Restored data is not recorded again as new history rows.
+        assert len(restored.history) == 0
+        for attribute in ("alerts", "calendar", "generic_data", "operating_data", "state", "next_mow", "user"):
+            assert getattr(restored, attribute) == getattr(indego, attribute)
+        assert restored.operating_data.battery.percent_adjusted == indego.operating_data.battery.percent_adjusted
+        # Nothing reached the API, so the client is not online and the data keeps its snapshot age.
+        assert restored._alerts_loaded and not restored.online
+        assert restored.fetch_info("state").timestamp == indego.fetch_info("state").timestamp
+        assert restored.fetch_info("state").source == "snapshot" and indego.fetch_info("state").source == "network"
+
+        old = {**data, "created": data["created"] - 3600, "fetched": {}}
+        restored = IndegoClient(**test_config)
+        restored.restore(old)
+        assert restored.fetch_info("state").timestamp == old["created"]
+        with patch("requests.request", return_value=MockResponseSync(STATE_RESPONSE, 200)) as request:
+            restored.ensure_fresh("state", 60)
+            assert request.call_count == 1
+        assert restored.online and restored.fetch_info("state").source == "network"
+
+        restored = IndegoClient(**test_config)
+        restored.restore({**data, "payloads": {**data["payloads"], "config": {}}, "fetched": {**data["fetched"], "config": 1}})
+        assert restored.fetch_info("config") is None and restored.config is None
+
+        with pytest.raises(ValueError):
+            IndegoClient(serial="other", token="token").restore(data)
+        with pytest.raises(ValueError):
+            IndegoClient(**test_config).restore({**data, "version": 0})
+
+        with patch("pyIndego.IndegoAsyncClient.start", return_value=True):
+            async with IndegoAsyncClient(token="token") as indego_async:
+                await indego_async.restore(filename)
+                assert indego_async.serial == test_config["serial"]
+                assert indego_async.state == indego.state
+                assert (await indego_async.snapshot(str(tmp_path / "async.json.gz")))["fetched"] == data["fetched"]
+                await indego_async.restore((tmp_path / "async.json.gz").read_bytes())
+                assert indego_async.user == indego.user
+
+    @pytest.mark.asyncio
+    async def test_ensure_fresh(self):
+        """Test that ensure_fresh only updates old data and shares concurrent updates."""
+        with patch("requests.request", return_value=MockResponseSync(OPERATING_RESPONSE, 200)) as request:
+            indego = IndegoClient(**test_config)
+            assert indego.fetch_info("operating_data") is None
+            # A failed update is not a fetch.
+            request.return_value = MockResponseSync({}, 500)
+            indego.update_operating_data()
+            assert indego.fetch_info("operating_data") is None and "operating_data" not in indego.snapshot()["payloads"]
+            request.return_value = MockResponseSync(OPERATING_RESPONSE, 200)
+            assert indego.ensure_fresh("operating_data", max_age=60) == indego.operating_data
+            assert indego.ensure_fresh("operating_data", max_age=60) is indego.operating_data
+            assert request.call_count == 2
+            info = indego.fetch_info("operating_data")
+            assert info.source == "network" and 0 <= info.age < 60
+            with patch("time.time", return_value=info.timestamp + 61):
+                indego.ensure_fresh("operating_data", max_age=60)
+            assert request.call_count == 3
+        with pytest.raises(ValueError):
+            indego.fetch_info("map")
+
+        class CacheMiddleware(Middleware):
+            def on_request(self, client, ctx):
+                ctx.short_circuit({"available": True})
+
+        indego.add_middleware(CacheMiddleware())
+        indego._online = True
+        indego.update_updates_available()
+        assert indego.fetch_info("updates_available").source == "cache"
+        indego._update_user(USER_RESPONSE)
+        assert indego.fetch_info("user").source == "network"
+
+        with patch("aiohttp.ClientSession.request", return_value=MockResponseAsync(OPERATING_RESPONSE, 200)) as request, patch(
+                "pyIndego.IndegoAsyncClient.start", return_value=True
+        ):
+            async with IndegoAsyncClient(**test_config) as indego:
+                results = await asyncio.gather(*[indego.ensure_fresh("operating_data", 60) for _ in range(5)])
+                assert request.call_count == 1 and results[0] is indego.operating_data
+                assert await indego.ensure_fresh("operating_data", 60) is results[0]
+                assert request.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_polling_scheduler(self):
+        """Test the intervals per activity, the pre-mow window and forceRefresh handling."""
+        assert mower_activity(None) == "docked"
+        assert mower_activity(State(state=513)) == "active"
+        assert mower_activity(State(state=64513)) == "sleeping"
+        assert mower_activity(State(state=513), online=False) == "offline"
+        assert mower_activity(State(state=1537)) == "attention"
+
+        indego = IndegoClient(**test_config)
+        policy = PollingPolicy()
+        policy.intervals["state"]["active"] = 1
+        assert PollingPolicy().intervals["state"]["active"] == 15
+        scheduler = PollingScheduler(indego, PollingPolicy(force_activities=frozenset({"active", "sleeping"})))
+        assert len(scheduler.plan()) == 16 and scheduler.next_due() == 0
+        for target in scheduler.updates:
+            indego._fetched[target] = FetchInfo(1000)
+        indego._update_state({**STATE_RESPONSE, "state": 513})
+        indego._fetched["state"] = FetchInfo(1000)
+        assert scheduler.plan(1010) == [] and scheduler.next_due(1010) == 5
+        due = scheduler.plan(1015)
+        assert [request.update for request in due] == ["state"] and due[0].kwargs == {"force": True}
+        assert [request.update for request in scheduler.plan(1060)] == ["state", "operating_data"]
+
+        indego._update_state({"state": 64513})
+        indego._fetched["state"] = FetchInfo(1000)
+        assert scheduler.plan(1899) == []
+        due = scheduler.plan(1900)
+        assert [request.update for request in due] == ["state", "alerts"] and due[0].kwargs == {}
+
+        indego._update_state({"state": 258})
+        indego._fetched["state"] = FetchInfo(1000)
+        assert scheduler.plan(1030) == []
+        indego.next_mow = datetime.fromtimestamp(1300, timezone.utc)
+        assert [request.update for request in scheduler.plan(1030)] == ["state"]
+
+        with patch("requests.request", return_value=MockResponseSync(STATE_RESPONSE, 200)) as request:
+            scheduler = PollingScheduler(IndegoClient(**test_config), updates=["state"])
+            assert scheduler.run_pending() == 1 and scheduler.run_pending() == 0
+            assert request.call_count == 1
+
+        sleeping = {**STATE_RESPONSE, "state": 64513}
+        with patch("aiohttp.ClientSession.request", return_value=MockResponseAsync(sleeping, 200)) as request, patch(
+                "pyIndego.IndegoAsyncClient.start", return_value=True
+        ):
+            async with IndegoAsyncClient(**test_config) as indego:
+                scheduler = PollingScheduler(
+                    indego, PollingPolicy(force_activities=frozenset({"sleeping"})), updates=["state"]
+                )
+                indego._fetched["state"] = FetchInfo(0)
+                indego._update_state(sleeping)
+                indego._fetched["state"] = FetchInfo(0)
+                stop = asyncio.Event()
+                stop.set()
+                await scheduler.run(stop)
+                assert await scheduler.async_run_pending() == 1
+                assert request.call_count == 1
+                assert "forceRefresh" not in request.call_args.kwargs["url"]
+
+    async def test_fleet_scheduler(self):
+        """Test the timing wheel and the jitter and dispatch limits of the fleet scheduler."""
+        with pytest.raises(ValueError):
+            TimingWheel(slots=4, levels=1)
+        wheel = TimingWheel(slots=4, levels=2)
+        timers = [wheel.schedule(expiry, expiry) for expiry in (0, 1, 5, 17, 40)]
+        assert len(wheel) == 5 and wheel.next_expiry() == 0
+        assert wheel.cancel(timers[2]) and not wheel.cancel(timers[2])
+        assert [timer.payload for timer in wheel.advance(1)] == [0, 1]
+        assert [timer.payload for timer in wheel.advance(16)] == []
+        assert [timer.payload for timer in wheel.advance(17)] == [17]
+        assert [timer.payload for timer in wheel.advance(40)] == [40] and len(wheel) == 0
+        # Timers far beyond slots**levels ticks expire on their own tick.
+        wheel = TimingWheel(slots=4, levels=2)
+        expiries = [3, 15, 16, 17, 63, 64, 100, 257]
+        for expiry in expiries:
+            wheel.schedule(expiry, expiry)
+        for tick in range(1, 260):
+            assert [timer.payload for timer in wheel.advance(tick)] == [tick] * (tick in expiries)
+
+        clients = [IndegoAsyncClient(**{**test_config, "serial": str(serial)}) for serial in range(50)]
+        calls = []
+
+        def fake_update(client, update):
+            async def update_target(**kwargs):
+                calls.append((client.serial, update))
+                await asyncio.sleep(0)
+
+            return update_target
+
+        for client in clients:
+            client.update_state = fake_update(client, "state")
+            client.update_alerts = fake_update(client, "alerts")
+        fleet = FleetScheduler(updates=["state", "alerts"], max_concurrency=30, max_dispatch_per_tick=20)
+        now = fleet._now()
+        for client in clients:
+            fleet.add_client(client, now)
+        with pytest.raises(ValueError):
+            fleet.add_client(clients[0], now)
+        due = [fleet.due_in(client.serial, "state", now) for client in clients]
+        assert all(0 <= value < 15 for value in due) and len(set(int(value) for value in due)) > 5
+
+        assert fleet.run_pending(now + 60) == 20 and fleet.queued == 80 and fleet.in_flight == 20
+        assert fleet.run_pending(now + 60) == 10 and fleet.in_flight == 30
+        await asyncio.sleep(0.01)
+        assert fleet.in_flight == 0 and len(calls) == 30
+        assert fleet.run_pending(now + 60) == 20
+        await asyncio.sleep(0.01)
+        assert len(calls) == 50 and len(set(calls)) == 50
+
+        # A docked mower polls the state every 2 minutes, with the same jitter of at most 10 percent per mower.
+        serial, update = calls[0]
+        delay = fleet.due_in(serial, update)
+        assert 108 <= delay <= 132
+        other = FleetScheduler(updates=["state", "alerts"])
+        assert other._delay(serial, update, 120) == fleet._delay(serial, update, 120)
+
+        fleet.remove_client(clients[0])
+        assert fleet.due_in(clients[0].serial, "state") is None
+        stop = asyncio.Event()
+        stop.set()
+        await fleet.run(stop)
+
+    def test_request_budget(self):
+        """Test the token bucket, the priorities and answering held back requests from cached data."""
+        bucket = TokenBucket(rate=1, capacity=2, now=0)
+        assert bucket.take(now=0) and bucket.take(now=0) and not bucket.take(now=0)
+        assert bucket.take(now=1) and not bucket.take(floor=0.5, now=1.2)
+        assert bucket.reserve(now=1.2) == pytest.approx(0.8)
+
+        indego = IndegoClient(**test_config)
+        with patch("time.monotonic", return_value=1000.0), patch(
+            "requests.request", return_value=MockResponseSync(STATE_RESPONSE, 200)
+        ) as request:
+            budget = RequestBudget(requests_per_minute=60, burst=10)
+            indego.set_request_budget(budget)
+            assert isinstance(indego.middlewares[0], BudgetMiddleware)
+            # The state of a sleeping mower has to leave 2 tokens, after that it is answered from the cached state.
+            for _ in range(9):
+                indego.update_state()
+            assert request.call_count == 8 and indego.fetch_info("state").source == "cache"
+            # A held back longpoll is never answered from the cached state, it waits for the budget.
+            with patch("time.sleep") as sleep:
+                indego.update_state(longpoll=True)
+                assert request.call_count == 9 and sleep.call_args[0][0] > 0
+            assert budget.priority(indego, indego._create_request_context(Methods.GET, "users/1")) == PRIORITY_BULK
+            ctx = indego._create_request_context(Methods.PUT, "alms/123456789/state", data={"state": "mow"})
+            assert budget.priority(indego, ctx) == PRIORITY_COMMAND
+            # Without cached data the request waits until the bucket is back at its reserve of 3.5 tokens.
+            request.return_value = MockResponseSync(OPERATING_RESPONSE, 200)
+            with patch("time.sleep") as sleep:
+                indego.update_operating_data()
+                assert request.call_count == 10 and sleep.call_args[0][0] == pytest.approx(3.5)
+        stats = budget.stats()
+        assert stats["priorities"]["active"]["degraded"] == 1 and stats["priorities"]["active"]["delayed"] == 1
+        assert stats["priorities"]["routine"]["delayed"] == 1
+        indego.set_request_budget(None)
+        assert len(indego.middlewares) == 2
+
+    async def test_priority_dispatcher(self):
+        """Test that commands get the first free slot and the queueing delay per class."""
+        indego = IndegoAsyncClient(**test_config)
+        assert request_class(indego._create_request_context(Methods.PUT, "alms/1/state", data={})) == "interactive"
+        assert request_class(indego._create_request_context(Methods.GET, "alms/1/state?longpoll=true")) == "longpoll"
+        assert request_class(indego._create_request_context(Methods.GET, "alms/1/operatingData")) == "refresh"
+        assert request_class(indego._create_request_context(Methods.GET, "alms/1/setup")) == "maintenance"
+        with pytest.raises(ValueError):
+            PriorityDispatcher({"bulk": 1})
+
+        dispatcher = PriorityDispatcher({"refresh": 2}, max_concurrency=1)
+        order = []
+
+        async def run(name):
+            await dispatcher.acquire(name)
+            order.append(name)
+
+        await dispatcher.acquire("refresh")
+        tasks = [asyncio.ensure_future(run(name)) for name in ("maintenance", "refresh", "refresh", "interactive")]
+        await asyncio.sleep(0)
+        assert order == [] and dispatcher.stats()["refresh"]["waiting"] == 2
+        tasks[2].cancel()
+        await asyncio.sleep(0)
+        for _ in range(3):
+            dispatcher.release(order[-1] if order else "refresh")
+            await asyncio.sleep(0)
+        assert order == ["interactive", "refresh", "maintenance"]
+        stats = dispatcher.stats()
+        assert stats["interactive"]["queued"] == 1 and stats["refresh"]["requests"] == 2 and stats["refresh"]["waiting"] == 0
+
+        # Longpolls at their own limit do not block a refresh.
+        capped = PriorityDispatcher({"longpoll": 2})
+        longpolls = [asyncio.ensure_future(capped.acquire("longpoll")) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert capped.stats()["longpoll"]["waiting"] == 1
+        await asyncio.wait_for(capped.acquire("refresh"), 1)
+        assert capped.running == 3
+        capped.release("longpoll")
+        await asyncio.gather(*longpolls)
+        assert capped.stats()["longpoll"]["running"] == 2
+
+        with patch("aiohttp.ClientSession.request", return_value=MockResponseAsync(None, 200)):
+            indego.set_dispatcher(dispatcher)
+            dispatcher.release("maintenance")
+            await indego.put_command("mow")
+            assert dispatcher.stats()["interactive"]["requests"] == 2 and dispatcher.running == 0
+        await indego.close()
+
+    async def test_connection_pools(self):
+        """Test that longpolls and short requests use separate connection pools."""
+        with patch("requests.Session.request", autospec=True, return_value=MockResponseSync(STATE_RESPONSE, 200)) as request:
+            with IndegoClient(**test_config) as indego:
+                indego.set_connection_pools(longpoll=PoolConfig(limit_per_host=50))
+                indego.update_state(longpoll=True)
+                indego.update_state()
+                sessions = [call.args[0] for call in request.call_args_list]
+                assert sessions == [indego._longpoll_session, indego._session] and sessions[0] is not sessions[1]
+                assert indego._longpoll_session.get_adapter("https://")._pool_maxsize == 50
+            assert indego._session is None
+
+        with patch("aiohttp.ClientSession.request", return_value=MockResponseAsync(STATE_RESPONSE, 200)):
+            async with IndegoAsyncClient(**test_config) as indego:
+                await indego.update_state()
+                assert indego._longpoll_session is None
+                assert indego._session.connector.limit == 100 and indego._session.connector.limit_per_host == 0
+                await indego.update_state(longpoll=True)
+                assert indego._longpoll_session is not indego._session and indego._longpoll_session.connector.limit == 0
+                await indego.set_connection_pools(PoolConfig(limit=5, limit_per_host=2), PoolConfig(limit=40))
+                assert indego._session.connector.limit == 5 and indego._longpoll_session is None
+                await indego.update_state(longpoll=True)
+                assert indego._longpoll_session.connector.limit == 40
+            assert indego._longpoll_session is None and indego._session.closed
+
+        # Longpolls use a session passed by the caller until pools are set.
+        async with ClientSession() as session:
+            with patch("aiohttp.ClientSession.request", return_value=MockResponseAsync(STATE_RESPONSE, 200)):
+                indego = IndegoAsyncClient(**test_config, session=session)
+                await indego.update_state(longpoll=True)
+                assert indego._longpoll_session is None
+                await indego.set_connection_pools(longpoll=PoolConfig(limit=40))
+                await indego.update_state(longpoll=True)
+                assert indego._longpoll_session is not session and indego._longpoll_session.connector.limit == 40
+                await indego.close()
+            assert not session.closed
+
+    def test_adaptive_timeouts(self):
+        """Test the latency percentiles and the timeouts derived from them."""
+        tracker = LatencyTracker(window=100)
+        key = ("GET", "alms/{serial}/state")
+        assert tracker.percentile(key, 0.99) is None
+        for latency in range(1, 201):
+            tracker.observe(key, latency / 100)
+        assert tracker.count(key) == 100 and tracker.percentile(key, 0.5) == 1.5 and tracker.percentile(key, 0.99) == 1.99
+        policy = TimeoutPolicy(factor=2, floor=1, ceiling=20, connect_timeout=3, min_samples=10)
+        assert policy.read_timeout(None, 10) == 10 and policy.read_timeout(0.1, 10) == 1
+        assert policy.read_timeout(4, 10) == 8 and policy.read_timeout(4, 5) == 5
+
+        indego = IndegoClient(**test_config)
+        assert indego.set_adaptive_timeouts(policy=policy, tracker=tracker) is tracker
+        with patch("requests.request", return_value=MockResponseSync(STATE_RESPONSE, 200)) as request:
+            indego.update_state()
+            assert request.call_args.kwargs["timeout"] == (3, 3.98)
+            request.return_value = MockResponseSync(OPERATING_RESPONSE, 200)
+            indego.update_operating_data()
+            assert request.call_args.kwargs["timeout"] == (3, 30)
+            assert tracker.count(("GET", "alms/{serial}/operatingData")) == 1
+            request.return_value = MockResponseSync(STATE_RESPONSE, 200)
+            indego.update_state(longpoll=True, longpoll_timeout=60)
+            assert request.call_args.kwargs["timeout"] == (3, 70)
+        with patch("requests.request", side_effect=Timeout("timeout")):
+            indego.update_operating_data()
+        assert tracker.count(("GET", "alms/{serial}/operatingData")) == 2
+        assert tracker.percentile(("GET", "alms/{serial}/operatingData"), 1) == 30
+        # A fast connection error is not a latency.
+        middleware = AdaptiveTimeoutMiddleware(policy, LatencyTracker())
+        ctx = indego._create_request_context(Methods.GET, "alms/123456789/state")
+        ctx.elapsed, ctx.error = 0.01, ClientOSError()
+        middleware.on_response(IndegoAsyncClient, ctx)
+        ctx.error = ServerTimeoutError()
+        middleware.on_response(IndegoAsyncClient, ctx)
+        assert middleware.tracker.percentile(("GET", "alms/{serial}/state"), 0) == ctx.timeout
+        assert indego.set_adaptive_timeouts(False) is None
+        with patch("requests.request", return_value=MockResponseSync(STATE_RESPONSE, 200)) as request:
+            indego.update_state()
+            assert request.call_args.kwargs["timeout"] == 10
+
+    async def test_hedging(self):
+        """Test that a slow GET is hedged, the first answer wins and the hedge rate is capped."""
+        hedger = Hedger(max_rate=0.25, min_samples=1)
+        hedger.tracker.observe(("GET", "alms/{serial}/state"), 0.01)
+        slow = []
+
+        async def send(ctx):
+            ctx.mark_sent()
+            try:
+                await asyncio.sleep(0.2 if slow.pop(0) else 0)
+                ctx.status = 200
+                ctx.result = ctx.request_id
+            except asyncio.CancelledError as exc:
+                ctx.error = exc
+            finally:
+                ctx.mark_done()
+
+        indego = IndegoAsyncClient(**test_config)
+        ctx = indego._create_request_context(Methods.GET, "alms/123456789/state")
+        slow.extend([True, False])
+        await hedger.send(ctx, send)
+        assert ctx.result == f"{ctx.request_id}-H" and ctx.extras["hedged"] and ctx.error is None
+        assert hedger.stats() == {"requests": 1, "hedged": 1, "hedge_wins": 1}
+        assert hedger.tracker.count(("GET", "alms/{serial}/state")) == 2
+
+        # The budget is used up, the next slow request is not hedged.
+        ctx = indego._create_request_context(Methods.GET, "alms/123456789/state")
+        slow.extend([True])
+        await hedger.send(ctx, send)
+        assert ctx.result == ctx.request_id and hedger.stats()["hedged"] == 1
+
+        assert not Hedger.eligible(indego._create_request_context(Methods.PUT, "alms/123456789/state", data={}))
+        assert not Hedger.eligible(indego._create_request_context(Methods.GET, "alms/123456789/state?longpoll=true"))
+        assert indego.set_hedging(hedger=hedger) is hedger
+        with patch("aiohttp.ClientSession.request", return_value=MockResponseAsync(STATE_RESPONSE, 200)):
+            await indego.update_state()
+            assert indego.state.state == 64513 and hedger.stats()["requests"] == 3
+            await indego.put_command("mow")
+            assert hedger.stats()["requests"] == 3
+        assert indego.set_hedging(False) is None
+        await indego.close()
+
+    def test_circuit_breaker(self):
+        """Test that a failing endpoint opens its breaker, fails fast with cached data and is probed once."""
+        breaker = CircuitBreaker(failure_rate=0.5, min_requests=2, window=4, open_duration=10)
+        breaker.record(True, 0)
+        assert breaker.allow(0)
+        breaker.record(True, 0)
+        assert breaker.state == "open" and not breaker.allow(5)
+        assert breaker.allow(10) and breaker.state == "half_open" and not breaker.allow(10)
+        breaker.record(False, 11, probe=True)
+        assert breaker.state == "closed" and breaker.as_dict()["trips"] == 1 and breaker.as_dict()["rejected"] == 2
+
+        breakers = CircuitBreakers(min_requests=4, window=4, open_duration=30)
+        indego = IndegoClient(**test_config)
+        indego.set_circuit_breakers(breakers)
+        assert indego.middlewares[0] is breakers
+        with patch("requests.request", return_value=MockResponseSync(STATE_RESPONSE, 200)) as request:
+            indego.update_state()
+            request.return_value = MockResponseSync({}, 502)
+            for _ in range(3):
+                indego.update_state()
+            assert breakers.state("alms/{serial}/state") == "open" and request.call_count == 4
+            indego.update_state()
+            assert request.call_count == 4 and indego.state.state == 64513
+            assert indego.fetch_info("state").source == "cache"
+
+            other = IndegoClient(**test_config, raise_request_exceptions=True)
+            other.set_circuit_breakers(breakers)
+            with pytest.raises(CircuitOpenError):
+                other.update_state()
+            # A longpoll is not answered from cache, it waits for the probe window and then fails.
+            with patch("time.sleep") as sleep:
+                with pytest.raises(CircuitOpenError):
+                    other.update_state(longpoll=True)
+                assert 29 < sleep.call_args.args[0] <= 30
+                assert indego.update_state(longpoll=True) is None and sleep.call_count == 2
+            assert request.call_count == 4 and indego.fetch_info("state").source == "cache"
+
+            request.return_value = MockResponseSync(STATE_RESPONSE, 200)
+            with patch("time.monotonic", return_value=time.monotonic() + 31):
+                other.update_state()
+            assert request.call_count == 5 and breakers.state("alms/{serial}/state") == "closed"
+        assert breakers.stats()["alms/{serial}/state"]["trips"] == 1
+        indego.set_circuit_breakers(None)
+        assert breakers not in indego.middlewares
+
+    def test_retry_policy(self):
+        """Test that only GETs are retried, with jittered delays, a maximum of attempts and metrics."""
+        policy = RetryPolicy(max_attempts=3, base_delay=1, max_delay=5, deadline=30)
+        delays = [policy.next_delay(previous) for previous in (1, 2, 4) for _ in range(20)]
+        assert all(1 <= delay <= 5 for delay in delays) and len(set(delays)) > 1
+
+        indego = IndegoClient(**test_config)
+        indego.set_retry_policy(policy)
+        with patch("requests.request") as request, patch("time.sleep") as sleep:
+            request.side_effect = [MockResponseSync({}, 502), MockResponseSync(STATE_RESPONSE, 200)]
+            indego.update_state()
+            assert request.call_count == 2 and sleep.call_count == 1 and indego.state.state == 64513
+            assert 1 <= sleep.call_args[0][0] <= 3
+
+            request.reset_mock(side_effect=True)
+            request.return_value = MockResponseSync({}, 502)
+            indego.put_command("mow")
+            assert request.call_count == 1
+            indego.update_state(longpoll=True)
+            assert request.call_count == 2
+
+            request.reset_mock(return_value=True)
+            request.side_effect = Timeout("timeout")
+            indego.update_state()
+            assert request.call_count == 3
+        assert policy.stats() == {"alms/{serial}/state": {"retries": 3, "recovered": 1, "exhausted": 1}}
+        metrics = indego.metrics()["GET"]["alms/{serial}/state"]
+        assert (metrics["retries"], metrics["retries_recovered"], metrics["retries_exhausted"]) == (3, 1, 1)
+        assert 'pyindego_request_retries_total{method="GET",endpoint="alms/{serial}/state",longpoll="false"} 3' in (
+            indego.metrics_prometheus()
+        )
+
+        # The attempt that just failed is counted once against the deadline.
+        policy = RetryPolicy(base_delay=2, max_delay=2, deadline=10)
+        ctx = indego._create_request_context(Methods.GET, "alms/123456789/state")
+        with patch("time.monotonic", side_effect=[0, 7]):
+            policy.on_request(indego, ctx)
+            ctx.elapsed, ctx.status = 7, 502
+            policy.on_response(indego, ctx)
+        assert ctx.replay and ctx.delay == 2
+        indego.set_retry_policy(None)
+        assert policy not in indego.middlewares
+
+    async def test_token_refresh_on_401(self):
+        """Test that a 401 invalidates and refreshes the token once for concurrent requests and replays them."""
+        calls = []
+        # A caching callback, the API rejects the token before it expires.
+        cached = ["old"]
+
+        async def refresh():
+            calls.append(1)
+            await asyncio.sleep(0)
+            return cached[-1]
+
+        async def invalidate():
+            cached.append("new")
+
+        def respond(**kwargs):
+            status = 401 if kwargs["headers"]["Authorization"] == "Bearer old" else 200
+            return MockResponseAsync(USER_RESPONSE, status)
+
+        with patch("aiohttp.ClientSession.request", side_effect=respond) as request:
+            indego = IndegoAsyncClient(
+                token="old", token_refresh_method=refresh, serial="123456789", token_invalidate_method=invalidate
+            )
+            results = await asyncio.gather(indego.get("users/1"), indego.get("users/2"))
+            assert results == [USER_RESPONSE, USER_RESPONSE] and request.call_count == 4
+            # Both requests got a 401 and shared a single refresh.
+            assert len(calls) == 3 and cached == ["old", "new"] and indego._token == "new"
+            await indego.close()
+
+        # Without an invalidate callback the cached token comes back and the request is not replayed.
+        with patch("aiohttp.ClientSession.request", side_effect=respond) as request:
+            calls.clear()
+            cached[:] = ["old"]
+            indego = IndegoAsyncClient(token="old", token_refresh_method=refresh, serial="123456789")
+            assert await indego.get("users/1") == {}
+            assert request.call_count == 1 and len(calls) == 2 and indego._token == "old"
+            await indego.close()
+
+        tokens = ["same"]
+        with patch("requests.request", return_value=MockResponseSync(USER_RESPONSE, 401)) as request:
+            indego = IndegoClient(token="same", token_refresh_method=lambda: tokens[-1])
+            # Without invalidation the cached token comes back and the request is not replayed.
+            indego.update_user()
+            assert request.call_count == 1 and indego.user is None
+            indego._token_invalidate_method = lambda: tokens.append("new")
+            request.side_effect = [MockResponseSync(USER_RESPONSE, 401), MockResponseSync(USER_RESPONSE, 200)]
+            indego.update_user()
+            assert request.call_count == 3 and indego.user is not None
+            assert request.call_args.kwargs["headers"]["Authorization"] == "Bearer new"
+
+    def test_request_headers_not_changed(self):
+        """Test that the headers of the caller are copied and not changed by the request."""
+        headers = {"Accept": "application/json"}
+        with patch("requests.request", return_value=MockResponseSync(None, 200)) as request:
+            indego = IndegoClient(**test_config)
+            indego._request(Methods.PUT, "alms/123456789/state", data={"state": "mow"}, headers=headers)
+            assert request.call_args.kwargs["headers"] is not headers
+        assert headers == {"Accept": "application/json"}
+
     def test_update_battery(self):
         """Test the battery update function."""
         indego = IndegoClient(**test_config)